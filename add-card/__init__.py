@@ -1,17 +1,23 @@
 import azure.functions as func
 import json
 import logging
-from shared_code.db_client import CosmosDBClient
-from shared_code.middleware import check_payment_access
+from shared_code.middleware import check_payment_access, RequestContext
 import stripe
-from datetime import datetime
+from shared_code import clients
+from shared_code.patch import Patch
+from shared_code.telemetry import track_invocation
+from shared_code.card_summaries import card_summary, CARD_SUMMARIES
+from shared_code.stripe_gateway import get_stripe_gateway, StripeUnavailable, stripe_unavailable_response, CHARGE_DEADLINE_SECONDS
 
+clients.configure_stripe()
+
+@track_invocation('add-card')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         email = req_body.get('email')
         payment_method_id = req_body.get('payment_method_id')
         
@@ -26,7 +32,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         try:
-            payment_setup = db_client.get_payment_setup(email)
+            payment_setup = request_context.payment_setup
             
             if not payment_setup:
                 return func.HttpResponse(
@@ -38,29 +44,25 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     status_code=404
                 )
 
-            payment_method = stripe.PaymentMethod.attach(
+            payment_method = get_stripe_gateway().call(
+                stripe.PaymentMethod.attach,
                 payment_method_id,
-                customer=payment_setup['stripe_customer_id']
+                customer=payment_setup['stripe_customer_id'],
+                deadline=CHARGE_DEADLINE_SECONDS
             )
 
-            current_payment_methods = payment_setup.get('payment_methods', [])
-            current_payment_methods.append(payment_method.id)
-            
-            payment_setup['payment_methods'] = current_payment_methods
-            payment_setup['updated_at'] = datetime.utcnow().isoformat()
+            card_details = card_summary(payment_method)
 
-            result = db_client.payment_container.replace_item(
-                item=payment_setup['id'],
-                body=payment_setup
-            )
+            if 'payment_methods' in payment_setup:
+                patch = Patch().add('/payment_methods/-', payment_method.id)
+            else:
+                patch = Patch().set('payment_methods', [payment_method.id])
+            if CARD_SUMMARIES in payment_setup:
+                patch.add(f'/{CARD_SUMMARIES}/-', card_details)
+            else:
+                patch.set(CARD_SUMMARIES, [card_details])
 
-            card_details = {
-                'id': payment_method.id,
-                'brand': payment_method.card.brand,
-                'last4': payment_method.card.last4,
-                'exp_month': payment_method.card.exp_month,
-                'exp_year': payment_method.card.exp_year
-            }
+            result = db_client.patch_payment_setup(email, patch)
 
             return func.HttpResponse(
                 json.dumps({
@@ -75,6 +77,9 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=200
             )
 
+        except StripeUnavailable as e:
+            return stripe_unavailable_response(e)
+
         except stripe.error.CardError as e:
             logging.error(f'Card error: {str(e)}')
             return func.HttpResponse(
@@ -2,18 +2,22 @@ import azure.functions as func
 import json
 import logging
 import stripe
-import os
-from shared_code.db_client import CosmosDBClient
-from shared_code.middleware import check_payment_access
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code import clients
+from shared_code.telemetry import track_invocation
+from shared_code.stripe_gateway import get_stripe_gateway, StripeUnavailable, stripe_unavailable_response, CHARGE_DEADLINE_SECONDS
+from shared_code.constants import CREDIT_SETTLEMENT_MODE, CREDIT_SETTLEMENT_WEBHOOK
+from shared_code.credit_purchases import credit_purchase_metadata, record_credit_purchase, settle_credit_purchase
 
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+clients.configure_stripe()
 
+@track_invocation('add-credits')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+async def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
 
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         logging.info(f"Request body: {req_body}")
         
         email = req_body.get('email')
@@ -42,7 +46,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
 
-        payment_setup = db_client.get_payment_setup(email)
+        payment_setup = request_context.payment_setup
         if not payment_setup:
             return func.HttpResponse(
                 json.dumps({
@@ -77,54 +81,64 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
         try:
             amount_in_cents = credit_amount * 100  # 50 becomes 5000 cents
-            
-            payment_intent = stripe.PaymentIntent.create(
+            intent_params = dict(
                 amount=amount_in_cents,
                 currency='usd',
                 customer=payment_setup['stripe_customer_id'],
                 payment_method=payment_method_id,
-                off_session=True,
-                confirm=True,
                 description=f'Purchase of ${credit_amount}.00 credits',
-                metadata={
-                    'credit_amount': credit_amount,
-                    'user_email': email
-                }
+                metadata=credit_purchase_metadata(email, credit_amount)
             )
+            deadline = None
+            if CREDIT_SETTLEMENT_MODE != CREDIT_SETTLEMENT_WEBHOOK:
+                intent_params.update(off_session=True, confirm=True)
+                deadline = CHARGE_DEADLINE_SECONDS
 
-            if payment_intent.status == 'succeeded':
-                transaction = db_client.create_transaction(
-                    user_id=email,
-                    amount=amount_in_cents,
-                    transaction_type="credit_purchase",
-                    tokens=amount_in_cents,
-                    status='completed',
-                    stripe_session_id=payment_intent.id
-                )
-
-                current_balance = payment_setup.get('tokens', 0)
-                new_balance = current_balance + amount_in_cents
-                
-                db_client.update_tokens(
-                    email=email,
-                    tokens=new_balance
-                )
+            payment_intent = await get_stripe_gateway().call_async(stripe.PaymentIntent.create, deadline=deadline, **intent_params)
 
+            if payment_intent.status != 'succeeded':
+                # Confirmed by the client with the secret; stripe-webhook credits the tokens
+                await record_credit_purchase(db_client, payment_intent)
                 return func.HttpResponse(
                     json.dumps({
-                        "status": "success",
-                        "message": f"Successfully purchased ${credit_amount}.00 credits",
+                        "status": "pending",
+                        "message": f"Purchase of ${credit_amount}.00 credits is awaiting payment confirmation",
                         "details": {
-                            "previous_balance": current_balance,
                             "purchased_credits": amount_in_cents,
-                            "new_balance": new_balance,
-                            "transaction_id": payment_intent.id
+                            "transaction_id": payment_intent.id,
+                            "payment_status": payment_intent.status,
+                            "client_secret": payment_intent.client_secret
                         }
                     }),
                     mimetype="application/json",
-                    status_code=200
+                    status_code=202
                 )
 
+            updated_setup = await settle_credit_purchase(db_client, payment_intent)
+            if updated_setup is None:
+                # The webhook got there first
+                updated_setup = await db_client.get_payment_setup(email)
+            new_balance = updated_setup['tokens']
+            current_balance = new_balance - amount_in_cents
+
+            return func.HttpResponse(
+                json.dumps({
+                    "status": "success",
+                    "message": f"Successfully purchased ${credit_amount}.00 credits",
+                    "details": {
+                        "previous_balance": current_balance,
+                        "purchased_credits": amount_in_cents,
+                        "new_balance": new_balance,
+                        "transaction_id": payment_intent.id
+                    }
+                }),
+                mimetype="application/json",
+                status_code=200
+            )
+
+        except StripeUnavailable as e:
+            return stripe_unavailable_response(e)
+
         except stripe.error.CardError as e:
             error_msg = e.error.message
             if e.error.code == 'insufficient_funds':
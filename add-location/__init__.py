@@ -2,17 +2,27 @@
 import azure.functions as func
 import json
 import logging
-from datetime import datetime, timezone
-from shared_code.db_client import CosmosDBClient
-from shared_code.middleware import check_payment_access
+from shared_code.middleware import check_payment_access, RequestContext
 from shared_code.models import Plan
+from shared_code.telemetry import track_invocation
 
+class InsufficientCreditsError(Exception):
+    pass
+
+def debit_location_fee(payment_setup: dict):
+    """Charge the location fee against the current balance"""
+    if payment_setup.get('tokens', 0) < Plan.INITIAL_REWARD:
+        raise InsufficientCreditsError(payment_setup.get('tokens', 0))
+    payment_setup['tokens'] = payment_setup.get('tokens', 0) - Plan.INITIAL_REWARD
+    payment_setup['num_locations'] = payment_setup.get('num_locations', 0) + 1
+
+@track_invocation('add-location')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         email = req_body.get('email')
         location_name = req_body.get('location_name')
         location_address = req_body.get('location_address')
@@ -31,7 +41,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
 
-        payment_setup = db_client.get_payment_setup(email)
+        payment_setup = request_context.payment_setup
         if not payment_setup:
             return func.HttpResponse(
                 json.dumps({"error": "No payment setup found for this email"}),
@@ -39,21 +49,19 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=404
             )
 
-        current_credits = payment_setup.get('tokens', 0)
-        current_num_locations = payment_setup.get('num_locations', 0)
-        
-        if current_credits < Plan.INITIAL_REWARD:
+        try:
+            # Re-checked against the latest balance on every conflict retry
+            updated_setup = db_client.modify_payment_setup(email, debit_location_fee)
+        except InsufficientCreditsError as e:
             return func.HttpResponse(
                 json.dumps({
-                    "error": f"Insufficient credits. You need {Plan.INITIAL_REWARD} credits but have {current_credits} credits.",
+                    "error": f"Insufficient credits. You need {Plan.INITIAL_REWARD} credits but have {e.args[0]} credits.",
                     "error_code": "insufficient_credits"
                 }),
                 mimetype="application/json",
                 status_code=400
             )
 
-        current_time = datetime.now(timezone.utc).isoformat()
-
         location = db_client.create_location(
             user_id=email,
             name=location_name,
@@ -69,19 +77,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             status='completed'
         )
 
-        new_balance = current_credits - Plan.INITIAL_REWARD
-        new_num_locations = current_num_locations + 1
-        
-        updated_setup = db_client.create_payment_setup(
-            email=email,
-            status=payment_setup.get('status', 'active'),
-            tokens=new_balance,
-            stripe_customer_id=payment_setup.get('stripe_customer_id'),
-            plan_type=payment_setup.get('plan_type'),
-            custom_threshold=payment_setup.get('custom_threshold'),
-            num_locations=new_num_locations,
-            pending_fee=payment_setup.get('pending_fee', 0)
-        )
+        new_balance = updated_setup['tokens']
+        new_num_locations = updated_setup['num_locations']
 
         logging.info(
             f"Added location for user {email}:"
@@ -0,0 +1,18 @@
+import azure.functions as func
+import logging
+from shared_code.async_db_client import AsyncCosmosDBClient
+from shared_code.dispatcher import process_shard_message
+from shared_code.telemetry import track_invocation
+
+@track_invocation('billing-shard-worker')
+async def main(msg: func.QueueMessage) -> None:
+    """Queue trigger function that processes one shard of a batch billing job"""
+    message = msg.get_json()
+    logging.info(f"Processing shard {message['shard']} of {message['job']} tick {message['tick_id']} (dequeue count {msg.dequeue_count})")
+    
+    try:
+        await process_shard_message(AsyncCosmosDBClient(), message)
+        
+    except Exception as e:
+        logging.error(f"Error processing shard message {message}: {str(e)}")
+        raise
@@ -1,15 +1,21 @@
 import azure.functions as func
 import logging
+import time
 from datetime import datetime, timezone
 import asyncio
 from shared_code.billing_service import BillingService
-from shared_code.constants import MAX_RETRIES, RETRY_DELAY
+from shared_code.run_state import RunState, hourly_tick, group_by_user
+from shared_code.query import Query
+from shared_code.lease import Shard, run_shards
+from shared_code.constants import MAX_RETRIES, RETRY_DELAY, FEE_ACCRUAL_MODE, FEE_ACCRUAL_LAZY, BILLING_LEASE_NAME
+from shared_code.telemetry import track_invocation
 
 async def process_location_with_retry(
     billing_service: BillingService,
     location: dict,
     current_time: str,
-    user_fees: dict
+    user_fees: dict,
+    tick_id: str = None
 ) -> None:
     """Process a single location with retry logic"""
     user_id = location['user_id']
@@ -17,7 +23,7 @@ async def process_location_with_retry(
     
     for attempt in range(MAX_RETRIES):
         try:
-            period_fee = await billing_service.process_location_billing(location, current_time)
+            period_fee = await billing_service.process_location_billing(location, current_time, tick_id)
             user_fees[user_id] = user_fees.get(user_id, 0) + period_fee
             logging.info(f"Location {location_id} processed: ${period_fee:.4f}")
             return
@@ -32,12 +38,13 @@ async def process_location_with_retry(
 async def process_user_with_retry(
     billing_service: BillingService,
     user_id: str,
-    fee: float
+    fee: float,
+    tick_id: str = None
 ) -> None:
     """Process a single user's billing with retry logic"""
     for attempt in range(MAX_RETRIES):
         try:
-            await billing_service.process_user_billing(user_id, fee)
+            await billing_service.process_user_billing(user_id, fee, tick_id)
             logging.info(f"User {user_id} billing processed: ${fee:.4f}")
             return
         except Exception as e:
@@ -48,56 +55,110 @@ async def process_user_with_retry(
                 logging.error(f"All attempts failed for user {user_id}")
                 raise
 
+async def process_shard(
+    billing_service: BillingService,
+    shard: Shard,
+    current_time: str,
+    tick_id: str,
+    started: float
+) -> dict:
+    """Bill the users of one shard, streaming active locations in user_id order with a checkpoint per page"""
+    run_state = await RunState(billing_service.db_client, 'billing-update', tick_id, shard.index, started, shard.lease).load()
+    if run_state.completed:
+        logging.info(f"Billing update for tick {tick_id} shard {shard} already completed. Skipping.")
+        return {'completed': True}
+    
+    query = run_state.resume_query(Query('location').where('is_active', True))
+    pages = billing_service.db_client.iter_location_pages(query, page_size=run_state.batch_size)
+    total_users = 0
+    total_locations = 0
+    failed_locations = []
+    failed_users = []
+    
+    async for locations_by_user in run_state.stream(group_by_user(pages)):
+        batch = [user_id for user_id in locations_by_user if shard.contains(user_id)]
+        total_users += len(batch)
+        total_locations += sum(len(locations_by_user[user_id]) for user_id in batch)
+        results = []
+        for user_id in batch:
+            user_fees = {}
+            for location in locations_by_user[user_id]:
+                try:
+                    await process_location_with_retry(
+                        billing_service,
+                        location,
+                        current_time,
+                        user_fees,
+                        tick_id
+                    )
+                except Exception as e:
+                    failed_locations.append(location['id'])
+                    continue
+            
+            try:
+                await process_user_with_retry(
+                    billing_service,
+                    user_id,
+                    user_fees.get(user_id, 0),
+                    tick_id
+                )
+                results.append(None)
+            except Exception as e:
+                failed_users.append(user_id)
+                results.append(e)
+        
+        await run_state.record_batch(batch, results, cursor=max(locations_by_user))
+    
+    successful_locations = total_locations - len(failed_locations)
+    logging.info(f"Shard {shard}: successfully processed {successful_locations}/{total_locations} locations")
+    if failed_locations:
+        logging.error(f"Failed to process locations: {', '.join(failed_locations)}")
+    
+    logging.info(f"Shard {shard}: processed {run_state.document['counts']} of {total_users} users for tick {tick_id}")
+    if failed_users:
+        logging.error(f"Failed to process users: {', '.join(failed_users)}")
+    
+    summary = {
+        'users': total_users,
+        'locations': total_locations,
+        'failed_locations': len(failed_locations),
+        'completed': run_state.finished
+    }
+    if summary['completed']:
+        await run_state.complete(summary)
+    else:
+        logging.warning(f"Billing update for tick {tick_id} shard {shard} not finished; the next run resumes it")
+    return summary
+
+@track_invocation('billing-update')
 async def main(mytimer: func.TimerRequest) -> None:
     """Main function for hourly billing updates"""
     start_time = datetime.utcnow()
+    started = time.monotonic()
     utc_timestamp = start_time.replace(microsecond=0).isoformat()
     logging.info(f'Billing update triggered at {utc_timestamp}')
     
     if mytimer.past_due:
         logging.warning('The timer is past due!')
+
+    if FEE_ACCRUAL_MODE == FEE_ACCRUAL_LAZY:
+        # hourly-update syncs changed users and users whose threshold falls due each tick
+        logging.info('Fees accrue lazily on read. Skipping billing update.')
+        return
     
     try:
         billing_service = BillingService()
         current_time = datetime.now(timezone.utc).isoformat()
+        tick_id = hourly_tick()
         
-        active_locations = billing_service.db_client.get_active_locations()
-        total_locations = len(active_locations)
-        logging.info(f"Starting to process {total_locations} active locations")
-        
-        user_fees = {}
-        failed_locations = []
-        
-        for location in active_locations:
-            try:
-                await process_location_with_retry(
-                    billing_service,
-                    location,
-                    current_time,
-                    user_fees
-                )
-            except Exception as e:
-                failed_locations.append(location['id'])
-                continue
-        
-        successful_locations = total_locations - len(failed_locations)
-        logging.info(f"Successfully processed {successful_locations}/{total_locations} locations")
-        if failed_locations:
-            logging.error(f"Failed to process locations: {', '.join(failed_locations)}")
-        
-        failed_users = []
-        for user_id, fee in user_fees.items():
-            try:
-                await process_user_with_retry(billing_service, user_id, fee)
-            except Exception as e:
-                failed_users.append(user_id)
-                continue
-        
-        total_users = len(user_fees)
-        successful_users = total_users - len(failed_users)
-        logging.info(f"Successfully processed {successful_users}/{total_users} users")
-        if failed_users:
-            logging.error(f"Failed to process users: {', '.join(failed_users)}")
+        # Shares its lease with hourly-update, so each (tick, shard) is billed
+        # by exactly one job on exactly one instance
+        await run_shards(
+            billing_service.db_client,
+            BILLING_LEASE_NAME,
+            tick_id,
+            lambda shard: process_shard(billing_service, shard, current_time, tick_id, started)
+        )
         
         end_time = datetime.utcnow()
         duration = (end_time - start_time).total_seconds()
@@ -105,4 +166,4 @@ async def main(mytimer: func.TimerRequest) -> None:
         
     except Exception as e:
         logging.error(f"Critical error in billing update: {str(e)}")
-        raise
\ No newline at end of file
+        raise
@@ -3,8 +3,15 @@ import azure.functions as func
 import json
 import logging
 from shared_code.db_client import CosmosDBClient
+from shared_code.pending_billing import payment_required
 from datetime import datetime, timezone
+from shared_code.telemetry import track_invocation
 
+class NotPending(Exception):
+    """The transaction was settled by a concurrent request"""
+
+
+@track_invocation('check-payment-status')
 def main(req: func.HttpRequest) -> func.HttpResponse:
     db_client = CosmosDBClient()
     
@@ -20,20 +27,10 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=404
             )
 
-        query = """
-        SELECT * FROM c 
-        WHERE c.type = 'transaction' 
-        AND c.user_id = @user_id 
-        AND c.transaction_type = 'weekly_billing'
-        AND c.status = 'pending'
-        """
-        parameters = [{"name": "@user_id", "value": email}]
-        
-        pending_transactions = list(db_client.transaction_container.query_items(
-            query=query,
-            parameters=parameters,
-            enable_cross_partition_query=True
-        ))
+        if payment_required(payment_setup) is False:
+            pending_transactions = []
+        else:
+            pending_transactions = db_client.get_pending_weekly_billing(email, fields=['id', 'amount'])
 
         if pending_transactions:
             total_pending = sum(t.get('amount', 0)/100 for t in pending_transactions)
@@ -42,29 +39,44 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             logging.info(f"Tokens: {current_tokens}, Pending: {total_pending}")
 
             if current_tokens >= total_pending:
-                new_balance = current_tokens - total_pending
-                
-                current_monthly_usage = payment_setup.get('monthly_usage', 0)
-                
-                updated_setup = db_client.create_payment_setup(
-                    email=email,
-                    status=payment_setup.get('status', 'active'),
-                    tokens=new_balance,
-                    stripe_customer_id=payment_setup.get('stripe_customer_id'),
-                    plan_type=payment_setup.get('plan_type'),
-                    custom_threshold=payment_setup.get('custom_threshold'),
-                    num_locations=payment_setup.get('num_locations', 0),
-                    pending_fee=0,
-                    monthly_usage=current_monthly_usage + total_pending
-                )
+                completed_at = datetime.now(timezone.utc).isoformat()
 
-                for transaction in pending_transactions:
+                def complete(transaction):
+                    if transaction.get('status') != 'pending':
+                        raise NotPending()
                     transaction['status'] = 'completed'
-                    transaction['completed_at'] = datetime.now(timezone.utc).isoformat()
-                    db_client.transaction_container.replace_item(
-                        item=transaction['id'],
-                        body=transaction
-                    )
+                    transaction['completed_at'] = completed_at
+
+                def reopen(transaction):
+                    transaction['status'] = 'pending'
+                    transaction.pop('completed_at', None)
+
+                # Completing a transaction claims it, so of concurrent requests
+                # that read the same pending list each one debits it only once
+                claimed = []
+                for transaction in pending_transactions:
+                    try:
+                        if db_client.modify_transaction(transaction['id'], email, complete):
+                            claimed.append(transaction)
+                    except NotPending:
+                        logging.info(f"Transaction {transaction['id']} was already settled")
+                claimed_total = sum(t.get('amount', 0)/100 for t in claimed)
+
+                def settle_pending(setup):
+                    if setup.get('tokens', 0) < claimed_total:
+                        raise ValueError("Token balance no longer covers the pending transactions")
+                    setup['tokens'] = setup.get('tokens', 0) - claimed_total
+                    setup['pending_fee'] = 0
+                    setup['monthly_usage'] = setup.get('monthly_usage', 0) + claimed_total
+                
+                try:
+                    updated_setup = db_client.modify_payment_setup(email, settle_pending)
+                except Exception:
+                    # Hand the claimed transactions back so a later request can settle them
+                    for transaction in claimed:
+                        db_client.modify_transaction(transaction['id'], email, reopen)
+                    raise
+                new_balance = updated_setup['tokens']
 
                 return func.HttpResponse(
                     json.dumps({
@@ -1,16 +1,19 @@
 import azure.functions as func
 import json
 import logging
-from shared_code.db_client import CosmosDBClient
-from shared_code.middleware import check_payment_access
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code.patch import Patch
+import azure.cosmos.exceptions as exceptions
 from datetime import datetime, timezone
+from shared_code.telemetry import track_invocation
 
+@track_invocation('delete-location')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         email = req_body.get('email')
         location_id = req_body.get('location_id')
         
@@ -25,7 +28,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         try:
-            payment_setup = db_client.get_payment_setup(email)
+            payment_setup = request_context.payment_setup
             if not payment_setup:
                 return func.HttpResponse(
                     json.dumps({
@@ -36,19 +39,9 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     status_code=404
                 )
 
-            query = "SELECT * FROM c WHERE c.id = @location_id AND c.type = 'location' AND c.user_id = @user_id"
-            parameters = [
-                {"name": "@location_id", "value": location_id},
-                {"name": "@user_id", "value": email}
-            ]
-            
-            items = list(db_client.location_container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
+            existing_location = db_client.get_location(location_id, user_id=email)
 
-            if not items:
+            if not existing_location:
                 return func.HttpResponse(
                     json.dumps({
                         "error": "Location not found or you don't have permission to delete it",
@@ -58,20 +51,18 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     status_code=404
                 )
 
-            existing_location = items[0]
             current_time = datetime.now(timezone.utc).isoformat()
 
+            # Always touch the payment setup: deletes do not appear in the change feed
+            setup_patch = Patch().set('updated_at', current_time)
             if existing_location['is_active']:
-                current_num_locations = payment_setup.get('num_locations', 0)
-                new_num_locations = max(0, current_num_locations - 1)
-                
-                payment_setup['num_locations'] = new_num_locations
-                payment_setup['updated_at'] = current_time
-                
-                db_client.payment_container.replace_item(
-                    item=payment_setup['id'],
-                    body=payment_setup
-                )
+                setup_patch.incr('num_locations', -1).where("c.num_locations > 0")
+            
+            try:
+                payment_setup = db_client.patch_payment_setup(email, setup_patch)
+            except exceptions.CosmosAccessConditionFailedError:
+                payment_setup = db_client.patch_payment_setup(email, Patch().set('updated_at', current_time))
+            new_num_locations = payment_setup.get('num_locations', 0)
             
             try:
                 db_client.location_container.delete_item(
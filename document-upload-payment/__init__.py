@@ -1,20 +1,22 @@
 import azure.functions as func
 import json
 import logging
-from shared_code.db_client import CosmosDBClient
-from shared_code.middleware import check_payment_access
-from datetime import datetime, timezone
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code.patch import Patch
+import azure.cosmos.exceptions as exceptions
+from shared_code.telemetry import track_invocation
 
 def calculate_document_fee(pages: int) -> float:
     """Calculate fee for document processing"""
     return 20 * float(pages)
 
+@track_invocation('document-upload-payment')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         email = req_body.get('email')
         pages = req_body.get('pages')
         
@@ -29,13 +31,11 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         try:
-            query = f"SELECT * FROM c WHERE c.id = 'payment_{email}'"
-            items = list(db_client.payment_container.query_items(
-                query=query,
-                enable_cross_partition_query=True
-            ))
-
-            if not items:
+            fee = calculate_document_fee(pages)
+            
+            try:
+                payment_doc = db_client.patch_payment_setup(email, Patch().incr('pending_fee', fee))
+            except exceptions.CosmosResourceNotFoundError:
                 return func.HttpResponse(
                     json.dumps({
                         "error": "User payment record not found",
@@ -45,18 +45,6 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     status_code=404
                 )
 
-            payment_doc = items[0]
-            
-            fee = calculate_document_fee(pages)
-            
-            payment_doc['pending_fee'] = payment_doc.get('pending_fee', 0) + fee
-            payment_doc['updated_at'] = datetime.now(timezone.utc).isoformat()
-            
-            db_client.payment_container.replace_item(
-                item=payment_doc['id'],
-                body=payment_doc
-            )
-
             return func.HttpResponse(
                 json.dumps({
                     "status": "success",
@@ -2,15 +2,28 @@
 import azure.functions as func
 import json
 import logging
-from shared_code.db_client import CosmosDBClient
-from shared_code.middleware import check_payment_access
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code.utils import calculate_accrued_fee, get_pending_fee, get_page_params, FEE_ACCRUAL_FIELDS
+from shared_code.constants import FEE_ACCRUAL_MODE, FEE_ACCRUAL_LAZY
+from datetime import datetime, timezone
+from shared_code.telemetry import track_invocation
 
+# Location fields returned to the caller; leaves out Cosmos system
+# properties and the billing jobs' run markers
+LOCATION_FIELDS = [
+    'id', 'user_id', 'type', 'name', 'address', 'is_active', 'current_usage',
+    'monthly_fee', 'created_at', 'updated_at', 'billing_periods',
+    'last_billing_update', 'current_period_fee', 'previous_period_fee',
+    'accumulated_fee', 'activated_at', 'deactivated_at', 'deactivation_reason'
+]
+
+@track_invocation('get-locations')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+async def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         email = req_body.get('email')
         
         if not email:
@@ -21,9 +34,27 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         try:
-            locations = db_client.get_locations(email)
+            page_size, continuation = get_page_params(req_body)
+        except ValueError:
+            return func.HttpResponse(
+                json.dumps({"error": "page_size must be a positive integer"}),
+                mimetype="application/json",
+                status_code=400
+            )
+
+        try:
+            paged = page_size is not None
+            if paged:
+                locations, next_continuation = await db_client.get_locations_page(
+                    email,
+                    LOCATION_FIELDS,
+                    page_size,
+                    continuation
+                )
+            else:
+                locations = await db_client.get_locations(email, fields=LOCATION_FIELDS)
             
-            payment_setup = db_client.get_payment_setup(email)
+            payment_setup = request_context.payment_setup
             
             if not payment_setup:
                 return func.HttpResponse(
@@ -32,13 +63,30 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     status_code=404
                 )
 
+            now = datetime.now(timezone.utc)
+            if paged and FEE_ACCRUAL_MODE == FEE_ACCRUAL_LAZY:
+                # The pending fee covers every location, not just this page
+                pending_fee = get_pending_fee(
+                    payment_setup,
+                    await db_client.get_locations(email, fields=FEE_ACCRUAL_FIELDS),
+                    now
+                )
+            else:
+                pending_fee = get_pending_fee(payment_setup, locations, now)
+            for location in locations:
+                location['current_period_fee'] = calculate_accrued_fee(location, now)
+
+            response = {
+                'status': 'success',
+                'locations': locations,
+                'num_locations': payment_setup['num_locations'],
+                'pending_fee': pending_fee
+            }
+            if paged:
+                response['continuation_token'] = next_continuation
+
             return func.HttpResponse(
-                json.dumps({
-                    'status': 'success',
-                    'locations': locations,
-                    'num_locations': payment_setup['num_locations'],
-                    'pending_fee': payment_setup['pending_fee']
-                }),
+                json.dumps(response),
                 mimetype="application/json",
                 status_code=200
             )
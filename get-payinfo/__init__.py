@@ -1,33 +1,25 @@
 import azure.functions as func
 import json
 import logging
-from shared_code.db_client import CosmosDBClient
-from shared_code.middleware import check_payment_access
-import os
-import stripe
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code import clients
+from shared_code.telemetry import track_invocation
+from shared_code.card_summaries import (
+    fetch_card_summaries,
+    missing_card_summaries,
+    ordered_card_summaries,
+    apply_card_summaries
+)
 
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
-
-def get_card_details(payment_method_id):
-    try:
-        payment_method = stripe.PaymentMethod.retrieve(payment_method_id)
-        return {
-            'id': payment_method_id,
-            'brand': payment_method.card.brand,
-            'last4': payment_method.card.last4,
-            'exp_month': payment_method.card.exp_month,
-            'exp_year': payment_method.card.exp_year
-        }
-    except stripe.error.StripeError as e:
-        logging.error(f"Error retrieving card details: {str(e)}")
-        return None
+clients.configure_stripe()
 
+@track_invocation('get-payinfo')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         email = req_body.get('email')
         
         if not email:
@@ -40,7 +32,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
 
-        payment_setup = db_client.get_payment_setup(email)
+        payment_setup = request_context.payment_setup
         
         if not payment_setup:
             return func.HttpResponse(
@@ -52,13 +44,14 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=404
             )
 
-        payment_methods = payment_setup.get('payment_methods', [])
-        detailed_payment_methods = []
-        
-        for payment_method_id in payment_methods:
-            card_details = get_card_details(payment_method_id)
-            if card_details:
-                detailed_payment_methods.append(card_details)
+        # Cards attached before summaries were stored are fetched once and written back
+        fetched = fetch_card_summaries(missing_card_summaries(payment_setup))
+        if fetched:
+            try:
+                db_client.modify_payment_setup(email, apply_card_summaries(fetched))
+            except Exception as e:
+                logging.error(f"Error storing card summaries: {str(e)}")
+        detailed_payment_methods = ordered_card_summaries(payment_setup, fetched)
 
         return func.HttpResponse(
             json.dumps({
@@ -1,15 +1,22 @@
 import azure.functions as func
 import json
 import logging
-from shared_code.db_client import CosmosDBClient
-from shared_code.middleware import check_payment_access
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code.telemetry import track_invocation
+from shared_code.utils import get_page_params
 
+PAYMENT_LOG_FIELDS = [
+    'id', 'user_id', 'amount', 'transaction_type', 'location_id',
+    'status', 'tokens_included', 'created_at', 'updated_at'
+]
+
+@track_invocation('get-paymentlog')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+async def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         email = req_body.get('email')
         
         if not email:
@@ -22,10 +29,31 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
 
-        payment_logs = db_client.get_payment_log(email)
+        try:
+            page_size, continuation = get_page_params(req_body)
+        except ValueError:
+            return func.HttpResponse(
+                json.dumps({
+                    "error": "page_size must be a positive integer",
+                    "error_code": "invalid_page_size"
+                }),
+                mimetype="application/json",
+                status_code=400
+            )
+
+        paged = page_size is not None
+        if paged:
+            payment_logs, next_continuation = await db_client.get_payment_log_page(
+                email,
+                PAYMENT_LOG_FIELDS,
+                page_size,
+                continuation
+            )
+        else:
+            payment_logs = await db_client.get_payment_log(email, fields=PAYMENT_LOG_FIELDS)
         print("payment_log === ", payment_logs)
         
-        if not payment_logs:
+        if not payment_logs and not continuation:
             return func.HttpResponse(
                 json.dumps({
                     "error": "Payment logs not found",
@@ -35,9 +63,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=404
             )
 
-        total_amount = sum(log.get('amount', 0) for log in payment_logs)
-        total_tokens = sum(log.get('tokens_included', 0) for log in payment_logs)
-        
+        payment_logs = payment_logs or []
         processed_logs = []
         for log in payment_logs:
             processed_logs.append({
@@ -52,17 +78,27 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 "updated_at": log.get('updated_at')
             })
 
+        if paged:
+            # A page only holds part of the log, so the totals come from the database
+            summary = await db_client.get_payment_log_totals(email)
+        else:
+            summary = {
+                "total_amount": sum(log.get('amount', 0) for log in payment_logs),
+                "total_tokens": sum(log.get('tokens_included', 0) for log in payment_logs),
+                "transaction_count": len(processed_logs)
+            }
+
+        data = {
+            "summary": summary,
+            "transactions": processed_logs
+        }
+        if paged:
+            data["continuation_token"] = next_continuation
+
         return func.HttpResponse(
             json.dumps({
                 "status": "success",
-                "data": {
-                    "summary": {
-                        "total_amount": total_amount,
-                        "total_tokens": total_tokens,
-                        "transaction_count": len(processed_logs)
-                    },
-                    "transactions": processed_logs
-                }
+                "data": data
             }),
             mimetype="application/json",
             status_code=200
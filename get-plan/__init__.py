@@ -2,29 +2,20 @@
 import azure.functions as func
 import json
 import logging
-from shared_code.db_client import CosmosDBClient
-from shared_code.middleware import check_payment_access
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code.utils import get_pending_fee
+from shared_code.telemetry import track_invocation
 
+@track_invocation('get-plan')
 @check_payment_access
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+async def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
-    db_client = CosmosDBClient()
+    db_client = request_context.db_client
     
     try:
-        try:
-            req_body = req.get_json()
-            logging.info(f"Request body: {req_body}")
-        except ValueError:
-            logging.error("Invalid JSON in request body")
-            return func.HttpResponse(
-                json.dumps({
-                    "error": "Invalid request body",
-                    "error_code": "invalid_request"
-                }),
-                mimetype="application/json",
-                status_code=400
-            )
+        req_body = request_context.body
+        logging.info(f"Request body: {req_body}")
 
         email = req_body.get('email')
         logging.info(f"Processing request for email: {email}")
@@ -41,7 +32,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         try:
-            payment_setup = db_client.get_payment_setup(email)
+            payment_setup = request_context.payment_setup
             logging.info(f"Payment setup retrieved: {payment_setup}")
 
             if not payment_setup:
@@ -55,6 +46,9 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     status_code=404
                 )
 
+            locations = await db_client.get_locations(email)
+            payment_setup['pending_fee'] = get_pending_fee(payment_setup, locations)
+
             return func.HttpResponse(
                 json.dumps({
                     "status": "success",
@@ -1,52 +1,49 @@
 import azure.functions as func
 import logging
-from shared_code.db_client import CosmosDBClient
-import asyncio
-from datetime import datetime, timezone
-from shared_code import fee_update  # Import the existing fee update logic
+from shared_code.async_db_client import AsyncCosmosDBClient
+from shared_code.billing_engine import HourlyBillingEngine
+from shared_code.constants import FEE_ACCRUAL_MODE, FEE_ACCRUAL_LAZY
+from shared_code.telemetry import track_invocation
 
+@track_invocation('hourly-update-http')
 async def main(req: func.HttpRequest) -> func.HttpResponse:
     """
     HTTP trigger function for testing fee updates
     Accepts optional user_id parameter to update specific user only
     """
+    if FEE_ACCRUAL_MODE == FEE_ACCRUAL_LAZY:
+        return func.HttpResponse(
+            "Fees accrue lazily on read; there is nothing to update",
+            status_code=200
+        )
+
     try:
         logging.info('Starting fee update process via HTTP trigger')
         
-        db_client = CosmosDBClient()
+        db_client = AsyncCosmosDBClient()
+        engine = HourlyBillingEngine(db_client, name='hourly-update-http')
         
         user_id = req.params.get('user_id')
         
         if user_id:
-            payment_setup = db_client.get_payment_setup(user_id)
+            payment_setup = await db_client.get_payment_setup(user_id)
             if not payment_setup:
                 return func.HttpResponse(
                     f"Payment setup not found for user: {user_id}",
                     status_code=404
                 )
                 
-            await fee_update.update_user_pending_fee(db_client, payment_setup)
+            await engine.run(user_id=user_id)
             return func.HttpResponse(
                 f"Successfully updated fees for user: {user_id}",
                 status_code=200
             )
         
         else:
-            query = "SELECT * FROM c WHERE c.type = 'payment_setup'"
-            payment_setups = list(db_client.payment_container.query_items(
-                query=query,
-                enable_cross_partition_query=True
-            ))
-            
-            tasks = [
-                fee_update.update_user_pending_fee(db_client, payment_setup)
-                for payment_setup in payment_setups
-            ]
-            
-            await asyncio.gather(*tasks)
+            summary = await engine.run()
             
             return func.HttpResponse(
-                f"Successfully updated fees for {len(payment_setups)} users",
+                f"Successfully updated fees for {summary['users']} users",
                 status_code=200
             )
             
@@ -56,4 +53,4 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse(
             error_message,
             status_code=500
-        )
\ No newline at end of file
+        )
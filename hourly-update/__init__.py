@@ -1,31 +1,37 @@
 import azure.functions as func
 import logging
-from shared_code.db_client import CosmosDBClient
-import asyncio
-from shared_code import fee_update
+from shared_code.async_db_client import AsyncCosmosDBClient
+from shared_code.billing_service import BillingService
+from shared_code.constants import FEE_ACCRUAL_MODE, FEE_ACCRUAL_LAZY, CHANGE_FEED_LEASE_NAME
+from shared_code.dispatcher import dispatch
+from shared_code.lease import run_shards
+from shared_code.run_state import hourly_tick, ticks_to_run
+from shared_code.telemetry import track_invocation
 
+@track_invocation('hourly-update')
 async def main(mytimer: func.TimerRequest) -> None:
     """Timer trigger function that runs every hour"""
     try:
-        logging.info('Starting hourly fee update process')
-        
-        db_client = CosmosDBClient()
-        
-        query = "SELECT * FROM c WHERE c.type = 'payment_setup'"
-        payment_setups = list(db_client.payment_container.query_items(
-            query=query,
-            enable_cross_partition_query=True
-        ))
+        db_client = AsyncCosmosDBClient()
         
-        tasks = [
-            fee_update.update_user_pending_fee(db_client, payment_setup)
-            for payment_setup in payment_setups
-        ]
-        
-        await asyncio.gather(*tasks)
+        if FEE_ACCRUAL_MODE == FEE_ACCRUAL_LAZY:
+            logging.info('Starting incremental billing from the change feed')
+            
+            async def sync_changes(shard):
+                summary = await BillingService().process_changes()
+                summary['completed'] = summary.get('failed', 0) == 0
+                logging.info(f"Synced pending fees for {summary['changed_users']} changed users: {summary}")
+                return summary
+            
+            await run_shards(db_client, CHANGE_FEED_LEASE_NAME, hourly_tick(), sync_changes, shard_count=1)
+            return
+
+        logging.info('Starting hourly fee update process')
         
-        logging.info(f'Successfully updated fees for {len(payment_setups)} users')
+        for tick_id in await ticks_to_run(db_client, 'hourly-update', hourly_tick()):
+            summary = await dispatch(db_client, 'hourly-update', tick_id)
+            logging.info(f"Hourly fee update for tick {tick_id} {summary['status']}: {summary['totals']}")
         
     except Exception as e:
         logging.error(f'Error in fee update process: {str(e)}')
-        raise
\ No newline at end of file
+        raise
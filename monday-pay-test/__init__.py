@@ -1,12 +1,15 @@
 # __init__.py
 import azure.functions as func
 import logging
-from shared_code.db_client import CosmosDBClient
+from shared_code.async_db_client import AsyncCosmosDBClient
+from shared_code.patch import Patch
+from shared_code.query import Query
 import asyncio
 from datetime import datetime
 import json
+from shared_code.telemetry import track_invocation
 
-async def process_user_fee(db_client: CosmosDBClient, payment_setup):
+async def process_user_fee(db_client: AsyncCosmosDBClient, payment_setup):
     """Process pending fee deduction for a user"""
     logging.info(f"Processing payment for user: {payment_setup['user_id']}")
     
@@ -33,17 +36,15 @@ async def process_user_fee(db_client: CosmosDBClient, payment_setup):
             return result
             
         if tokens >= pending_fee:
-            new_tokens = tokens - pending_fee
-            
-            payment_setup['tokens'] = new_tokens
-            payment_setup['pending_fee'] = 0
-            payment_setup['is_blocked'] = False
-            payment_setup['updated_at'] = datetime.utcnow().isoformat()
-            
-            db_client.payment_container.replace_item(
-                item=payment_setup['id'],
-                body=payment_setup
+            updated_setup = await db_client.patch_payment_setup(
+                payment_setup['user_id'],
+                Patch()
+                .incr('tokens', -pending_fee)
+                .set('pending_fee', 0)
+                .set('is_blocked', False)
+                .where(f"c.tokens >= {pending_fee}")
             )
+            new_tokens = updated_setup['tokens']
             
             result.update({
                 "success": True,
@@ -53,13 +54,7 @@ async def process_user_fee(db_client: CosmosDBClient, payment_setup):
             logging.info(f"Successfully processed payment for user: {payment_setup['user_id']}, remaining tokens: {new_tokens}")
             return result
         else:
-            payment_setup['is_blocked'] = True
-            payment_setup['updated_at'] = datetime.utcnow().isoformat()
-            
-            db_client.payment_container.replace_item(
-                item=payment_setup['id'],
-                body=payment_setup
-            )
+            await db_client.patch_payment_setup(payment_setup['user_id'], Patch().set('is_blocked', True))
             
             result.update({
                 "success": False,
@@ -79,28 +74,23 @@ async def process_user_fee(db_client: CosmosDBClient, payment_setup):
         })
         return result
 
+@track_invocation('monday-pay-test')
 async def main(req: func.HttpRequest) -> func.HttpResponse:
     """HTTP trigger function for testing payment processing"""
     logging.info('Payment processing test triggered via HTTP')
     
     try:
-        db_client = CosmosDBClient()
+        db_client = AsyncCosmosDBClient()
         
         user_id = req.params.get('user_id')
         test_all = req.params.get('test_all', 'false').lower() == 'true'
         
         if test_all:
-            query = """
-            SELECT * FROM c 
-            WHERE c.type = 'payment_setup' 
-            AND c.pending_fee > 0
-            """
+            query = Query('payment_setup').where('pending_fee', 0, '>')
+            payment_setups = await db_client.get_payment_setups(query)
         elif user_id:
-            query = f"""
-            SELECT * FROM c 
-            WHERE c.type = 'payment_setup' 
-            AND c.user_id = '{user_id}'
-            """
+            payment_setup = await db_client.get_payment_setup(user_id)
+            payment_setups = [payment_setup] if payment_setup else []
         else:
             return func.HttpResponse(
                 json.dumps({
@@ -110,11 +100,6 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
         
-        payment_setups = list(db_client.payment_container.query_items(
-            query=query,
-            enable_cross_partition_query=True
-        ))
-        
         if not payment_setups:
             return func.HttpResponse(
                 json.dumps({
@@ -1,16 +1,18 @@
 import azure.functions as func
 import json
 import logging
-from shared_code.db_client import CosmosDBClient
-from shared_code.middleware import check_payment_access
-from datetime import datetime 
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code.patch import Patch
+import azure.cosmos.exceptions as exceptions
+from shared_code.telemetry import track_invocation
 
+@track_invocation('pay-pending')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         email = req_body.get('email')
 
         if not email:
@@ -23,7 +25,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
 
-        payment_setup = db_client.get_payment_setup(email)
+        payment_setup = request_context.payment_setup
         if not payment_setup:
             return func.HttpResponse(
                 json.dumps({
@@ -58,6 +60,26 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         try:
+            # Only settle the fee that was shown, and only while the balance covers it
+            try:
+                updated_setup = db_client.patch_payment_setup(
+                    email,
+                    Patch()
+                    .incr('tokens', -pending_fee)
+                    .set('pending_fee', 0)
+                    .set('is_blocked', False)
+                    .where(f"c.pending_fee = {pending_fee} AND c.tokens >= {pending_fee}")
+                )
+            except exceptions.CosmosAccessConditionFailedError:
+                return func.HttpResponse(
+                    json.dumps({
+                        "error": "Balance changed",
+                        "details": "Your pending fee or token balance changed, please try again"
+                    }),
+                    mimetype="application/json",
+                    status_code=409
+                )
+
             transaction = db_client.create_transaction(
                 user_id=email,
                 amount=pending_fee,
@@ -66,16 +88,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 tokens=-pending_fee
             )
 
-            new_token_balance = current_tokens - pending_fee
-            payment_setup['tokens'] = new_token_balance
-            payment_setup['pending_fee'] = 0
-            payment_setup['is_blocked'] = False
-            payment_setup['updated_at'] = datetime.utcnow().isoformat()
-            
-            db_client.payment_container.replace_item(
-                item=payment_setup['id'],
-                body=payment_setup
-            )
+            new_token_balance = updated_setup['tokens']
 
             return func.HttpResponse(
                 json.dumps({
@@ -0,0 +1,16 @@
+import azure.functions as func
+import logging
+from shared_code.async_db_client import AsyncCosmosDBClient
+from shared_code.pending_billing import reconcile_pending_billing
+from shared_code.telemetry import track_invocation
+
+@track_invocation('reconcile-pending-billing')
+async def main(mytimer: func.TimerRequest) -> None:
+    """Timer trigger function that rebuilds the pending weekly billing counters daily at 03:30 UTC"""
+    try:
+        summary = await reconcile_pending_billing(AsyncCosmosDBClient())
+        logging.info(f"Pending billing reconciliation finished: {summary}")
+        
+    except Exception as e:
+        logging.error(f"Critical error in pending billing reconciliation: {str(e)}")
+        raise
@@ -0,0 +1,19 @@
+import azure.functions as func
+import logging
+from shared_code.async_db_client import AsyncCosmosDBClient
+from shared_code.card_summaries import refresh_card_summaries
+from shared_code import clients
+from shared_code.telemetry import track_invocation
+
+clients.configure_stripe()
+
+@track_invocation('refresh-card-summaries')
+async def main(mytimer: func.TimerRequest) -> None:
+    """Timer trigger function that re-reads stored card summaries from Stripe every Sunday at 04:00 UTC"""
+    try:
+        summary = await refresh_card_summaries(AsyncCosmosDBClient())
+        logging.info(f"Card summary refresh finished: {summary}")
+        
+    except Exception as e:
+        logging.error(f"Critical error in card summary refresh: {str(e)}")
+        raise
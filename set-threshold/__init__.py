@@ -2,16 +2,17 @@
 import azure.functions as func
 import json
 import logging
-from shared_code.db_client import CosmosDBClient
 from shared_code.models import PlanType, PLAN_THRESHOLDS
-from shared_code.middleware import check_payment_access
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code.telemetry import track_invocation
 
+@track_invocation('set-threshold')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+async def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         email = req_body.get('email')
         plan_type = req_body.get('plan')
         custom_threshold = req_body.get('custom_threshold')
@@ -37,7 +38,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
 
-        payment_setup = db_client.get_payment_setup(email)
+        payment_setup = request_context.payment_setup
         if not payment_setup:
             return func.HttpResponse(
                 json.dumps({"error": "No payment setup found for this email"}),
@@ -55,28 +56,12 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
         logging.info(f"Plan type: {plan_type}, Threshold amount: {threshold_amount}")
 
-        current_num_locations = payment_setup.get('num_locations', 0)
-        current_pending_fee = payment_setup.get('pending_fee', 0)
-        current_status = payment_setup.get('status', 'active')
-        current_tokens = payment_setup.get('tokens', 0)
-        current_stripe_customer_id = payment_setup.get('stripe_customer_id')
-        current_payment_methods = payment_setup.get('payment_methods')
-        current_monthly_usage = payment_setup.get('monthly_usage')
+        def apply_plan(setup):
+            setup['plan_type'] = plan_type
+            setup['custom_threshold'] = int(custom_threshold) if plan_type == PlanType.CUSTOM.value else None
 
-        logging.info(f"Updating with num_locations: {current_num_locations}")
-
-        updated_setup = db_client.create_payment_setup(
-            email=email,
-            status=current_status,
-            tokens=current_tokens,
-            stripe_customer_id=current_stripe_customer_id,
-            plan_type=plan_type,
-            custom_threshold=int(custom_threshold) if plan_type == PlanType.CUSTOM.value else None,
-            num_locations=current_num_locations,
-            pending_fee=current_pending_fee,
-            payment_methods = current_payment_methods, 
-            monthly_usage = current_monthly_usage,
-        )
+        updated_setup = await db_client.modify_payment_setup(email, apply_plan)
+        current_num_locations = updated_setup.get('num_locations', 0)
 
         logging.info(f"Updated payment setup: {updated_setup}")
 
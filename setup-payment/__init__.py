@@ -1,11 +1,32 @@
 import azure.functions as func
 import json
+import uuid
+import hashlib
 import logging
 from shared_code.db_client import CosmosDBClient
 from shared_code.models import PaymentSetup, Location, Transaction, Plan
 import stripe
+from shared_code import clients
 from shared_code.middleware import check_payment_access
+from shared_code.telemetry import track_invocation
+from shared_code.card_summaries import card_summary
+from shared_code.stripe_gateway import get_stripe_gateway, StripeUnavailable, stripe_unavailable_response, CHARGE_DEADLINE_SECONDS
 
+clients.configure_stripe()
+
+def idempotency_key(email: str, payment_method_id: str, step: str, request_id: str = None) -> str:
+    """Stripe idempotency key of one setup step.
+
+    Stripe replays the first response to a key for 24 hours, declines
+    included, so steps that can be declined also key on the client's
+    request_id: a retry after a timeout sends the same one, a new attempt
+    after a decline a new one.
+    """
+    parts = [email, payment_method_id] + ([request_id] if request_id else [])
+    digest = hashlib.sha256(':'.join(parts).encode('utf-8')).hexdigest()
+    return f"setup-payment-{digest}-{step}"
+
+@track_invocation('setup-payment')
 async def main(req: func.HttpRequest) -> func.HttpResponse:
     db_client = CosmosDBClient()
     
@@ -15,6 +36,8 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
         location_name = req_body.get('locationName')
         location_address = req_body.get('locationAddress')
         payment_method_id = req_body.get('payment_method_id')
+        # Without one a retry cannot be told from a new attempt, so no charge is replayed
+        request_id = req_body.get('request_id') or uuid.uuid4().hex
         
         if not all([email, location_name, location_address, payment_method_id]):
             return func.HttpResponse(
@@ -27,30 +50,42 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         try:
-            customer = stripe.Customer.create(
-                email=email
+            gateway = get_stripe_gateway()
+            # A retry after a timeout gets the same customer and payment
+            # intent back from Stripe instead of creating and charging again;
+            # the customer is also reused by new attempts with the same card
+            customer = await gateway.call_async(
+                stripe.Customer.create,
+                email=email,
+                idempotency_key=idempotency_key(email, payment_method_id, 'customer')
             )
 
-            payment_method = stripe.PaymentMethod.attach(
+            payment_method = await gateway.call_async(
+                stripe.PaymentMethod.attach,
                 payment_method_id,
-                customer=customer.id
+                customer=customer.id,
+                idempotency_key=idempotency_key(email, payment_method_id, 'attach', request_id)
             )
 
-            stripe.Customer.modify(
+            await gateway.call_async(
+                stripe.Customer.modify,
                 customer.id,
                 invoice_settings={
                     'default_payment_method': payment_method.id
                 }
             )
 
-            payment_intent = stripe.PaymentIntent.create(
+            payment_intent = await gateway.call_async(
+                stripe.PaymentIntent.create,
                 amount=Plan.INITIAL_SETUP_FEE,
                 currency='usd',
                 customer=customer.id,
                 payment_method=payment_method.id,
                 off_session=True,
                 confirm=True,
-                description=f'Initial location setup for {email}'
+                description=f'Initial location setup for {email}',
+                idempotency_key=idempotency_key(email, payment_method_id, 'setup-fee', request_id),
+                deadline=CHARGE_DEADLINE_SECONDS
             )
 
             payment_setup = PaymentSetup(
@@ -61,7 +96,8 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
                 num_locations=1,
                 pending_fee=0,
                 monthly_usage=0,
-                payment_methods=[payment_method.id]
+                payment_methods=[payment_method.id],
+                card_summaries=[card_summary(payment_method)]
             )
 
             location = Location(
@@ -124,6 +160,9 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=200
             )
 
+        except StripeUnavailable as e:
+            return stripe_unavailable_response(e)
+
         except stripe.error.CardError as e:
             logging.error(f'Card error: {str(e)}')
             return func.HttpResponse(
@@ -0,0 +1,149 @@
+# shared_code/access_cache.py
+import os
+import time
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+from .constants import ACCESS_CACHE_TTL_SECONDS, ACCESS_CACHE_MAX_ENTRIES
+from .telemetry import register_metrics
+
+
+class CacheBackend(ABC):
+    """Key/value store behind AccessCache; implement this to share decisions across instances"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: float):
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+
+class LocalCacheBackend(CacheBackend):
+    """In-process LRU with per-entry expiry"""
+
+    def __init__(self, max_entries: int = ACCESS_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: float):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class AccessCache:
+    """Per-user payment access decisions, cached for a short TTL.
+
+    Writers that create or settle weekly_billing transactions call
+    invalidate(user_id), so the next request re-reads the decision. The TTL
+    bounds how stale a decision can get when the writer ran on another
+    instance and the backend is local.
+    """
+
+    def __init__(self, backend: Optional[CacheBackend] = None, ttl: Optional[float] = None):
+        self.backend = backend or LocalCacheBackend()
+        self.ttl = ttl if ttl is not None else float(os.getenv('ACCESS_CACHE_TTL_SECONDS', ACCESS_CACHE_TTL_SECONDS))
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'errors': 0}
+
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"payment_required:{user_id}"
+
+    def _lookup(self, key: str) -> Optional[bool]:
+        try:
+            cached = self.backend.get(key)
+        except Exception as e:
+            # A shared backend being down must not take the guarded endpoints with it
+            logging.error(f"Error reading access cache: {str(e)}")
+            self.stats['errors'] += 1
+            cached = None
+
+        self.stats['hits' if cached is not None else 'misses'] += 1
+        return cached
+
+    def _store(self, key: str, decision: bool):
+        try:
+            self.backend.set(key, decision, self.ttl)
+        except Exception as e:
+            logging.error(f"Error writing access cache: {str(e)}")
+            self.stats['errors'] += 1
+
+    def payment_required(self, user_id: str, load: Callable[[str], bool]) -> bool:
+        """Cached decision for user_id, calling load(user_id) on a miss"""
+        if self.ttl <= 0:
+            return load(user_id)
+
+        key = self._key(user_id)
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+
+        decision = load(user_id)
+        self._store(key, decision)
+        return decision
+
+    async def payment_required_async(self, user_id: str, load: Callable[[str], Awaitable[bool]]) -> bool:
+        """payment_required for an async load, e.g. one on the azure.cosmos.aio client"""
+        if self.ttl <= 0:
+            return await load(user_id)
+
+        key = self._key(user_id)
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+
+        decision = await load(user_id)
+        self._store(key, decision)
+        return decision
+
+    def invalidate(self, user_id: str):
+        self.stats['invalidations'] += 1
+        try:
+            self.backend.delete(self._key(user_id))
+        except Exception as e:
+            logging.error(f"Error invalidating access cache for {user_id}: {str(e)}")
+            self.stats['errors'] += 1
+
+    def get_stats(self) -> Dict:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return {**self.stats, 'hit_rate': round(self.stats['hits'] / lookups, 4) if lookups else 0}
+
+
+_access_cache = AccessCache()
+register_metrics('access_cache', _access_cache.get_stats)
+
+
+def get_access_cache() -> AccessCache:
+    return _access_cache
+
+
+def set_access_cache_backend(backend: CacheBackend):
+    """Swap in a shared backend, e.g. at startup of a function app"""
+    _access_cache.backend = backend
@@ -0,0 +1,575 @@
+# shared_code/async_db_client.py
+import azure.cosmos.exceptions as exceptions
+from azure.core import MatchConditions
+import os
+import asyncio
+import logging
+from datetime import datetime
+from typing import AsyncIterator, Callable, Optional, Dict, List, Tuple
+from .models import PaymentSetup, Transaction
+from .patch import Patch, MAX_PATCH_OPERATIONS
+from .query import Query
+from .concurrency import update_with_retry_async, if_match
+from .access_cache import get_access_cache
+from .pending_billing import (
+    PENDING_BILLING_COUNT,
+    is_pending_weekly_billing,
+    pending_billing_patch,
+    payment_required
+)
+from .constants import EVENT_TYPE_THRESHOLD_EXCEEDED, EVENT_SUBJECT_PREFIX, SYSTEM_PARTITION_KEY, QUERY_PAGE_SIZE
+from .telemetry import span, SPAN_EVENTGRID
+from . import clients
+
+class AsyncCosmosDBClient:
+    """azure.cosmos.aio counterpart of CosmosDBClient for the batch billing jobs and async HTTP handlers"""
+
+    async def payment_container(self):
+        return await clients.get_async_container('culvana-payment')
+
+    async def location_container(self):
+        return await clients.get_async_container('culvana-location')
+
+    async def transaction_container(self):
+        return await clients.get_async_container('culvana-payment-log')
+
+    async def publish_threshold_event(self, user_id: str, current_fee: float, threshold: float):
+        """Publish threshold exceeded event to Event Grid"""
+        try:
+            event = [{
+                'event_type': EVENT_TYPE_THRESHOLD_EXCEEDED,
+                'subject': f'{EVENT_SUBJECT_PREFIX}/{user_id}',
+                'data': {
+                    'userId': user_id,
+                    'currentFee': current_fee,
+                    'threshold': threshold,
+                    'timestamp': datetime.utcnow().isoformat()
+                },
+                'data_version': '1.0'
+            }]
+
+            event_grid_client = await clients.get_async_event_grid_client(
+                os.getenv('EVENTGRID_ENDPOINT'),
+                os.getenv('EVENTGRID_KEY')
+            )
+            with span(SPAN_EVENTGRID):
+                await event_grid_client.send(event)
+            logging.info(f"Published threshold event for user {user_id}")
+
+        except Exception as e:
+            logging.error(f"Error publishing threshold event: {str(e)}")
+            raise
+
+    async def _read_item(self, container, item_id: str, partition_key: str) -> Optional[Dict]:
+        """Point read an item by id and partition key (user_id), None if it does not exist"""
+        try:
+            return await container.read_item(item=item_id, partition_key=partition_key)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    async def _query(
+        self,
+        container,
+        query: str,
+        parameters: Optional[List[Dict]] = None,
+        partition_key: Optional[str] = None
+    ) -> List[Dict]:
+        return [
+            item async for item in container.query_items(
+                query=query,
+                parameters=parameters,
+                partition_key=partition_key
+            )
+        ]
+
+    async def query(self, container, query: Query, partition_key: Optional[str] = None) -> List:
+        """Run a built query, within one partition (user_id) when partition_key is given"""
+        sql, parameters = query.build()
+        return await self._query(container, sql, parameters, partition_key)
+
+    async def iter_pages(
+        self,
+        container,
+        query: Query,
+        partition_key: Optional[str] = None,
+        max_item_count: Optional[int] = None
+    ) -> AsyncIterator[List]:
+        """Yield the results page by page as they are fetched, instead of materializing them all"""
+        sql, parameters = query.build()
+        pages = container.query_items(
+            query=sql,
+            parameters=parameters,
+            partition_key=partition_key,
+            max_item_count=max_item_count or QUERY_PAGE_SIZE
+        ).by_page()
+        async for page in pages:
+            items = [item async for item in page]
+            if items:
+                yield items
+
+    async def query_page(
+        self,
+        container,
+        query: Query,
+        partition_key: str,
+        max_item_count: Optional[int] = None,
+        continuation: Optional[str] = None
+    ) -> Tuple[List, Optional[str]]:
+        """One page of a single-partition query and the token for the next page, None after the last"""
+        sql, parameters = query.build()
+        pages = container.query_items(
+            query=sql,
+            parameters=parameters,
+            partition_key=partition_key,
+            max_item_count=max_item_count or QUERY_PAGE_SIZE
+        ).by_page(continuation)
+        try:
+            items = [item async for item in await pages.__anext__()]
+        except StopAsyncIteration:
+            items = []
+        return items, pages.continuation_token
+
+    async def query_value(self, container, query: Query, partition_key: Optional[str] = None):
+        """Run a count(), exists() or sum() query and return its single value"""
+        results = await self.query(container, query, partition_key)
+        return results[0] if results else query.default
+
+    async def _patch_item(self, container, item_id: str, partition_key: str, patch: Patch) -> Dict:
+        """Apply a partial update and stamp updated_at, returning the updated item"""
+        patch.touch()
+        if len(patch) > MAX_PATCH_OPERATIONS:
+            raise ValueError(f"Patch has {len(patch)} operations, at most {MAX_PATCH_OPERATIONS} are allowed")
+        return await container.patch_item(
+            item=item_id,
+            partition_key=partition_key,
+            patch_operations=patch.operations,
+            filter_predicate=patch.filter_predicate
+        )
+
+    async def patch_payment_setup(self, email: str, patch: Patch) -> Dict:
+        """Partially update a payment setup without reading it first"""
+        try:
+            return await self._patch_item(await self.payment_container(), PaymentSetup.document_id(email), email, patch)
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
+            raise
+        except Exception as e:
+            logging.error(f"Error patching payment setup: {str(e)}")
+            raise
+
+    async def patch_location(self, location_id: str, user_id: str, patch: Patch) -> Dict:
+        """Partially update a location without reading it first"""
+        try:
+            return await self._patch_item(await self.location_container(), location_id, user_id, patch)
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
+            raise
+        except Exception as e:
+            logging.error(f"Error patching location: {str(e)}")
+            raise
+
+    async def get_payment_setup(self, email: str) -> Optional[Dict]:
+        """Get payment setup by email"""
+        try:
+            return await self._read_item(
+                await self.payment_container(),
+                PaymentSetup.document_id(email),
+                email
+            )
+        except Exception as e:
+            logging.error(f"Error getting payment setup: {str(e)}")
+            raise
+
+    async def get_system_document(self, doc_id: str) -> Optional[Dict]:
+        """Get a lease, checkpoint or run-state document"""
+        try:
+            return await self._read_item(await self.payment_container(), doc_id, SYSTEM_PARTITION_KEY)
+        except Exception as e:
+            logging.error(f"Error getting system document {doc_id}: {str(e)}")
+            raise
+
+    async def upsert_system_document(self, document: Dict) -> Dict:
+        """Create or replace a lease, checkpoint or run-state document"""
+        try:
+            document['user_id'] = SYSTEM_PARTITION_KEY
+            container = await self.payment_container()
+            return await container.upsert_item(body=document)
+        except Exception as e:
+            logging.error(f"Error saving system document {document.get('id')}: {str(e)}")
+            raise
+
+    async def create_system_document(self, document: Dict) -> Dict:
+        """Create a system document, raising CosmosResourceExistsError if the id is taken"""
+        try:
+            document['user_id'] = SYSTEM_PARTITION_KEY
+            container = await self.payment_container()
+            return await container.create_item(body=document)
+        except exceptions.CosmosResourceExistsError:
+            raise
+        except Exception as e:
+            logging.error(f"Error creating system document {document.get('id')}: {str(e)}")
+            raise
+
+    async def replace_system_document(self, document: Dict, etag: str) -> Dict:
+        """Replace a system document only if its ETag still matches, else raise CosmosAccessConditionFailedError"""
+        try:
+            document['user_id'] = SYSTEM_PARTITION_KEY
+            container = await self.payment_container()
+            return await container.replace_item(
+                item=document['id'],
+                body=document,
+                etag=etag,
+                match_condition=MatchConditions.IfNotModified
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            raise
+        except Exception as e:
+            logging.error(f"Error replacing system document {document.get('id')}: {str(e)}")
+            raise
+
+    async def delete_system_document(self, doc_id: str, etag: Optional[str] = None):
+        """Delete a system document, only if its ETag still matches when one is given"""
+        try:
+            container = await self.payment_container()
+            options = {'etag': etag, 'match_condition': MatchConditions.IfNotModified} if etag else {}
+            await container.delete_item(item=doc_id, partition_key=SYSTEM_PARTITION_KEY, **options)
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
+            raise
+        except Exception as e:
+            logging.error(f"Error deleting system document {doc_id}: {str(e)}")
+            raise
+
+    async def query_system_documents(self, query: str, parameters: Optional[List[Dict]] = None) -> List:
+        """Query the system partition (leases, checkpoints, run state)"""
+        try:
+            return await self._query(
+                await self.payment_container(),
+                query,
+                parameters,
+                partition_key=SYSTEM_PARTITION_KEY
+            )
+        except Exception as e:
+            logging.error(f"Error querying system documents: {str(e)}")
+            raise
+
+    async def get_payment_setups(self, query: Optional[Query] = None) -> List[Dict]:
+        """Get payment setups across all users, optionally filtered or projected"""
+        try:
+            return await self.query(await self.payment_container(), query or Query('payment_setup'))
+        except Exception as e:
+            logging.error(f"Error getting payment setups: {str(e)}")
+            raise
+
+    async def iter_payment_setup_pages(self, query: Optional[Query] = None, page_size: Optional[int] = None) -> AsyncIterator[List[Dict]]:
+        """Stream payment setups across all users a page at a time"""
+        async for page in self.iter_pages(await self.payment_container(), query or Query('payment_setup'), max_item_count=page_size):
+            yield page
+
+    async def iter_location_pages(self, query: Optional[Query] = None, page_size: Optional[int] = None) -> AsyncIterator[List[Dict]]:
+        """Stream locations across all users a page at a time"""
+        async for page in self.iter_pages(await self.location_container(), query or Query('location'), max_item_count=page_size):
+            yield page
+
+    async def iter_transaction_pages(self, query: Query, page_size: Optional[int] = None) -> AsyncIterator[List[Dict]]:
+        """Stream transactions across all users a page at a time"""
+        async for page in self.iter_pages(await self.transaction_container(), query, max_item_count=page_size):
+            yield page
+
+    async def get_locations_of_users(self, user_ids: List[str], fields: Optional[List[str]] = None) -> List[Dict]:
+        """Locations of several users in one query, e.g. for one page of payment setups"""
+        if not user_ids:
+            return []
+        try:
+            query = Query('location').select(*(fields or [])).where_in('user_id', user_ids)
+            return await self.query(await self.location_container(), query)
+        except Exception as e:
+            logging.error(f"Error getting locations of {len(user_ids)} users: {str(e)}")
+            raise
+
+    async def get_locations(self, email: str, fields: Optional[List[str]] = None) -> List[Dict]:
+        """Get all locations for a user, only the given fields if any"""
+        try:
+            query = Query('location').select(*(fields or [])).where('user_id', email)
+            return await self.query(await self.location_container(), query, partition_key=email)
+        except Exception as e:
+            logging.error(f"Error getting locations: {str(e)}")
+            raise
+
+    async def get_locations_page(
+        self,
+        email: str,
+        fields: Optional[List[str]] = None,
+        page_size: Optional[int] = None,
+        continuation: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """One page of a user's locations and the continuation token for the next"""
+        try:
+            query = Query('location').select(*(fields or [])).where('user_id', email)
+            return await self.query_page(await self.location_container(), query, email, page_size, continuation)
+        except Exception as e:
+            logging.error(f"Error getting locations page: {str(e)}")
+            raise
+
+    async def get_payment_log(self, email: str, fields: Optional[List[str]] = None) -> Optional[List[Dict]]:
+        """Get a user's transactions, only the given fields if any"""
+        try:
+            query = Query('transaction').select(*(fields or [])).where('user_id', email)
+            results = await self.query(await self.transaction_container(), query, partition_key=email)
+            return results if results else None
+        except Exception as e:
+            logging.error(f"Error getting payment log: {str(e)}")
+            raise
+
+    async def get_payment_log_page(
+        self,
+        email: str,
+        fields: Optional[List[str]] = None,
+        page_size: Optional[int] = None,
+        continuation: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """One page of a user's transactions and the continuation token for the next"""
+        try:
+            query = Query('transaction').select(*(fields or [])).where('user_id', email)
+            return await self.query_page(await self.transaction_container(), query, email, page_size, continuation)
+        except Exception as e:
+            logging.error(f"Error getting payment log page: {str(e)}")
+            raise
+
+    async def get_payment_log_totals(self, email: str) -> Dict:
+        """Amount, tokens and count over all of a user's transactions, the three queries run concurrently"""
+        try:
+            container = await self.transaction_container()
+            total_amount, total_tokens, transaction_count = await asyncio.gather(
+                self.query_value(container, Query('transaction').where('user_id', email).sum('amount'), email),
+                self.query_value(container, Query('transaction').where('user_id', email).sum('tokens_included'), email),
+                self.query_value(container, Query('transaction').where('user_id', email).count(), email)
+            )
+            return {
+                'total_amount': total_amount,
+                'total_tokens': total_tokens,
+                'transaction_count': transaction_count
+            }
+        except Exception as e:
+            logging.error(f"Error getting payment log totals: {str(e)}")
+            raise
+
+    def _pending_weekly_billing(self, email: str) -> Query:
+        return (
+            Query('transaction')
+            .where('user_id', email)
+            .where('transaction_type', 'weekly_billing')
+            .where('status', 'pending')
+        )
+
+    async def has_pending_weekly_billing(self, email: str, payment_setup: Optional[Dict] = None) -> bool:
+        """Whether the user has an unpaid weekly charge, from the payment setup's counters when it has them"""
+        try:
+            payment_setup = payment_setup or await self.get_payment_setup(email)
+            decision = payment_required(payment_setup) if payment_setup else None
+            if decision is not None:
+                return decision
+
+            query = self._pending_weekly_billing(email).exists()
+            return await self.query_value(await self.transaction_container(), query, partition_key=email)
+        except Exception as e:
+            logging.error(f"Error checking pending transactions: {str(e)}")
+            raise
+
+    async def get_location(self, location_id: str, user_id: Optional[str] = None) -> Optional[Dict]:
+        """Get a location by id, using a point read when the owning user is known"""
+        try:
+            container = await self.location_container()
+            if user_id:
+                location = await self._read_item(container, location_id, user_id)
+                if location and location.get('type') != 'location':
+                    return None
+                return location
+
+            query = "SELECT * FROM c WHERE c.id = @id AND c.type = 'location'"
+            parameters = [{"name": "@id", "value": location_id}]
+            results = await self._query(container, query, parameters)
+            return results[0] if results else None
+        except Exception as e:
+            logging.error(f"Error getting location: {str(e)}")
+            raise
+
+    async def get_all_locations(self) -> List[Dict]:
+        """Get every location across all users in a single query"""
+        try:
+            query = "SELECT * FROM c WHERE c.type = 'location'"
+            return await self._query(await self.location_container(), query)
+        except Exception as e:
+            logging.error(f"Error getting all locations: {str(e)}")
+            raise
+
+    async def get_active_locations(self) -> List[Dict]:
+        """Get all active locations"""
+        try:
+            query = "SELECT * FROM c WHERE c.type = 'location' AND c.is_active = true"
+            return await self._query(await self.location_container(), query)
+        except Exception as e:
+            logging.error(f"Error getting active locations: {str(e)}")
+            raise
+
+    async def modify_payment_setup(self, email: str, mutate: Callable[[Dict], Optional[Dict]]) -> Optional[Dict]:
+        """Apply mutate to the current payment setup and write it back if no one else changed it meanwhile"""
+        try:
+            return await update_with_retry_async(
+                'payment_setup',
+                lambda: self.get_payment_setup(email),
+                self.update_payment_setup,
+                mutate
+            )
+        except Exception as e:
+            logging.error(f"Error modifying payment setup: {str(e)}")
+            raise
+
+    async def modify_location(self, location_id: str, user_id: str, mutate: Callable[[Dict], Optional[Dict]]) -> Optional[Dict]:
+        """Apply mutate to the current location and write it back if no one else changed it meanwhile"""
+        try:
+            return await update_with_retry_async(
+                'location',
+                lambda: self.get_location(location_id, user_id=user_id),
+                self.update_location,
+                mutate
+            )
+        except Exception as e:
+            logging.error(f"Error modifying location: {str(e)}")
+            raise
+
+    async def get_transaction(self, transaction_id: str, user_id: str) -> Optional[Dict]:
+        """Point read a transaction, None if it does not exist"""
+        try:
+            return await self._read_item(await self.transaction_container(), transaction_id, user_id)
+        except Exception as e:
+            logging.error(f"Error getting transaction: {str(e)}")
+            raise
+
+    async def create_transaction(
+        self,
+        user_id: str,
+        amount: int,
+        transaction_type: str,
+        location_id: Optional[str] = None,
+        tokens: int = 0,
+        status: str = 'pending',
+        stripe_session_id: Optional[str] = None,
+        transaction_id: Optional[str] = None
+    ) -> Dict:
+        """Create a transaction, failing with 409 if one with transaction_id already exists"""
+        try:
+            transaction = Transaction(
+                user_id=user_id,
+                amount=amount,
+                transaction_type=transaction_type,
+                location_id=location_id,
+                tokens=tokens,
+                status=status,
+                stripe_session_id=stripe_session_id,
+                transaction_id=transaction_id
+            )
+            container = await self.transaction_container()
+            result = await container.create_item(body=transaction.to_dict())
+            if is_pending_weekly_billing(result):
+                await self._adjust_pending_billing(user_id, 1, result.get('amount', 0))
+            return result
+        except exceptions.CosmosResourceExistsError:
+            raise
+        except Exception as e:
+            logging.error(f"Error creating transaction: {str(e)}")
+            raise
+
+    async def _adjust_pending_billing(self, user_id: str, count: int, amount: float):
+        """Move the pending weekly billing counters on the user's payment setup, if it has them"""
+        get_access_cache().invalidate(user_id)
+        patch = pending_billing_patch(count, amount).where(f"IS_DEFINED(c.{PENDING_BILLING_COUNT})")
+        try:
+            await self.patch_payment_setup(user_id, patch)
+        except (exceptions.CosmosAccessConditionFailedError, exceptions.CosmosResourceNotFoundError):
+            logging.info(f"Payment setup of {user_id} has no pending billing counters yet")
+
+    async def update_transaction(self, transaction: Dict) -> Dict:
+        """Replace a transaction document, failing with 412 if it changed since it was read"""
+        container = await self.transaction_container()
+        return await container.replace_item(item=transaction['id'], body=transaction, **if_match(transaction))
+
+    async def modify_transaction(self, transaction_id: str, user_id: str, mutate: Callable[[Dict], Optional[Dict]]) -> Optional[Dict]:
+        """Apply mutate to the current transaction and write it back if no one else changed it meanwhile"""
+        try:
+            before = {}
+
+            def tracked(transaction):
+                # Re-run on every conflict retry, so this holds the version that was replaced
+                before['pending'] = is_pending_weekly_billing(transaction)
+                before['amount'] = transaction.get('amount', 0)
+                return mutate(transaction)
+
+            transaction = await update_with_retry_async(
+                'transaction',
+                lambda: self.get_transaction(transaction_id, user_id),
+                self.update_transaction,
+                tracked
+            )
+            if transaction:
+                change = int(is_pending_weekly_billing(transaction)) - int(before['pending'])
+                if change:
+                    amount = transaction.get('amount', 0) if change > 0 else before['amount']
+                    await self._adjust_pending_billing(user_id, change, change * amount)
+            return transaction
+        except Exception as e:
+            logging.error(f"Error modifying transaction: {str(e)}")
+            raise
+
+    async def update_location(self, location: Dict) -> Dict:
+        """Replace a location document, failing with 412 if it changed since it was read"""
+        try:
+            container = await self.location_container()
+            return await container.replace_item(item=location['id'], body=location, **if_match(location))
+        except exceptions.CosmosAccessConditionFailedError:
+            raise
+        except Exception as e:
+            logging.error(f"Error updating location: {str(e)}")
+            raise
+
+    async def update_payment_setup(self, payment_setup: Dict) -> Dict:
+        """Replace a payment setup document, failing with 412 if it changed since it was read"""
+        try:
+            container = await self.payment_container()
+            return await container.replace_item(item=payment_setup['id'], body=payment_setup, **if_match(payment_setup))
+        except exceptions.CosmosAccessConditionFailedError:
+            raise
+        except Exception as e:
+            logging.error(f"Error updating payment setup: {str(e)}")
+            raise
+
+    async def update_location_billing(
+        self,
+        location_id: str,
+        current_period_fee: float,
+        last_billing_update: str,
+        user_id: Optional[str] = None
+    ):
+        """Update location billing information"""
+        try:
+            if not user_id:
+                location = await self.get_location(location_id)
+                if not location:
+                    raise ValueError(f"Location {location_id} not found")
+                user_id = location['user_id']
+
+            return await self.patch_location(location_id, user_id, Patch().set_fields({
+                'current_period_fee': current_period_fee,
+                'last_billing_update': last_billing_update
+            }))
+
+        except Exception as e:
+            logging.error(f"Error updating location billing: {str(e)}")
+            raise
+
+    async def update_payment_setup_pending_fee(self, email: str, pending_fee: float):
+        """Update pending fee in payment setup"""
+        try:
+            return await self.patch_payment_setup(email, Patch().set('pending_fee', pending_fee))
+        except exceptions.CosmosResourceNotFoundError:
+            raise ValueError(f"Payment setup for {email} not found")
+        except Exception as e:
+            logging.error(f"Error updating payment setup pending fee: {str(e)}")
+            raise
@@ -0,0 +1,154 @@
+# shared_code/billing_engine.py
+import logging
+import azure.cosmos.exceptions as exceptions
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from .async_db_client import AsyncCosmosDBClient
+from .fee_update import calculate_hourly_fee
+from .scheduler import TaskScheduler
+from .run_state import RunState
+from .lease import Shard
+from .constants import MAX_RETRIES
+from .patch import Patch
+from .query import Query
+
+# Fields bill_user reads, so the scans do not load whole documents
+BILLING_SETUP_FIELDS = ['id', 'user_id', 'pending_fee', 'last_billing_tick']
+BILLING_LOCATION_FIELDS = ['id', 'user_id', 'is_active', 'monthly_fee', 'current_period_fee', 'last_billing_tick']
+
+
+class HourlyBillingEngine:
+    """Hourly fee accrual streamed over pages of payment_setups.
+
+    Payment setups are read a page at a time in user_id order, and the
+    locations of each page's users are fetched with one query, so memory
+    stays flat however many users there are and billing starts with the
+    first page. Each location and each payment_setup is written exactly
+    once per run and never re-read.
+    """
+
+    def __init__(self, db_client: Optional[AsyncCosmosDBClient] = None, name: str = 'hourly-billing'):
+        self.db_client = db_client or AsyncCosmosDBClient()
+        self.name = name
+
+    async def _locations_by_user(self, user_ids: List[str]) -> Dict[str, List[Dict]]:
+        locations_by_user = defaultdict(list)
+        for location in await self.db_client.get_locations_of_users(user_ids, fields=BILLING_LOCATION_FIELDS):
+            locations_by_user[location['user_id']].append(location)
+        return locations_by_user
+
+    async def _pages(self, user_id: Optional[str], run_state: Optional[RunState]):
+        if user_id:
+            payment_setup = await self.db_client.get_payment_setup(user_id)
+            if payment_setup:
+                yield [payment_setup]
+            return
+
+        query = Query('payment_setup').select(*BILLING_SETUP_FIELDS)
+        if run_state is None:
+            async for page in self.db_client.iter_payment_setup_pages(query):
+                yield page
+            return
+
+        # Users stamped with the tick are done, so a retry pass reads only the ones that failed
+        query.where_not('last_billing_tick', run_state.tick_id)
+        pages = self.db_client.iter_payment_setup_pages(run_state.resume_query(query), page_size=run_state.batch_size)
+        async for page in run_state.stream(pages):
+            yield page
+
+    async def bill_user(
+        self,
+        payment_setup: Dict,
+        locations: List[Dict],
+        current_time: str,
+        tick_id: Optional[str] = None
+    ) -> float:
+        """Add one hour of fees to the user's active locations and store the new pending fee.
+
+        With a tick_id, documents already stamped with that tick are skipped,
+        so re-running a partially finished tick never bills an hour twice.
+        """
+        user_id = payment_setup['user_id']
+        try:
+            if tick_id and payment_setup.get('last_billing_tick') == tick_id:
+                logging.info(f"User {user_id} already billed for tick {tick_id}")
+                return payment_setup.get('pending_fee', 0)
+
+            total_pending_fee = 0
+            for location in locations:
+                if location.get('is_active', False) and not (tick_id and location.get('last_billing_tick') == tick_id):
+                    patch = Patch().incr(
+                        'current_period_fee',
+                        calculate_hourly_fee(location.get('monthly_fee', 0))
+                    ).set_fields({
+                        'last_billing_update': current_time,
+                        'updated_at': current_time
+                    })
+                    if tick_id:
+                        patch.set('last_billing_tick', tick_id).where_not('last_billing_tick', tick_id)
+                    try:
+                        location = await self.db_client.patch_location(location['id'], user_id, patch)
+                    except exceptions.CosmosAccessConditionFailedError:
+                        location = await self.db_client.get_location(location['id'], user_id=user_id)
+                total_pending_fee += location.get('current_period_fee', 0)
+
+            patch = Patch().set_fields({'pending_fee': total_pending_fee, 'updated_at': current_time})
+            if tick_id:
+                patch.set('last_billing_tick', tick_id)
+            await self.db_client.patch_payment_setup(user_id, patch)
+
+            logging.info(f"Updated pending fee for {user_id}: {total_pending_fee}")
+            return total_pending_fee
+
+        except Exception as e:
+            logging.error(f"Error updating pending fee for {user_id}: {str(e)}")
+            raise
+
+    async def run(
+        self,
+        user_id: Optional[str] = None,
+        run_state: Optional[RunState] = None,
+        shard: Optional[Shard] = None
+    ) -> Dict:
+        """Bill every user, only user_id when given, or only the users of a shard.
+
+        With a run_state, every page is checkpointed and the run stops early
+        once the time budget is spent; call again to resume. A run that ends
+        with failed users is rewound to retry them, up to MAX_RETRIES passes,
+        and is not completed until then.
+        """
+        current_time = datetime.now(timezone.utc).isoformat()
+        tick_id = run_state.tick_id if run_state else None
+        scheduler = TaskScheduler(self.name)
+        summary = {'users': 0, 'locations': 0}
+
+        async for page in self._pages(user_id, run_state):
+            payment_setups = [
+                payment_setup for payment_setup in page
+                if shard is None or shard.contains(payment_setup['user_id'])
+            ]
+            user_ids = [payment_setup['user_id'] for payment_setup in payment_setups]
+            locations_by_user = await self._locations_by_user(user_ids)
+            summary['users'] += len(payment_setups)
+            summary['locations'] += sum(len(locations_by_user[user_id]) for user_id in user_ids)
+
+            results = await scheduler.run(
+                payment_setups,
+                lambda payment_setup: self.bill_user(
+                    payment_setup,
+                    locations_by_user[payment_setup['user_id']],
+                    current_time,
+                    tick_id
+                ),
+                return_exceptions=run_state is not None
+            )
+            if run_state is not None:
+                await run_state.record_batch(user_ids, results, cursor=page[-1]['user_id'])
+
+        summary.update(scheduler.stats)
+        # The tick stamps let another pass bill only the users that failed
+        if run_state is not None and run_state.finished and not await run_state.start_retry_pass(MAX_RETRIES):
+            await run_state.complete(summary)
+        summary['completed'] = run_state is None or run_state.completed
+        return summary
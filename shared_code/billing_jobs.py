@@ -0,0 +1,371 @@
+# shared_code/billing_jobs.py
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Optional
+import azure.cosmos.exceptions as exceptions
+from .access_cache import get_access_cache
+from .async_db_client import AsyncCosmosDBClient
+from .billing_engine import HourlyBillingEngine
+from .constants import FEE_ACCRUAL_MODE, FEE_ACCRUAL_LAZY, BILLING_LEASE_NAME, MAX_RETRIES
+from .lease import Shard
+from .patch import Patch
+from .query import Query
+from .run_state import RunState
+from .scheduler import TaskScheduler, get_retry_after
+from .utils import calculate_accrued_fee, get_pending_fee, settle_location_fee, FEE_ACCRUAL_FIELDS
+
+# Fields the monthly initialization reads, so it does not load whole documents
+MONTHLY_INIT_SETUP_FIELDS = [
+    'id', 'user_id', 'monthly_usage', 'pending_fee',
+    'previous_monthly_usage', 'last_month_total', 'last_billing_cycle_id'
+]
+MONTHLY_INIT_LOCATION_FIELDS = ['id', 'user_id', 'last_billing_cycle_id', *FEE_ACCRUAL_FIELDS]
+
+# Weekly tick of a user's last weekly charge, written in the charge's own patch
+LAST_WEEKLY_TICK = 'last_weekly_tick'
+
+async def process_user_fee(db_client: AsyncCosmosDBClient, payment_setup, locations=None, tick_id: Optional[str] = None):
+    """Process pending fee deduction for a user; with a tick_id, at most once per tick"""
+    logging.info(f"Processing payment for user: {payment_setup['user_id']}")
+    
+    result = {
+        "user_id": payment_setup['user_id'],
+        "processed_at": datetime.utcnow().isoformat(),
+        "success": False,
+        "is_blocked": False,
+        "message": ""
+    }
+    
+    try:
+        if tick_id and payment_setup.get(LAST_WEEKLY_TICK) == tick_id:
+            result.update({
+                "success": True,
+                "message": f"Already charged for {tick_id}"
+            })
+            logging.info(f"User {payment_setup['user_id']} already charged for {tick_id}")
+            return result
+
+        if locations is None:
+            locations = await db_client.get_locations(payment_setup['user_id'])
+        now = datetime.now(timezone.utc)
+        tokens = payment_setup.get('tokens', 0)
+        pending_fee = get_pending_fee(payment_setup, locations, now)
+        
+        result.update({
+            "initial_tokens": tokens,
+            "pending_fee": pending_fee
+        })
+        
+        if pending_fee == 0:
+            result.update({
+                "success": True,
+                "message": "No pending fee to process"
+            })
+            logging.info(f"No pending fee for user: {payment_setup['user_id']}")
+            return result
+            
+        if tokens >= pending_fee:
+            # The condition re-checks the balance on the server, so tokens
+            # spent since the scan can never be charged into the negative,
+            # and the tick stamp makes a rerun of the tick skip the user
+            patch = (
+                Patch()
+                .incr('tokens', -pending_fee)
+                .set('pending_fee', 0)
+                .set('is_blocked', False)
+                .where(f"c.tokens >= {pending_fee}")
+            )
+            if tick_id:
+                patch.set(LAST_WEEKLY_TICK, tick_id).where_not(LAST_WEEKLY_TICK, tick_id)
+            try:
+                updated_setup = await db_client.patch_payment_setup(payment_setup['user_id'], patch)
+            except exceptions.CosmosAccessConditionFailedError:
+                current_setup = await db_client.get_payment_setup(payment_setup['user_id'])
+                if not tick_id or (current_setup or {}).get(LAST_WEEKLY_TICK) != tick_id:
+                    raise
+                result.update({
+                    "success": True,
+                    "message": f"Already charged for {tick_id}"
+                })
+                logging.info(f"User {payment_setup['user_id']} already charged for {tick_id}")
+                return result
+            new_tokens = updated_setup['tokens']
+            get_access_cache().invalidate(payment_setup['user_id'])
+            
+            result.update({
+                "success": True,
+                "final_tokens": new_tokens,
+                "message": f"Successfully processed payment. Remaining tokens: {new_tokens}"
+            })
+            logging.info(f"Successfully processed payment for user: {payment_setup['user_id']}, remaining tokens: {new_tokens}")
+            return result
+        else:
+            await db_client.patch_payment_setup(payment_setup['user_id'], Patch().set('is_blocked', True))
+
+            deactivated_locations = []
+            
+            for location in locations:
+                if location.get('is_active', False):
+                    settle_location_fee(location, now)
+                    
+                    await db_client.patch_location(location['id'], location['user_id'], Patch().set_fields({
+                        'is_active': False,
+                        'current_period_fee': location['current_period_fee'],
+                        'last_billing_update': location['last_billing_update'],
+                        'deactivated_at': now.isoformat(),
+                        'deactivation_reason': 'insufficient_tokens'
+                    }))
+                    deactivated_locations.append(location['id'])
+            
+            get_access_cache().invalidate(payment_setup['user_id'])
+            result.update({
+                "success": False,
+                "is_blocked": True,
+                "deactivated_locations": deactivated_locations,
+                "message": f"Insufficient tokens for payment. Required: {pending_fee}, Available: {tokens}. Account blocked and locations deactivated."
+            })
+            logging.warning(f"Insufficient tokens for user: {payment_setup['user_id']}, required: {pending_fee}, available: {tokens}. Deactivated {len(deactivated_locations)} locations.")
+            return result
+            
+    except Exception as e:
+        if get_retry_after(e) is not None:
+            raise
+        error_msg = f"Error processing payment for {payment_setup['user_id']}: {str(e)}"
+        logging.error(error_msg)
+        result.update({
+            "success": False,
+            "error": str(e),
+            "message": "Internal error during payment processing"
+        })
+        return result
+
+
+async def initialize_user_billing(db_client: AsyncCosmosDBClient, payment_setup, cycle_id: str = None):
+    """Initialize billing for a user's payment setup and locations"""
+    try:
+        user_id = payment_setup['user_id']
+        logging.info(f"Processing monthly initialization for user: {user_id}")
+        
+        locations = await db_client.get_locations(user_id, fields=MONTHLY_INIT_LOCATION_FIELDS)
+        now = datetime.now(timezone.utc)
+        
+        # The payment setup is stamped with the cycle before the locations are
+        # reset, so a retried user only finishes resetting its locations
+        if cycle_id and payment_setup.get('last_billing_cycle_id') == cycle_id:
+            logging.info(f"User {user_id} already initialized for cycle {cycle_id}, resuming location reset")
+            previous_monthly_usage = payment_setup.get('previous_monthly_usage', 0)
+            total_usage = payment_setup.get('last_month_total', 0)
+            new_pending_fee = payment_setup.get('pending_fee', 0)
+        else:
+            previous_monthly_usage = payment_setup.get('monthly_usage', 0)
+            total_usage = sum(calculate_accrued_fee(location, now) for location in locations)
+            
+            patch = Patch().set_fields({
+                'previous_monthly_usage': previous_monthly_usage,
+                'last_month_total': total_usage,
+                'monthly_usage': 0,
+                'last_billing_cycle': datetime.now(timezone.utc).isoformat(),
+                'last_billing_cycle_id': cycle_id
+            }).incr('pending_fee', total_usage)
+            if cycle_id:
+                patch.where_not('last_billing_cycle_id', cycle_id)
+            
+            updated_setup = await db_client.patch_payment_setup(user_id, patch)
+            new_pending_fee = updated_setup['pending_fee']
+        
+        processed_locations = 0
+        for location in locations:
+            if cycle_id and location.get('last_billing_cycle_id') == cycle_id:
+                continue
+            if location.get('is_active', False):
+                current_fee = calculate_accrued_fee(location, now)
+                
+                await db_client.patch_location(location['id'], user_id, Patch().set_fields({
+                    'previous_period_fee': current_fee,
+                    'current_period_fee': 0,
+                    'last_billing_cycle': now.isoformat(),
+                    'last_billing_cycle_id': cycle_id,
+                    'last_billing_update': now.isoformat()
+                }))
+                processed_locations += 1
+        
+        return {
+            "user_id": user_id,
+            "previous_usage": previous_monthly_usage,
+            "last_month_total": total_usage,
+            "new_pending_fee": new_pending_fee,
+            "locations_processed": processed_locations,
+            "success": True
+        }
+        
+    except Exception as e:
+        if get_retry_after(e) is not None:
+            raise
+        error_msg = f"Error initializing billing for {payment_setup['user_id']}: {str(e)}"
+        logging.error(error_msg)
+        return {
+            "user_id": payment_setup['user_id'],
+            "success": False,
+            "error": str(e)
+        }
+
+
+async def bill_hourly_shard(db_client: AsyncCosmosDBClient, shard: Shard, tick_id: str, started: float) -> Dict:
+    """Add one hour of fees for the users of a shard"""
+    run_state = await RunState(db_client, 'hourly-update', tick_id, shard.index, started, shard.lease).load()
+    if run_state.completed:
+        logging.info(f"Tick {tick_id} shard {shard} already completed. Skipping.")
+        return {'completed': True}
+
+    summary = await HourlyBillingEngine(db_client, name='hourly-update').run(run_state=run_state, shard=shard)
+    if summary['completed']:
+        logging.info(f"Successfully updated fees for {summary['users']} users in tick {tick_id} shard {shard}: {summary}")
+    else:
+        logging.warning(f"Tick {tick_id} shard {shard} not finished; it is requeued: {summary}")
+    return summary
+
+
+async def charge_weekly_shard(db_client: AsyncCosmosDBClient, shard: Shard, tick_id: str, started: float) -> Dict:
+    """Deduct pending fees from the token balance of the users of a shard, a page at a time.
+
+    Each charge stamps the user with the tick, so a redelivered or taken-over
+    shard skips users already charged. A pass that ends with failed users
+    is requeued to retry them, up to MAX_RETRIES passes.
+    """
+    run_state = await RunState(db_client, 'monday-pay', tick_id, shard.index, started, shard.lease).load()
+    if run_state.completed:
+        logging.info(f"Weekly charge for {tick_id} shard {shard} already completed. Skipping.")
+        return {'completed': True}
+
+    lazy = FEE_ACCRUAL_MODE == FEE_ACCRUAL_LAZY
+    query = Query('payment_setup').where_not(LAST_WEEKLY_TICK, tick_id)
+    # Lazily accrued fees are only known once the locations are read
+    if not lazy:
+        query.where('pending_fee', 0, '>')
+    query = run_state.resume_query(query)
+    pages = db_client.iter_payment_setup_pages(query, page_size=run_state.batch_size)
+
+    scheduler = TaskScheduler('monday-pay')
+    summary = {'users': 0, 'successful': 0, 'blocked': 0, 'failed': 0}
+    async for page in run_state.stream(pages):
+        payment_setups = [payment_setup for payment_setup in page if shard.contains(payment_setup['user_id'])]
+
+        locations_by_user = None
+        if lazy:
+            locations_by_user = defaultdict(list)
+            for location in await db_client.get_locations_of_users(
+                [payment_setup['user_id'] for payment_setup in payment_setups]
+            ):
+                locations_by_user[location['user_id']].append(location)
+            payment_setups = [
+                payment_setup for payment_setup in payment_setups
+                if get_pending_fee(payment_setup, locations_by_user[payment_setup['user_id']]) > 0
+            ]
+
+        logging.info(f'Shard {shard}: found {len(payment_setups)} payments to process in this page')
+
+        results = await scheduler.run(
+            payment_setups,
+            lambda payment_setup: process_user_fee(
+                db_client,
+                payment_setup,
+                locations_by_user[payment_setup['user_id']] if locations_by_user is not None else None,
+                tick_id
+            )
+        )
+
+        failed = [result for result in results if not result['success'] and not result['is_blocked']]
+        for result in failed:
+            logging.error(f"Failed to process payment for {result['user_id']}: {result.get('error')}")
+
+        # Blocked users were handled; only errors are retried
+        await run_state.record_batch(
+            [result['user_id'] for result in results],
+            [result['success'] or result['is_blocked'] or Exception(result.get('error')) for result in results],
+            cursor=page[-1]['user_id']
+        )
+        summary['users'] += len(results)
+        summary['successful'] += sum(1 for r in results if r['success'])
+        summary['blocked'] += sum(1 for r in results if r['is_blocked'])
+        summary['failed'] += len(failed)
+
+    if not run_state.finished:
+        logging.warning(f"Weekly charge for {tick_id} shard {shard} not finished; it is requeued")
+        return {**summary, 'completed': False}
+
+    # Another pass only finds the failed users; the tick stamp filters out everyone already charged
+    if await run_state.start_retry_pass(MAX_RETRIES):
+        return {**summary, 'completed': False}
+
+    await run_state.complete(run_state.document['counts'])
+    return {**summary, 'completed': True}
+
+
+async def initialize_monthly_shard(db_client: AsyncCosmosDBClient, shard: Shard, tick_id: str, started: float) -> Dict:
+    """Close the previous billing cycle for the users of a shard, streaming the payment setups.
+
+    A pass that ends with failed users is requeued to retry them, up to
+    MAX_RETRIES passes.
+    """
+    run_state = await RunState(db_client, 'first-monday-init', tick_id, shard.index, started, shard.lease).load()
+    if run_state.completed:
+        logging.info(f"Monthly initialization for {tick_id} shard {shard} already completed. Skipping.")
+        return {'completed': True}
+
+    query = run_state.resume_query(Query('payment_setup').select(*MONTHLY_INIT_SETUP_FIELDS))
+    pages = db_client.iter_payment_setup_pages(query, page_size=run_state.batch_size)
+
+    scheduler = TaskScheduler('first-monday-init')
+    users = 0
+    successful = 0
+    async for page in run_state.stream(pages):
+        payment_setups = [payment_setup for payment_setup in page if shard.contains(payment_setup['user_id'])]
+        results = await scheduler.run(
+            payment_setups,
+            lambda payment_setup: initialize_user_billing(db_client, payment_setup, tick_id)
+        )
+        await run_state.record_batch(
+            [payment_setup['user_id'] for payment_setup in payment_setups],
+            results,
+            cursor=page[-1]['user_id']
+        )
+        users += len(payment_setups)
+        successful += sum(1 for r in results if r['success'])
+        for result in results:
+            if not result['success']:
+                logging.error(f"Failed to process user {result['user_id']}: {result.get('error')}")
+
+    summary = {
+        'users': users,
+        'successful': successful,
+        'completed': False
+    }
+    if not run_state.finished:
+        logging.warning(f"Monthly initialization for {tick_id} shard {shard} not finished; it is requeued")
+        return summary
+    # The cycle stamps on payment setups and locations make another pass redo only what failed
+    if await run_state.start_retry_pass(MAX_RETRIES):
+        return summary
+
+    await run_state.complete(run_state.document['counts'])
+    return {**summary, 'completed': True}
+
+
+class ShardJob:
+    """A batch job that can be run one shard at a time by any worker"""
+
+    def __init__(self, name: str, lease_name: str, handler):
+        self.name = name
+        self.lease_name = lease_name
+        self.handler = handler
+
+
+SHARD_JOBS = {
+    job.name: job for job in [
+        # Shares its lease with billing-update so a tick is never billed twice
+        ShardJob('hourly-update', BILLING_LEASE_NAME, bill_hourly_shard),
+        ShardJob('monday-pay', 'monday-pay', charge_weekly_shard),
+        ShardJob('first-monday-init', 'first-monday-init', initialize_monthly_shard)
+    ]
+}
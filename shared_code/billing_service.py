@@ -1,8 +1,14 @@
 # shared_code/billing_service.py
 from datetime import datetime, timezone
 import logging
-from .db_client import CosmosDBClient
+import azure.cosmos.exceptions as exceptions
+from .async_db_client import AsyncCosmosDBClient
 from .event_publisher import EventGridPublisher
+from .change_feed import ChangeFeedProcessor
+from .scheduler import TaskScheduler
+from .utils import calculate_pending_fee, calculate_threshold_due_at
+from .patch import Patch
+from .query import Query
 from .constants import (
     DEFAULT_MONTHLY_FEE,
     DEFAULT_THRESHOLD,
@@ -12,7 +18,7 @@ from .constants import (
 
 class BillingService:
     def __init__(self):
-        self.db_client = CosmosDBClient()
+        self.db_client = AsyncCosmosDBClient()
         self.event_publisher = EventGridPublisher()
     
     def calculate_hourly_rate(self, monthly_fee: int = DEFAULT_MONTHLY_FEE) -> float:
@@ -28,19 +34,25 @@ class BillingService:
             logging.error(f"Error calculating hours: {str(e)}")
             return 1.0
     
-    async def process_location_billing(self, location: dict, current_time: str) -> float:
+    async def process_location_billing(self, location: dict, current_time: str, tick_id: str = None) -> float:
         try:
+            if tick_id and location.get('last_billing_tick') == tick_id:
+                return 0
+            
             hours_used = self.calculate_hours_since_update(
                 location.get('last_billing_update', location['created_at'])
             )
             hourly_rate = self.calculate_hourly_rate(location.get('monthly_fee', DEFAULT_MONTHLY_FEE))
             period_fee = hourly_rate * hours_used
             
-            location['current_period_fee'] = location.get('current_period_fee', 0) + period_fee
-            location['last_billing_update'] = current_time
-            location['updated_at'] = datetime.utcnow().isoformat()
-            
-            self.db_client.update_location(location)
+            patch = Patch().incr('current_period_fee', period_fee).set('last_billing_update', current_time)
+            if tick_id:
+                patch.set('last_billing_tick', tick_id).where_not('last_billing_tick', tick_id)
+            try:
+                await self.db_client.patch_location(location['id'], location['user_id'], patch)
+            except exceptions.CosmosAccessConditionFailedError:
+                logging.info(f"Location {location['id']} already billed for tick {tick_id}")
+                return 0
             logging.info(f"Updated billing for location {location['id']}: {period_fee:.2f}")
             
             return period_fee
@@ -49,32 +61,119 @@ class BillingService:
             logging.error(f"Error processing location billing: {str(e)}")
             raise
     
-    async def process_user_billing(self, user_id: str, new_fee: float):
+    async def process_user_billing(self, user_id: str, new_fee: float, tick_id: str = None):
         try:
-            payment_setup = self.db_client.get_payment_setup(user_id)
-            if not payment_setup:
+            patch = Patch().incr('pending_fee', new_fee)
+            if tick_id:
+                patch.set('last_billing_tick', tick_id).where_not('last_billing_tick', tick_id)
+            try:
+                payment_setup = await self.db_client.patch_payment_setup(user_id, patch)
+            except exceptions.CosmosResourceNotFoundError:
                 logging.warning(f"No payment setup found for user {user_id}")
                 return
+            except exceptions.CosmosAccessConditionFailedError:
+                logging.info(f"User {user_id} already billed for tick {tick_id}")
+                return
             
-            current_fee = payment_setup.get('pending_fee', 0)
-            total_fee = current_fee + new_fee
-            threshold = payment_setup.get('custom_threshold', DEFAULT_THRESHOLD)
-            
-            payment_setup['pending_fee'] = total_fee
-            payment_setup['updated_at'] = datetime.utcnow().isoformat()
-            self.db_client.update_payment_setup(payment_setup)
-            
-            if total_fee > threshold:
-                event_published = await self.event_publisher.publish_threshold_event(
-                    user_id=user_id,
-                    current_fee=total_fee,
-                    threshold=threshold
-                )
-                if event_published:
-                    logging.info(f"Threshold event published for user {user_id}")
-                else:
-                    logging.warning(f"Failed to publish threshold event for user {user_id}")
+            await self.notify_threshold(payment_setup, payment_setup['pending_fee'])
                     
         except Exception as e:
             logging.error(f"Error processing user billing: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+
+    async def notify_threshold(self, payment_setup: dict, total_fee: float):
+        user_id = payment_setup['user_id']
+        threshold = payment_setup.get('custom_threshold') or DEFAULT_THRESHOLD
+        if total_fee > threshold:
+            event_published = await self.event_publisher.publish_threshold_event(
+                user_id=user_id,
+                current_fee=total_fee,
+                threshold=threshold
+            )
+            if event_published:
+                logging.info(f"Threshold event published for user {user_id}")
+            else:
+                logging.warning(f"Failed to publish threshold event for user {user_id}")
+
+    async def sync_user_pending_fee(self, user_id: str, as_of: datetime) -> float:
+        """Store the lazily accrued pending fee of one user and when it will cross their threshold"""
+        try:
+            payment_setup = await self.db_client.get_payment_setup(user_id)
+            if payment_setup is None:
+                logging.warning(f"No payment setup found for user {user_id}")
+                return 0
+            locations = await self.db_client.get_locations(user_id)
+            pending_fee = calculate_pending_fee(locations, as_of)
+            threshold = payment_setup.get('custom_threshold') or DEFAULT_THRESHOLD
+            
+            # Matching timestamps let the next change feed read skip this write
+            try:
+                payment_setup = await self.db_client.patch_payment_setup(user_id, Patch().set_fields({
+                    'pending_fee': pending_fee,
+                    'threshold_due_at': calculate_threshold_due_at(locations, threshold, as_of),
+                    'updated_at': as_of.isoformat(),
+                    'pending_fee_synced_at': as_of.isoformat()
+                }))
+            except exceptions.CosmosResourceNotFoundError:
+                logging.warning(f"No payment setup found for user {user_id}")
+                return 0
+            
+            await self.notify_threshold(payment_setup, pending_fee)
+            return pending_fee
+            
+        except Exception as e:
+            logging.error(f"Error syncing pending fee for {user_id}: {str(e)}")
+            raise
+
+    async def get_threshold_due_users(self, as_of: datetime) -> list:
+        """Users whose lazily accrued fee crosses their threshold by as_of.
+
+        Accrual alone writes nothing, so the change feed never surfaces a
+        user whose fee crosses the threshold by the hour passing. Each sync
+        stores when that will happen as threshold_due_at; users synced
+        before it existed have none and are picked up once.
+        """
+        query = Query('payment_setup').select('user_id').where_undefined_or('threshold_due_at', as_of.isoformat(), '<=')
+        user_ids = []
+        async for page in self.db_client.iter_payment_setup_pages(query):
+            user_ids.extend(payment_setup['user_id'] for payment_setup in page)
+        return user_ids
+
+    async def process_changes(self) -> dict:
+        """Recompute pending fees only for users whose documents changed or whose fee crosses their threshold.
+
+        Unchanged locations need no work because their fees accrue lazily.
+        """
+        now = datetime.now(timezone.utc)
+        location_feed = ChangeFeedProcessor(self.db_client, 'culvana-location')
+        payment_feed = ChangeFeedProcessor(self.db_client, 'culvana-payment')
+        
+        changed_users = {
+            location['user_id'] for location in await location_feed.read_changes()
+            if location.get('type') == 'location'
+        }
+        for document in await payment_feed.read_changes():
+            if (document.get('type') == 'payment_setup'
+                    and document.get('pending_fee_synced_at') != document.get('updated_at')):
+                changed_users.add(document['user_id'])
+        due_users = set(await self.get_threshold_due_users(now)) - changed_users
+        users = sorted(changed_users | due_users)
+        
+        scheduler = TaskScheduler('billing-change-feed')
+        results = await scheduler.run(
+            users,
+            lambda user_id: self.sync_user_pending_fee(user_id, now),
+            return_exceptions=True
+        )
+        
+        failed = {user_id for user_id, result in zip(users, results) if isinstance(result, Exception)}
+        if failed & changed_users:
+            logging.error(f"{len(failed & changed_users)} users failed; change feed checkpoint not advanced")
+        else:
+            await location_feed.checkpoint()
+            await payment_feed.checkpoint()
+        if failed & due_users:
+            # Their threshold_due_at is unchanged, so the next tick retries them
+            logging.error(f"{len(failed & due_users)} users due for a threshold check failed")
+        
+        return {'changed_users': len(changed_users), 'threshold_due_users': len(due_users), **scheduler.stats}
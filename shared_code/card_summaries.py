@@ -0,0 +1,104 @@
+# shared_code/card_summaries.py
+import logging
+from typing import Dict, List, Optional
+import stripe
+import azure.cosmos.exceptions as exceptions
+from .query import Query
+from .stripe_gateway import get_stripe_gateway, is_outage
+
+# Denormalized on payment_setup: display details of each attached card,
+# written when the card is attached, so get-payinfo needs no Stripe call
+CARD_SUMMARIES = 'card_summaries'
+
+
+def card_summary(payment_method) -> Dict:
+    """Compact summary of a Stripe card PaymentMethod"""
+    return {
+        'id': payment_method.id,
+        'brand': payment_method.card.brand,
+        'last4': payment_method.card.last4,
+        'exp_month': payment_method.card.exp_month,
+        'exp_year': payment_method.card.exp_year
+    }
+
+
+def retrieve_card_summary(payment_method_id: str) -> Optional[Dict]:
+    """Summary fetched from Stripe, None if Stripe rejects the lookup; outages raise so the gateway's breaker sees them"""
+    try:
+        return card_summary(stripe.PaymentMethod.retrieve(payment_method_id))
+    except stripe.error.StripeError as e:
+        logging.error(f"Error retrieving card details: {str(e)}")
+        if is_outage(e):
+            raise
+        return None
+
+
+def fetch_card_summaries(payment_method_ids: List[str]) -> Dict[str, Dict]:
+    """Summaries of the given cards fetched from Stripe concurrently; cards that failed or timed out are left out"""
+    fetched, _ = get_stripe_gateway().map(retrieve_card_summary, payment_method_ids)
+    return {payment_method_id: card for payment_method_id, card in fetched.items() if card}
+
+
+async def fetch_card_summaries_async(payment_method_ids: List[str]) -> Dict[str, Dict]:
+    fetched, _ = await get_stripe_gateway().map_async(retrieve_card_summary, payment_method_ids)
+    return {payment_method_id: card for payment_method_id, card in fetched.items() if card}
+
+
+def summaries_by_id(payment_setup: Dict) -> Dict[str, Dict]:
+    return {summary['id']: summary for summary in payment_setup.get(CARD_SUMMARIES) or []}
+
+
+def missing_card_summaries(payment_setup: Dict) -> List[str]:
+    """Ids of attached cards without a stored summary, e.g. attached before summaries existed"""
+    stored = summaries_by_id(payment_setup)
+    return [payment_method_id for payment_method_id in payment_setup.get('payment_methods', []) if payment_method_id not in stored]
+
+
+def ordered_card_summaries(payment_setup: Dict, fetched: Optional[Dict[str, Dict]] = None) -> List[Dict]:
+    """Summaries of the attached cards in payment_methods order; fetched ones win over stored ones"""
+    summaries = {**summaries_by_id(payment_setup), **(fetched or {})}
+    return [
+        summaries[payment_method_id]
+        for payment_method_id in payment_setup.get('payment_methods', [])
+        if payment_method_id in summaries
+    ]
+
+
+def apply_card_summaries(fetched: Dict[str, Dict]):
+    """Mutation for modify_payment_setup that stores fetched summaries of still attached cards"""
+    def mutate(payment_setup):
+        payment_setup[CARD_SUMMARIES] = ordered_card_summaries(payment_setup, fetched)
+    return mutate
+
+
+async def refresh_card_summaries(db_client) -> Dict:
+    """Re-read every attached card from Stripe and store the summaries that changed.
+
+    Catches expiry dates updated by the card networks and fills in cards
+    attached before summaries were stored. Each user's cards are fetched
+    concurrently on the Stripe gateway's pool, off the event loop.
+    """
+    summary = {'users': 0, 'cards': 0, 'updated': 0, 'failed': 0}
+    query = Query('payment_setup').select('id', 'user_id', 'payment_methods', CARD_SUMMARIES)
+    async for page in db_client.iter_payment_setup_pages(query):
+        for payment_setup in page:
+            payment_method_ids = payment_setup.get('payment_methods') or []
+            if not payment_method_ids:
+                continue
+            summary['users'] += 1
+            summary['cards'] += len(payment_method_ids)
+
+            fetched = await fetch_card_summaries_async(payment_method_ids)
+            if ordered_card_summaries(payment_setup, fetched) == payment_setup.get(CARD_SUMMARIES):
+                continue
+
+            try:
+                await db_client.modify_payment_setup(payment_setup['user_id'], apply_card_summaries(fetched))
+                summary['updated'] += 1
+            except exceptions.CosmosResourceNotFoundError:
+                continue
+            except Exception as e:
+                logging.error(f"Error refreshing card summaries of {payment_setup['user_id']}: {str(e)}")
+                summary['failed'] += 1
+
+    return summary
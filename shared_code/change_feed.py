@@ -0,0 +1,74 @@
+# shared_code/change_feed.py
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from .async_db_client import AsyncCosmosDBClient
+from . import clients
+
+# azure-cosmos 4.5.1, pinned in requirements.txt, can only read the change
+# feed of one partition key range at a time and has no public way to list
+# the ranges (read_feed_ranges and feed_range arrived in later releases).
+# The ranges are read through the client connection's private
+# _ReadPartitionKeyRanges; tests/test_change_feed.py runs it through the
+# real SDK, so an upgrade that drops it fails there. Moving to the public
+# feed-range API also changes the continuation tokens kept in the lease.
+PARTITION_KEY_RANGES_METHOD = '_ReadPartitionKeyRanges'
+
+
+def read_partition_key_range_ids(container):
+    """Ids of the container's partition key ranges, through the pinned SDK's private API"""
+    read_ranges = getattr(container.client_connection, PARTITION_KEY_RANGES_METHOD, None)
+    if read_ranges is None:
+        raise RuntimeError(
+            f"azure-cosmos no longer provides {PARTITION_KEY_RANGES_METHOD}; "
+            f"move ChangeFeedProcessor to the public feed-range API"
+        )
+    return read_ranges(container.container_link)
+
+
+class ChangeFeedProcessor:
+    """Reads a container's change feed from the checkpoint kept in a lease document.
+
+    The lease stores one continuation token (etag) per partition key range.
+    Ranges without a token, including the children of a split, are read
+    from the beginning, so consumers must be idempotent.
+    """
+
+    def __init__(self, db_client: AsyncCosmosDBClient, container_name: str, lease_name: Optional[str] = None):
+        self.db_client = db_client
+        self.container_name = container_name
+        self.lease_id = f"changefeed_{lease_name or container_name}"
+        self._lease = None
+        self._continuations = {}
+
+    async def _partition_key_ranges(self, container) -> List[str]:
+        return [partition_range['id'] async for partition_range in read_partition_key_range_ids(container)]
+
+    async def read_changes(self) -> List[Dict]:
+        """Return every document created or replaced since the last checkpoint"""
+        container = await clients.get_async_container(self.container_name)
+        self._lease = await self.db_client.get_system_document(self.lease_id) or {
+            'id': self.lease_id,
+            'type': 'lease',
+            'continuations': {}
+        }
+        self._continuations = dict(self._lease.get('continuations', {}))
+
+        changes = []
+        for range_id in await self._partition_key_ranges(container):
+            token = self._continuations.get(range_id)
+            options = {'continuation': token} if token else {'is_start_from_beginning': True}
+            pages = container.query_items_change_feed(partition_key_range_id=range_id, **options).by_page()
+            async for page in pages:
+                changes.extend([item async for item in page])
+                if pages.continuation_token:
+                    self._continuations[range_id] = pages.continuation_token
+
+        logging.info(f"Read {len(changes)} changes from {self.container_name}")
+        return changes
+
+    async def checkpoint(self):
+        """Persist the continuation tokens reached by the last read_changes call"""
+        self._lease['continuations'] = self._continuations
+        self._lease['updated_at'] = datetime.now(timezone.utc).isoformat()
+        self._lease = await self.db_client.upsert_system_document(self._lease)
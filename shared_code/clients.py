@@ -0,0 +1,210 @@
+# shared_code/clients.py
+import os
+import asyncio
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import stripe
+import azure.cosmos.cosmos_client as cosmos_client
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.eventgrid import EventGridPublisherClient
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+from azure.eventgrid.aio import EventGridPublisherClient as AsyncEventGridPublisherClient
+from azure.storage.queue import TextBase64EncodePolicy
+from azure.storage.queue.aio import QueueClient as AsyncQueueClient
+from .telemetry import InstrumentedContainer, AsyncInstrumentedContainer, span, register_metrics, SPAN_STRIPE
+
+DATABASE_NAME = 'culvana'
+POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', '10'))
+POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '50'))
+STRIPE_TIMEOUT = int(os.getenv('STRIPE_TIMEOUT_SECONDS', '30'))
+
+_lock = threading.RLock()
+_sessions = {}
+_clients = {}
+_stats = {}
+_async_locks = {}
+
+
+def _record(name: str, created: bool):
+    entry = _stats.setdefault(name, {'created': 0, 'reused': 0})
+    entry['created' if created else 'reused'] += 1
+
+
+def _get_or_create(name: str, factory):
+    """Return the process-wide instance registered under name, creating it once"""
+    client = _clients.get(name)
+    if client is not None:
+        _record(name, created=False)
+        return client
+
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            logging.info(f"Creating shared client: {name}")
+            client = factory()
+            _clients[name] = client
+            _record(name, created=True)
+        else:
+            _record(name, created=False)
+        return client
+
+
+async def _get_or_create_async(name: str, factory):
+    """Async counterpart of _get_or_create; aio clients are bound to the running event loop"""
+    key = f'{name}@{id(asyncio.get_running_loop())}'
+    client = _clients.get(key)
+    if client is not None:
+        _record(name, created=False)
+        return client
+
+    with _lock:
+        lock = _async_locks.setdefault(key, asyncio.Lock())
+
+    async with lock:
+        client = _clients.get(key)
+        if client is None:
+            logging.info(f"Creating shared async client: {name}")
+            client = await factory()
+            _clients[key] = client
+            _record(name, created=True)
+        else:
+            _record(name, created=False)
+        return client
+
+
+def get_http_session(name: str) -> requests.Session:
+    """Keep-alive requests session with a connection pool, one per upstream service"""
+    def factory():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _sessions[name] = session
+        return session
+
+    return _get_or_create(f'session:{name}', factory)
+
+
+def get_cosmos_client() -> cosmos_client.CosmosClient:
+    return _get_or_create('cosmos', lambda: cosmos_client.CosmosClient.from_connection_string(
+        os.getenv('COSMOS_CONNECTION_STRING'),
+        transport=RequestsTransport(session=get_http_session('cosmos'), session_owner=False)
+    ))
+
+
+def get_database():
+    return _get_or_create('cosmos:database', lambda: get_cosmos_client().get_database_client(DATABASE_NAME))
+
+
+def get_container(container_name: str):
+    return _get_or_create(
+        f'cosmos:container:{container_name}',
+        lambda: InstrumentedContainer(get_database().get_container_client(container_name))
+    )
+
+
+def get_event_grid_client(endpoint: str, key: str) -> EventGridPublisherClient:
+    return _get_or_create(f'eventgrid:{endpoint}', lambda: EventGridPublisherClient(
+        endpoint=endpoint,
+        credential=AzureKeyCredential(key),
+        transport=RequestsTransport(session=get_http_session('eventgrid'), session_owner=False)
+    ))
+
+
+async def get_async_cosmos_client() -> AsyncCosmosClient:
+    async def factory():
+        client = AsyncCosmosClient.from_connection_string(os.getenv('COSMOS_CONNECTION_STRING'))
+        await client.__aenter__()
+        return client
+
+    return await _get_or_create_async('aio:cosmos', factory)
+
+
+async def get_async_container(container_name: str):
+    async def factory():
+        client = await get_async_cosmos_client()
+        return AsyncInstrumentedContainer(
+            client.get_database_client(DATABASE_NAME).get_container_client(container_name)
+        )
+
+    return await _get_or_create_async(f'aio:cosmos:container:{container_name}', factory)
+
+
+async def get_async_event_grid_client(endpoint: str, key: str) -> AsyncEventGridPublisherClient:
+    async def factory():
+        return AsyncEventGridPublisherClient(endpoint=endpoint, credential=AzureKeyCredential(key))
+
+    return await _get_or_create_async(f'aio:eventgrid:{endpoint}', factory)
+
+
+async def get_async_queue_client(queue_name: str) -> AsyncQueueClient:
+    async def factory():
+        # Base64 is what the Functions queue trigger expects
+        return AsyncQueueClient.from_connection_string(
+            os.getenv('AzureWebJobsStorage'),
+            queue_name,
+            message_encode_policy=TextBase64EncodePolicy()
+        )
+
+    return await _get_or_create_async(f'aio:queue:{queue_name}', factory)
+
+
+class TimedRequestsClient(stripe.http_client.RequestsClient):
+    """Stripe HTTP client that records each API request as a stripe span"""
+
+    def request(self, method, url, headers, post_data=None):
+        with span(SPAN_STRIPE):
+            return super().request(method, url, headers, post_data)
+
+    def request_stream(self, method, url, headers, post_data=None):
+        with span(SPAN_STRIPE):
+            return super().request_stream(method, url, headers, post_data)
+
+
+def configure_stripe():
+    """Point the stripe module at the shared keep-alive session; safe to call on every import.
+
+    STRIPE_API_BASE sends every Stripe request to another host, e.g. the
+    local stand-in in tools/stripe_stub.py for offline load tests.
+    """
+    def factory():
+        stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+        api_base = os.getenv('STRIPE_API_BASE')
+        if api_base:
+            logging.warning(f"Stripe requests go to {api_base} instead of the Stripe API")
+            stripe.api_base = api_base
+        stripe.default_http_client = TimedRequestsClient(
+            timeout=STRIPE_TIMEOUT,
+            session=get_http_session('stripe')
+        )
+        return stripe.default_http_client
+
+    _get_or_create('stripe', factory)
+    return stripe
+
+
+def get_pool_stats() -> dict:
+    """Creation/reuse counts per client and connection counts per HTTP pool"""
+    with _lock:
+        pools = {}
+        for name, session in _sessions.items():
+            adapter = session.get_adapter('https://')
+            host_pools = [
+                adapter.poolmanager.pools[key]
+                for key in adapter.poolmanager.pools.keys()
+            ]
+            pools[name] = {
+                'hosts': len(host_pools),
+                'connections_opened': sum(pool.num_connections for pool in host_pools),
+                'requests_sent': sum(pool.num_requests for pool in host_pools)
+            }
+        return {
+            'clients': {name: dict(counts) for name, counts in _stats.items()},
+            'pools': pools
+        }
+
+
+register_metrics('clients', get_pool_stats)
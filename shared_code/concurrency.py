@@ -0,0 +1,114 @@
+# shared_code/concurrency.py
+import time
+import random
+import asyncio
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+import azure.cosmos.exceptions as exceptions
+from azure.core import MatchConditions
+from .constants import CONFLICT_MAX_ATTEMPTS, CONFLICT_RETRY_JITTER_SECONDS
+from .telemetry import register_metrics
+
+_lock = threading.Lock()
+_stats = {}
+
+
+class ConflictError(Exception):
+    """An optimistic write kept losing to concurrent writers until the attempts ran out"""
+
+
+def _record(name: str, outcome: str):
+    with _lock:
+        entry = _stats.setdefault(name, {'writes': 0, 'conflicts': 0, 'exhausted': 0})
+        entry[outcome] += 1
+
+
+def get_conflict_stats() -> Dict[str, Dict]:
+    """Writes, 412 conflicts and exhausted retries per document kind, with the conflict rate"""
+    with _lock:
+        return {
+            name: {
+                **counts,
+                'conflict_rate': round(counts['conflicts'] / (counts['writes'] + counts['conflicts']), 4)
+                if counts['writes'] + counts['conflicts'] else 0
+            }
+            for name, counts in _stats.items()
+        }
+
+
+register_metrics('write_conflicts', get_conflict_stats)
+
+
+def if_match(item: Dict) -> Dict:
+    """replace_item keyword arguments that make the write fail with 412 if the item changed since it was read"""
+    return {'etag': item['_etag'], 'match_condition': MatchConditions.IfNotModified}
+
+
+def _backoff(attempt: int) -> float:
+    # The first retry is immediate; later ones spread out racing writers
+    return random.uniform(0, CONFLICT_RETRY_JITTER_SECONDS) * attempt
+
+
+def _prepare(item: Dict, mutate: Callable[[Dict], Optional[Dict]]) -> Dict:
+    item = mutate(item) or item
+    item['updated_at'] = datetime.now(timezone.utc).isoformat()
+    return item
+
+
+def update_with_retry(
+    name: str,
+    read: Callable[[], Optional[Dict]],
+    replace: Callable[[Dict], Dict],
+    mutate: Callable[[Dict], Optional[Dict]],
+    max_attempts: int = CONFLICT_MAX_ATTEMPTS
+) -> Optional[Dict]:
+    """Read, mutate and conditionally replace a document, re-reading and re-applying mutate on 412.
+
+    replace must send the item's ETag with an if-match condition. mutate
+    edits the item in place and may raise to abort the update. Returns None
+    if the document does not exist.
+    """
+    for attempt in range(max_attempts):
+        item = read()
+        if item is None:
+            return None
+        try:
+            result = replace(_prepare(item, mutate))
+        except exceptions.CosmosAccessConditionFailedError:
+            _record(name, 'conflicts')
+            logging.info(f"Conflict writing {name} {item.get('id')}, attempt {attempt + 1}/{max_attempts}")
+            time.sleep(_backoff(attempt))
+            continue
+        _record(name, 'writes')
+        return result
+
+    _record(name, 'exhausted')
+    raise ConflictError(f"Gave up writing {name} after {max_attempts} conflicting attempts")
+
+
+async def update_with_retry_async(
+    name: str,
+    read,
+    replace,
+    mutate: Callable[[Dict], Optional[Dict]],
+    max_attempts: int = CONFLICT_MAX_ATTEMPTS
+) -> Optional[Dict]:
+    """Async counterpart of update_with_retry; read and replace are coroutine functions"""
+    for attempt in range(max_attempts):
+        item = await read()
+        if item is None:
+            return None
+        try:
+            result = await replace(_prepare(item, mutate))
+        except exceptions.CosmosAccessConditionFailedError:
+            _record(name, 'conflicts')
+            logging.info(f"Conflict writing {name} {item.get('id')}, attempt {attempt + 1}/{max_attempts}")
+            await asyncio.sleep(_backoff(attempt))
+            continue
+        _record(name, 'writes')
+        return result
+
+    _record(name, 'exhausted')
+    raise ConflictError(f"Gave up writing {name} after {max_attempts} conflicting attempts")
@@ -1,3 +1,4 @@
+import os
 from datetime import timedelta
 
 DEFAULT_MONTHLY_FEE = 45
@@ -5,10 +6,71 @@ DEFAULT_THRESHOLD = 100
 HOURS_IN_DAY = 24
 DAYS_IN_MONTH = 30
 
+FEE_ACCRUAL_LAZY = 'lazy'
+FEE_ACCRUAL_EAGER = 'eager'
+FEE_ACCRUAL_MODE = os.getenv('FEE_ACCRUAL_MODE', FEE_ACCRUAL_LAZY)
+
 EVENT_TYPE_THRESHOLD_EXCEEDED = 'BillingThresholdExceeded'
 EVENT_TYPE_BILLING_UPDATE = 'BillingUpdate'
 
 EVENT_SUBJECT_PREFIX = '/billing/users'
 
+# Partition of culvana-payment holding leases, checkpoints and run state
+SYSTEM_PARTITION_KEY = '__system__'
+
 MAX_RETRIES = 3
-RETRY_DELAY = timedelta(seconds=2)
\ No newline at end of file
+RETRY_DELAY = timedelta(seconds=2)
+
+# ETag-conditioned writes re-read and re-apply on 412 this many times
+CONFLICT_MAX_ATTEMPTS = 5
+CONFLICT_RETRY_JITTER_SECONDS = 0.05
+
+BATCH_MAX_CONCURRENCY = 32
+BATCH_MIN_CONCURRENCY = 2
+
+RUN_CHECKPOINT_BATCH_SIZE = 100
+RUN_TIME_BUDGET_SECONDS = 240
+RUN_STATE_TTL_SECONDS = 7 * 24 * 3600
+# Timer jobs split users into shards and claim each (tick, shard) with a lease
+BILLING_SHARD_COUNT = 4
+BILLING_LEASE_NAME = 'hourly-billing'
+CHANGE_FEED_LEASE_NAME = 'billing-change-feed'
+LEASE_DURATION_SECONDS = 600
+LEASE_RETENTION_SECONDS = 2 * 24 * 3600
+
+# check_payment_access caches each user's decision; writers invalidate it
+ACCESS_CACHE_TTL_SECONDS = 60
+ACCESS_CACHE_MAX_ENTRIES = 10000
+
+# Stripe requests made through the gateway run on a bounded thread pool;
+# a call still running after its deadline is reported as timed out
+STRIPE_MAX_WORKERS = int(os.getenv('STRIPE_MAX_WORKERS', '8'))
+STRIPE_CALL_DEADLINE_SECONDS = float(os.getenv('STRIPE_CALL_DEADLINE_SECONDS', '10'))
+
+# Fail fast with stripe_unavailable instead of queueing behind an unhealthy
+# Stripe: at most STRIPE_MAX_IN_FLIGHT calls per worker, and the breaker
+# opens after STRIPE_BREAKER_FAILURE_THRESHOLD outage failures in a row,
+# probing again after STRIPE_BREAKER_RESET_SECONDS
+STRIPE_MAX_IN_FLIGHT = int(os.getenv('STRIPE_MAX_IN_FLIGHT', '16'))
+STRIPE_BREAKER_FAILURE_THRESHOLD = int(os.getenv('STRIPE_BREAKER_FAILURE_THRESHOLD', '5'))
+STRIPE_BREAKER_RESET_SECONDS = float(os.getenv('STRIPE_BREAKER_RESET_SECONDS', '30'))
+
+# sync: add-credits confirms the PaymentIntent and credits tokens in the
+# request. webhook: it only creates the intent for the client to confirm,
+# and stripe-webhook credits the tokens on payment_intent.succeeded
+CREDIT_SETTLEMENT_SYNC = 'sync'
+CREDIT_SETTLEMENT_WEBHOOK = 'webhook'
+CREDIT_SETTLEMENT_MODE = os.getenv('CREDIT_SETTLEMENT_MODE', CREDIT_SETTLEMENT_SYNC)
+
+# Per-request span timings: Server-Timing header on guarded endpoints and
+# a timings section in the invocation summary log line
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'true').lower() == 'true'
+
+# Items per query page; HTTP callers may ask for smaller pages, never larger
+QUERY_PAGE_SIZE = int(os.getenv('QUERY_PAGE_SIZE', '100'))
+
+# Sharded batch jobs are fanned out to queue-triggered workers
+WORK_QUEUE_STORAGE = 'storage'
+WORK_QUEUE_LOCAL = 'local'
+WORK_QUEUE_BACKEND = os.getenv('WORK_QUEUE_BACKEND', WORK_QUEUE_STORAGE)
+SHARD_QUEUE_NAME = 'billing-shards'
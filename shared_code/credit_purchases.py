@@ -0,0 +1,132 @@
+# shared_code/credit_purchases.py
+import logging
+from typing import Dict, Optional
+import azure.cosmos.exceptions as exceptions
+
+CREDIT_PURCHASE = 'credit_purchase'
+
+# The purchase's transaction is completed before its tokens are credited and
+# records the credit afterwards, so a settled purchase is never credited again
+TOKENS_CREDITED = 'tokens_credited'
+
+# Ids of the last PaymentIntents credited to a payment_setup, written in the
+# same replace as the tokens. They only need to cover settlements between
+# completing the transaction and recording the credit on it, e.g. a retry
+# after a crash in between or a concurrent settlement.
+SETTLED_PAYMENT_INTENTS = 'settled_payment_intents'
+SETTLED_PAYMENT_INTENTS_KEPT = 50
+
+
+class AlreadySettled(Exception):
+    """The PaymentIntent's tokens were already credited"""
+
+
+def credit_transaction_id(payment_intent_id: str) -> str:
+    """One transaction per PaymentIntent, whichever of add-credits and the webhook writes it first"""
+    return f"trans_{payment_intent_id}"
+
+
+def credit_purchase_metadata(email: str, credit_amount: int) -> Dict:
+    return {
+        'purpose': CREDIT_PURCHASE,
+        'credit_amount': credit_amount,
+        'user_email': email
+    }
+
+
+def is_credit_purchase(payment_intent) -> bool:
+    return (payment_intent.get('metadata') or {}).get('purpose') == CREDIT_PURCHASE
+
+
+async def record_credit_purchase(db_client, payment_intent, status: str = 'pending') -> Dict:
+    """Create the purchase's transaction, or return the existing one"""
+    email = payment_intent['metadata']['user_email']
+    transaction_id = credit_transaction_id(payment_intent['id'])
+    try:
+        return await db_client.create_transaction(
+            user_id=email,
+            amount=payment_intent['amount'],
+            transaction_type=CREDIT_PURCHASE,
+            tokens=payment_intent['amount'],
+            status=status,
+            stripe_session_id=payment_intent['id'],
+            transaction_id=transaction_id
+        )
+    except exceptions.CosmosResourceExistsError:
+        return await db_client.get_transaction(transaction_id, email)
+
+
+async def _modify_credit_transaction(db_client, payment_intent, mutate) -> Optional[Dict]:
+    """Apply mutate to the purchase's transaction, creating it as pending first if add-credits never wrote it"""
+    email = payment_intent['metadata']['user_email']
+    transaction_id = credit_transaction_id(payment_intent['id'])
+    transaction = await db_client.modify_transaction(transaction_id, email, mutate)
+    if transaction is None:
+        # A concurrent writer may win the create; either way the next modify finds it
+        await record_credit_purchase(db_client, payment_intent)
+        transaction = await db_client.modify_transaction(transaction_id, email, mutate)
+    return transaction
+
+
+async def settle_credit_purchase(db_client, payment_intent) -> Optional[Dict]:
+    """Credit a succeeded credit purchase's tokens once and complete its transaction.
+
+    Safe to call any number of times per PaymentIntent, from add-credits
+    and from webhook retries alike. Returns the updated payment setup, or
+    None if the tokens had already been credited.
+    """
+    email = payment_intent['metadata']['user_email']
+    payment_intent_id = payment_intent['id']
+    tokens = payment_intent.get('amount_received') or payment_intent['amount']
+
+    def claim(transaction):
+        if transaction.get('status') == 'completed':
+            # Settlements completed before the credit was recorded on the transaction credited first
+            if transaction.get(TOKENS_CREDITED, True):
+                raise AlreadySettled()
+            return
+        transaction['status'] = 'completed'
+        transaction[TOKENS_CREDITED] = False
+
+    def credit(payment_setup):
+        settled = payment_setup.get(SETTLED_PAYMENT_INTENTS) or []
+        if payment_intent_id in settled:
+            raise AlreadySettled()
+        payment_setup['tokens'] = payment_setup.get('tokens', 0) + tokens
+        payment_setup[SETTLED_PAYMENT_INTENTS] = (settled + [payment_intent_id])[-SETTLED_PAYMENT_INTENTS_KEPT:]
+
+    def record_credit(transaction):
+        transaction[TOKENS_CREDITED] = True
+
+    if await db_client.get_payment_setup(email) is None:
+        raise ValueError(f"No payment setup for {email} to credit {payment_intent_id} to")
+    try:
+        await _modify_credit_transaction(db_client, payment_intent, claim)
+    except AlreadySettled:
+        logging.info(f"{payment_intent_id} was already credited to {email}")
+        return None
+
+    updated_setup = None
+    try:
+        updated_setup = await db_client.modify_payment_setup(email, credit)
+        if updated_setup is None:
+            raise ValueError(f"Payment setup of {email} was removed before {payment_intent_id} was credited")
+        logging.info(f"Credited {tokens} tokens of {payment_intent_id} to {email}")
+    except AlreadySettled:
+        pass
+
+    await _modify_credit_transaction(db_client, payment_intent, record_credit)
+    return updated_setup
+
+
+async def fail_credit_purchase(db_client, payment_intent) -> Optional[Dict]:
+    """Mark a credit purchase's transaction failed, unless it was already completed"""
+    def apply_status(transaction):
+        if transaction.get('status') == 'completed':
+            raise AlreadySettled()
+        transaction['status'] = 'failed'
+
+    try:
+        return await _modify_credit_transaction(db_client, payment_intent, apply_status)
+    except AlreadySettled:
+        return None
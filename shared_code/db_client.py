@@ -1,65 +1,55 @@
 # shared_code/db_client.py
-import azure.cosmos.cosmos_client as cosmos_client
 import azure.cosmos.exceptions as exceptions
 from azure.cosmos.partition_key import PartitionKey
-from azure.core.credentials import AzureKeyCredential
-from azure.eventgrid import EventGridPublisherClient
 import os
 import logging
 import uuid
 from datetime import datetime
-from typing import Optional, Dict, List
+from typing import Callable, Iterator, Optional, Dict, List, Tuple
 from .models import PaymentSetup, Location, Transaction, Plan, BaseModel
+from .patch import Patch, MAX_PATCH_OPERATIONS
+from .query import Query
+from .concurrency import update_with_retry, if_match
+from .constants import QUERY_PAGE_SIZE
+from .access_cache import get_access_cache
+from .pending_billing import (
+    PENDING_BILLING_COUNT,
+    is_pending_weekly_billing,
+    pending_billing_patch,
+    payment_required
+)
+from .telemetry import span, SPAN_EVENTGRID
+from . import clients
 
 class CosmosDBClient:
-    def __init__(self):
-        self._client = None
-        self._database = None
-        self._payment_container = None
-        self._location_container = None
-        self._transaction_container = None
-        self._event_grid_client = None
+    """Thin repository over the process-wide clients held in shared_code.clients"""
 
     @property
     def client(self):
-        if not self._client:
-            self._client = cosmos_client.CosmosClient.from_connection_string(
-                os.getenv('COSMOS_CONNECTION_STRING')
-            )
-        return self._client
+        return clients.get_cosmos_client()
 
     @property
     def event_grid_client(self):
-        if not self._event_grid_client:
-            self._event_grid_client = EventGridPublisherClient(
-                endpoint=os.getenv('EVENTGRID_ENDPOINT'),
-                credential=AzureKeyCredential(os.getenv('EVENTGRID_KEY'))
-            )
-        return self._event_grid_client
+        return clients.get_event_grid_client(
+            os.getenv('EVENTGRID_ENDPOINT'),
+            os.getenv('EVENTGRID_KEY')
+        )
 
     @property
     def database(self):
-        if not self._database:
-            self._database = self.client.get_database_client('culvana')
-        return self._database
+        return clients.get_database()
 
     @property
     def payment_container(self):
-        if not self._payment_container:
-            self._payment_container = self.database.get_container_client('culvana-payment')
-        return self._payment_container
+        return clients.get_container('culvana-payment')
 
     @property
     def location_container(self):
-        if not self._location_container:
-            self._location_container = self.database.get_container_client('culvana-location')
-        return self._location_container
+        return clients.get_container('culvana-location')
 
     @property
     def transaction_container(self):
-        if not self._transaction_container:
-            self._transaction_container = self.database.get_container_client('culvana-payment-log')
-        return self._transaction_container
+        return clients.get_container('culvana-payment-log')
 
     async def publish_threshold_event(self, user_id: str, current_fee: float, threshold: float):
         """Publish threshold exceeded event to Event Grid"""
@@ -76,7 +66,8 @@ class CosmosDBClient:
                 'data_version': '1.0'
             }]
             
-            self.event_grid_client.send(event)
+            with span(SPAN_EVENTGRID):
+                self.event_grid_client.send(event)
             logging.info(f"Published threshold event for user {user_id}")
             
         except Exception as e:
@@ -94,7 +85,8 @@ class CosmosDBClient:
         num_locations: int = 0,
         pending_fee: int = 0,
         payment_methods = None,
-        monthly_usage: int = 0
+        monthly_usage: int = 0,
+        card_summaries = None
     ) -> Dict:
         """Create new payment setup"""
         try:
@@ -108,7 +100,8 @@ class CosmosDBClient:
                 num_locations=num_locations,
                 pending_fee=pending_fee,
                 payment_methods=payment_methods,
-                monthly_usage=monthly_usage
+                monthly_usage=monthly_usage,
+                card_summaries=card_summaries
             )
             item_dict = payment_setup.to_dict()
             item_dict['updated_at'] = datetime.utcnow().isoformat()
@@ -143,7 +136,12 @@ class CosmosDBClient:
             )
             item_dict = transaction.to_dict()
             logging.info(f"Creating transaction: {item_dict}")
-            return self.transaction_container.upsert_item(body=item_dict)
+            result = self.transaction_container.upsert_item(body=item_dict)
+            if is_pending_weekly_billing(result):
+                self._adjust_pending_billing(user_id, 1, result.get('amount', 0))
+            elif transaction_type == 'weekly_billing':
+                get_access_cache().invalidate(user_id)
+            return result
 
         except Exception as e:
             logging.error(f"Error creating transaction: {str(e)}")
@@ -164,64 +162,293 @@ class CosmosDBClient:
             logging.error(f"Error creating location: {str(e)}")
             raise
 
+    def _read_item(self, container, item_id: str, partition_key: str) -> Optional[Dict]:
+        """Point read an item by id and partition key (user_id), None if it does not exist"""
+        try:
+            return container.read_item(item=item_id, partition_key=partition_key)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    def query(self, container, query: Query, partition_key: Optional[str] = None) -> List:
+        """Run a built query, within one partition (user_id) when partition_key is given"""
+        sql, parameters = query.build()
+        if partition_key is not None:
+            return list(container.query_items(query=sql, parameters=parameters, partition_key=partition_key))
+        return list(container.query_items(query=sql, parameters=parameters, enable_cross_partition_query=True))
+
+    def _pages(self, container, query: Query, partition_key: Optional[str], max_item_count: Optional[int], continuation: Optional[str]):
+        sql, parameters = query.build()
+        options = {'partition_key': partition_key} if partition_key is not None else {'enable_cross_partition_query': True}
+        return container.query_items(
+            query=sql,
+            parameters=parameters,
+            max_item_count=max_item_count or QUERY_PAGE_SIZE,
+            **options
+        ).by_page(continuation)
+
+    def iter_pages(
+        self,
+        container,
+        query: Query,
+        partition_key: Optional[str] = None,
+        max_item_count: Optional[int] = None
+    ) -> Iterator[List]:
+        """Yield the results page by page as they are fetched, instead of materializing them all"""
+        for page in self._pages(container, query, partition_key, max_item_count, None):
+            items = list(page)
+            if items:
+                yield items
+
+    def query_page(
+        self,
+        container,
+        query: Query,
+        partition_key: str,
+        max_item_count: Optional[int] = None,
+        continuation: Optional[str] = None
+    ) -> Tuple[List, Optional[str]]:
+        """One page of a single-partition query and the token for the next page, None after the last"""
+        pages = self._pages(container, query, partition_key, max_item_count, continuation)
+        page = next(pages, None)
+        items = list(page) if page is not None else []
+        return items, pages.continuation_token
+
+    def query_value(self, container, query: Query, partition_key: Optional[str] = None):
+        """Run a count(), exists() or sum() query and return its single value"""
+        results = self.query(container, query, partition_key)
+        return results[0] if results else query.default
+
+    def _patch_item(self, container, item_id: str, partition_key: str, patch: Patch) -> Dict:
+        """Apply a partial update and stamp updated_at, returning the updated item"""
+        patch.touch()
+        if len(patch) > MAX_PATCH_OPERATIONS:
+            raise ValueError(f"Patch has {len(patch)} operations, at most {MAX_PATCH_OPERATIONS} are allowed")
+        return container.patch_item(
+            item=item_id,
+            partition_key=partition_key,
+            patch_operations=patch.operations,
+            filter_predicate=patch.filter_predicate
+        )
+
+    def patch_payment_setup(self, email: str, patch: Patch) -> Dict:
+        """Partially update a payment setup without reading it first"""
+        try:
+            return self._patch_item(self.payment_container, PaymentSetup.document_id(email), email, patch)
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
+            raise
+        except Exception as e:
+            logging.error(f"Error patching payment setup: {str(e)}")
+            raise
+
+    def patch_location(self, location_id: str, user_id: str, patch: Patch) -> Dict:
+        """Partially update a location without reading it first"""
+        try:
+            return self._patch_item(self.location_container, location_id, user_id, patch)
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
+            raise
+        except Exception as e:
+            logging.error(f"Error patching location: {str(e)}")
+            raise
+
+    def _adjust_pending_billing(self, user_id: str, count: int, amount: float):
+        """Move the pending weekly billing counters on the user's payment setup.
+
+        Setups created before the counters existed are left alone; they keep
+        the query-based access check until reconciliation fills them in.
+        """
+        get_access_cache().invalidate(user_id)
+        patch = pending_billing_patch(count, amount).where(f"IS_DEFINED(c.{PENDING_BILLING_COUNT})")
+        try:
+            self.patch_payment_setup(user_id, patch)
+        except (exceptions.CosmosAccessConditionFailedError, exceptions.CosmosResourceNotFoundError):
+            logging.info(f"Payment setup of {user_id} has no pending billing counters yet")
+
+    def _modify_item(self, name: str, container, item_id: str, partition_key: str, mutate) -> Optional[Dict]:
+        return update_with_retry(
+            name,
+            lambda: self._read_item(container, item_id, partition_key),
+            lambda item: container.replace_item(item=item['id'], body=item, **if_match(item)),
+            mutate
+        )
+
+    def modify_payment_setup(self, email: str, mutate: Callable[[Dict], Optional[Dict]]) -> Optional[Dict]:
+        """Apply mutate to the current payment setup and write it back if no one else changed it meanwhile"""
+        try:
+            return self._modify_item(
+                'payment_setup',
+                self.payment_container,
+                PaymentSetup.document_id(email),
+                email,
+                mutate
+            )
+        except Exception as e:
+            logging.error(f"Error modifying payment setup: {str(e)}")
+            raise
+
+    def modify_location(self, location_id: str, user_id: str, mutate: Callable[[Dict], Optional[Dict]]) -> Optional[Dict]:
+        """Apply mutate to the current location and write it back if no one else changed it meanwhile"""
+        try:
+            return self._modify_item('location', self.location_container, location_id, user_id, mutate)
+        except Exception as e:
+            logging.error(f"Error modifying location: {str(e)}")
+            raise
+
+    def modify_transaction(self, transaction_id: str, user_id: str, mutate: Callable[[Dict], Optional[Dict]]) -> Optional[Dict]:
+        """Apply mutate to the current transaction and write it back if no one else changed it meanwhile"""
+        try:
+            before = {}
+
+            def tracked(transaction):
+                # Re-run on every conflict retry, so this holds the version that was replaced
+                before['pending'] = is_pending_weekly_billing(transaction)
+                before['amount'] = transaction.get('amount', 0)
+                return mutate(transaction)
+
+            transaction = self._modify_item('transaction', self.transaction_container, transaction_id, user_id, tracked)
+            if transaction:
+                change = int(is_pending_weekly_billing(transaction)) - int(before['pending'])
+                if change:
+                    amount = transaction.get('amount', 0) if change > 0 else before['amount']
+                    self._adjust_pending_billing(user_id, change, change * amount)
+                elif transaction.get('transaction_type') == 'weekly_billing':
+                    get_access_cache().invalidate(user_id)
+            return transaction
+        except Exception as e:
+            logging.error(f"Error modifying transaction: {str(e)}")
+            raise
+
     def get_payment_setup(self, email: str) -> Optional[Dict]:
         """Get payment setup by email"""
         try:
-            query = "SELECT * FROM c WHERE c.type = 'payment_setup' AND c.user_id = @user_id"
-            parameters = [{"name": "@user_id", "value": email}]
-            results = list(self.payment_container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
-            return results[0] if results else None
+            return self._read_item(
+                self.payment_container,
+                PaymentSetup.document_id(email),
+                email
+            )
         except Exception as e:
             logging.error(f"Error getting payment setup: {str(e)}")
             raise
 
-    def get_payment_log(self, email: str) -> Optional[Dict]:
-        """Get payment setup by email"""
+    def get_location(self, location_id: str, user_id: Optional[str] = None) -> Optional[Dict]:
+        """Get a location by id, using a point read when the owning user is known"""
         try:
-            query = "SELECT * FROM c WHERE c.type = 'transaction' AND c.user_id = @user_id"
-            parameters = [{"name": "@user_id", "value": email}]
-            results = list(self.transaction_container.query_items(
+            if user_id:
+                location = self._read_item(self.location_container, location_id, user_id)
+                if location and location.get('type') != 'location':
+                    return None
+                return location
+
+            query = "SELECT * FROM c WHERE c.id = @id AND c.type = 'location'"
+            parameters = [{"name": "@id", "value": location_id}]
+            results = list(self.location_container.query_items(
                 query=query,
                 parameters=parameters,
                 enable_cross_partition_query=True
             ))
+            return results[0] if results else None
+        except Exception as e:
+            logging.error(f"Error getting location: {str(e)}")
+            raise
+
+    def get_payment_log(self, email: str, fields: Optional[List[str]] = None) -> Optional[List[Dict]]:
+        """Get a user's transactions, only the given fields if any"""
+        try:
+            query = Query('transaction').select(*(fields or [])).where('user_id', email)
+            results = self.query(self.transaction_container, query, partition_key=email)
             return results if results else None
         except Exception as e:
             logging.error(f"Error getting payment setup: {str(e)}")
             raise
 
-    def get_locations(self, email: str) -> List[Dict]:
-        """Get all locations for a user"""
+    def get_locations(self, email: str, fields: Optional[List[str]] = None) -> List[Dict]:
+        """Get all locations for a user, only the given fields if any"""
         try:
-            query = "SELECT * FROM c WHERE c.type = 'location' AND c.user_id = @user_id"
-            parameters = [{"name": "@user_id", "value": email}]
-            results = list(self.location_container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
-            return results
+            query = Query('location').select(*(fields or [])).where('user_id', email)
+            return self.query(self.location_container, query, partition_key=email)
         except Exception as e:
             logging.error(f"Error getting locations: {str(e)}")
             raise
 
+    def get_payment_log_page(
+        self,
+        email: str,
+        fields: Optional[List[str]] = None,
+        page_size: Optional[int] = None,
+        continuation: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """One page of a user's transactions and the continuation token for the next"""
+        try:
+            query = Query('transaction').select(*(fields or [])).where('user_id', email)
+            return self.query_page(self.transaction_container, query, email, page_size, continuation)
+        except Exception as e:
+            logging.error(f"Error getting payment log page: {str(e)}")
+            raise
+
+    def get_payment_log_totals(self, email: str) -> Dict:
+        """Amount, tokens and count over all of a user's transactions, computed by the database"""
+        try:
+            container = self.transaction_container
+            return {
+                'total_amount': self.query_value(container, Query('transaction').where('user_id', email).sum('amount'), email),
+                'total_tokens': self.query_value(container, Query('transaction').where('user_id', email).sum('tokens_included'), email),
+                'transaction_count': self.query_value(container, Query('transaction').where('user_id', email).count(), email)
+            }
+        except Exception as e:
+            logging.error(f"Error getting payment log totals: {str(e)}")
+            raise
+
+    def get_locations_page(
+        self,
+        email: str,
+        fields: Optional[List[str]] = None,
+        page_size: Optional[int] = None,
+        continuation: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """One page of a user's locations and the continuation token for the next"""
+        try:
+            query = Query('location').select(*(fields or [])).where('user_id', email)
+            return self.query_page(self.location_container, query, email, page_size, continuation)
+        except Exception as e:
+            logging.error(f"Error getting locations page: {str(e)}")
+            raise
+
+    def _pending_weekly_billing(self, email: str) -> Query:
+        return (
+            Query('transaction')
+            .where('user_id', email)
+            .where('transaction_type', 'weekly_billing')
+            .where('status', 'pending')
+        )
+
+    def has_pending_weekly_billing(self, email: str, payment_setup: Optional[Dict] = None) -> bool:
+        """Whether the user has an unpaid weekly charge, from the payment setup's counters when it has them"""
+        try:
+            payment_setup = payment_setup or self.get_payment_setup(email)
+            decision = payment_required(payment_setup) if payment_setup else None
+            if decision is not None:
+                return decision
+
+            query = self._pending_weekly_billing(email).exists()
+            return self.query_value(self.transaction_container, query, partition_key=email)
+        except Exception as e:
+            logging.error(f"Error checking pending transactions: {str(e)}")
+            raise
+
+    def get_pending_weekly_billing(self, email: str, fields: Optional[List[str]] = None) -> List[Dict]:
+        """Get a user's unpaid weekly charges, only the given fields if any"""
+        try:
+            query = self._pending_weekly_billing(email).select(*(fields or []))
+            return self.query(self.transaction_container, query, partition_key=email)
+        except Exception as e:
+            logging.error(f"Error getting pending transactions: {str(e)}")
+            raise
+
     def update_tokens(self, email: str, tokens: int):
         """Update tokens for a user's payment setup."""
-        payment_setup = self.get_payment_setup(email)
-        if not payment_setup:
+        try:
+            return self.patch_payment_setup(email, Patch().set('tokens', tokens))
+        except exceptions.CosmosResourceNotFoundError:
             raise ValueError("Payment setup not found")
-        
-        payment_setup['tokens'] = tokens
-        payment_setup['updated_at'] = datetime.utcnow().isoformat()
-        
-        return self.payment_container.replace_item(
-            item=payment_setup['id'],
-            body=payment_setup
-        )
 
     def get_active_locations(self) -> List[Dict]:
         """Get all active locations"""
@@ -236,28 +463,25 @@ class CosmosDBClient:
             logging.error(f"Error getting active locations: {str(e)}")
             raise
 
-    async def update_location_billing(self, location_id: str, current_period_fee: float, last_billing_update: str):
+    async def update_location_billing(
+        self,
+        location_id: str,
+        current_period_fee: float,
+        last_billing_update: str,
+        user_id: Optional[str] = None
+    ):
         """Update location billing information"""
         try:
-            query = "SELECT * FROM c WHERE c.id = @id"
-            parameters = [{"name": "@id", "value": location_id}]
-            results = list(self.location_container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
-            
-            if not results:
-                raise ValueError(f"Location {location_id} not found")
-            location = results[0]
-            location['current_period_fee'] = current_period_fee
-            location['last_billing_update'] = last_billing_update
-            location['updated_at'] = datetime.utcnow().isoformat()
+            if not user_id:
+                location = self.get_location(location_id)
+                if not location:
+                    raise ValueError(f"Location {location_id} not found")
+                user_id = location['user_id']
             
-            updated_location = self.location_container.replace_item(
-                item=location['id'],
-                body=location
-            )
+            return self.patch_location(location_id, user_id, Patch().set_fields({
+                'current_period_fee': current_period_fee,
+                'last_billing_update': last_billing_update
+            }))
 
         except Exception as e:
             logging.error(f"Error updating location billing: {str(e)}")
@@ -266,17 +490,9 @@ class CosmosDBClient:
     async def update_payment_setup_pending_fee(self, email: str, pending_fee: float):
         """Update pending fee in payment setup"""
         try:
-            payment_setup = self.get_payment_setup(email)
-            if not payment_setup:
-                raise ValueError(f"Payment setup for {email} not found")
-            
-            payment_setup['pending_fee'] = pending_fee
-            payment_setup['updated_at'] = datetime.utcnow().isoformat()
-            
-            return self.payment_container.replace_item(
-                item=payment_setup['id'],
-                body=payment_setup
-            )
+            return self.patch_payment_setup(email, Patch().set('pending_fee', pending_fee))
+        except exceptions.CosmosResourceNotFoundError:
+            raise ValueError(f"Payment setup for {email} not found")
         except Exception as e:
             logging.error(f"Error updating payment setup pending fee: {str(e)}")
             raise
\ No newline at end of file
@@ -0,0 +1,152 @@
+# shared_code/dispatcher.py
+import os
+import time
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Optional
+import azure.cosmos.exceptions as exceptions
+from .async_db_client import AsyncCosmosDBClient
+from .billing_jobs import SHARD_JOBS
+from .constants import BILLING_SHARD_COUNT, MAX_RETRIES, RUN_STATE_TTL_SECONDS
+from .lease import Shard, run_shard
+from .work_queue import WorkQueue, LocalWorkQueue, get_work_queue
+
+RUN_SUMMARY_DISPATCHED = 'dispatched'
+RUN_SUMMARY_COMPLETED = 'completed'
+
+
+def run_summary_id(job: str, tick_id: str) -> str:
+    return f"runsummary_{job}_{tick_id}"
+
+
+# Per-shard rates and gauges that make no sense summed across shards
+NON_ADDITIVE_KEYS = {'items_per_second', 'final_concurrency'}
+
+
+def _totals(shards: Dict[str, Dict]) -> Dict:
+    totals = {}
+    for summary in shards.values():
+        for key, value in summary.items():
+            if key in NON_ADDITIVE_KEYS:
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+async def dispatch(
+    db_client: AsyncCosmosDBClient,
+    job: str,
+    tick_id: str,
+    queue: Optional[WorkQueue] = None,
+    shard_count: Optional[int] = None
+) -> Dict:
+    """Open the run summary of a job tick and enqueue one message per shard.
+
+    With a LocalWorkQueue the shards are processed in-process before this
+    returns; otherwise billing-shard-worker instances pick them up.
+    """
+    shard_count = shard_count or int(os.getenv('BILLING_SHARD_COUNT', BILLING_SHARD_COUNT))
+    queue = queue or get_work_queue()
+
+    summary = await db_client.get_system_document(run_summary_id(job, tick_id))
+    if summary is None:
+        try:
+            summary = await db_client.create_system_document({
+                'id': run_summary_id(job, tick_id),
+                'type': 'run_summary',
+                'job': job,
+                'tick_id': tick_id,
+                'shard_count': shard_count,
+                'status': RUN_SUMMARY_DISPATCHED,
+                'shards': {},
+                'totals': {},
+                'dispatched_at': datetime.now(timezone.utc).isoformat(),
+                'ttl': RUN_STATE_TTL_SECONDS
+            })
+        except exceptions.CosmosResourceExistsError:
+            summary = await db_client.get_system_document(run_summary_id(job, tick_id))
+
+    if summary['status'] == RUN_SUMMARY_COMPLETED:
+        logging.info(f"{job} tick {tick_id} already completed. Skipping dispatch.")
+        return summary
+
+    shard_count = summary['shard_count']
+    for index in range(shard_count):
+        if str(index) not in summary['shards']:
+            await queue.send({'job': job, 'tick_id': tick_id, 'shard': index, 'shard_count': shard_count})
+    logging.info(f"Dispatched {shard_count - len(summary['shards'])} shards of {job} tick {tick_id}")
+
+    if isinstance(queue, LocalWorkQueue):
+        await queue.drain(lambda message: process_shard_message(db_client, message, queue))
+        return await get_run_summary(db_client, job, tick_id)
+    return summary
+
+
+async def process_shard_message(
+    db_client: AsyncCosmosDBClient,
+    message: Dict,
+    queue: Optional[WorkQueue] = None
+) -> Optional[Dict]:
+    """Run one shard of a job under its lease and record the result.
+
+    Returns None when another instance holds the shard. A shard that ran out
+    of time budget is sent back to the queue to continue where it stopped.
+    """
+    job = SHARD_JOBS[message['job']]
+    tick_id = message['tick_id']
+    shard = Shard(message['shard'], message['shard_count'])
+    started = time.monotonic()
+
+    summary = await run_shard(
+        db_client,
+        job.lease_name,
+        tick_id,
+        shard,
+        lambda shard: job.handler(db_client, shard, tick_id, started)
+    )
+    if summary is None:
+        logging.info(f"{job.name} tick {tick_id} shard {shard} is held or done elsewhere. Skipping.")
+        return None
+
+    if summary.get('completed', True):
+        await record_shard_result(db_client, job.name, tick_id, shard, summary)
+    else:
+        await (queue or get_work_queue()).send(message)
+    return summary
+
+
+async def record_shard_result(
+    db_client: AsyncCosmosDBClient,
+    job: str,
+    tick_id: str,
+    shard: Shard,
+    summary: Dict
+) -> Dict:
+    """Merge a finished shard into the run summary, retrying on concurrent updates"""
+    for attempt in range(MAX_RETRIES * 3):
+        run_summary = await get_run_summary(db_client, job, tick_id)
+        if run_summary is None:
+            raise ValueError(f"Run summary for {job} tick {tick_id} not found")
+
+        run_summary['shards'][str(shard.index)] = summary
+        run_summary['totals'] = _totals(run_summary['shards'])
+        run_summary['updated_at'] = datetime.now(timezone.utc).isoformat()
+        if len(run_summary['shards']) >= run_summary['shard_count']:
+            run_summary['status'] = RUN_SUMMARY_COMPLETED
+            run_summary['completed_at'] = run_summary['updated_at']
+
+        try:
+            run_summary = await db_client.replace_system_document(run_summary, run_summary['_etag'])
+        except exceptions.CosmosAccessConditionFailedError:
+            continue
+
+        if run_summary['status'] == RUN_SUMMARY_COMPLETED:
+            logging.info(f"{job} tick {tick_id} completed: {run_summary['totals']}")
+        return run_summary
+
+    raise RuntimeError(f"Could not record shard {shard} of {job} tick {tick_id} after repeated conflicts")
+
+
+async def get_run_summary(db_client: AsyncCosmosDBClient, job: str, tick_id: str) -> Optional[Dict]:
+    return await db_client.get_system_document(run_summary_id(job, tick_id))
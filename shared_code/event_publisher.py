@@ -4,9 +4,9 @@ import uuid
 import asyncio
 import logging
 from datetime import datetime, timezone
-from azure.eventgrid import EventGridPublisherClient
-from azure.core.credentials import AzureKeyCredential
 from azure.core.exceptions import AzureError
+from .telemetry import span, SPAN_EVENTGRID
+from . import clients
 from .constants import (
     EVENT_TYPE_THRESHOLD_EXCEEDED,
     EVENT_SUBJECT_PREFIX,
@@ -16,10 +16,8 @@ from .constants import (
 
 class EventGridPublisher:
     def __init__(self):
-        self.client = EventGridPublisherClient(
-            endpoint=os.environ["EventGrid_TopicEndpoint"],
-            credential=AzureKeyCredential(os.environ["EventGrid_TopicKey"])
-        )
+        self.endpoint = os.environ["EventGrid_TopicEndpoint"]
+        self.key = os.environ["EventGrid_TopicKey"]
     
     async def publish_threshold_event(self, user_id: str, current_fee: float, threshold: float):
         event = [{
@@ -36,7 +34,9 @@ class EventGridPublisher:
         
         for attempt in range(MAX_RETRIES):
             try:
-                self.client.send(event)
+                client = await clients.get_async_event_grid_client(self.endpoint, self.key)
+                with span(SPAN_EVENTGRID):
+                    await client.send(event)
                 logging.info(f"Successfully published threshold event for user {user_id}")
                 return True
             except AzureError as e:
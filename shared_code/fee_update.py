@@ -1,5 +1,9 @@
 import logging
-from shared_code.db_client import CosmosDBClient
+from typing import Optional
+import azure.cosmos.exceptions as exceptions
+from shared_code.async_db_client import AsyncCosmosDBClient
+from shared_code.patch import Patch
+from shared_code.run_state import hourly_tick
 import asyncio
 from datetime import datetime, timezone
 
@@ -9,25 +13,34 @@ def calculate_hourly_fee(monthly_fee: float) -> float:
     hourly_fee = daily_fee / 24
     return hourly_fee
 
-async def update_location_fees(db_client: CosmosDBClient, location):
-    """Update current_period_fee for a location"""
+async def update_location_fees(db_client: AsyncCosmosDBClient, location, tick_id: Optional[str] = None):
+    """Add one hour of fees to a location's current_period_fee, at most once per tick"""
     try:
         if not location.get('is_active', False):
             logging.info(f"Skipping inactive location {location['id']}")
             return location.get('current_period_fee', 0)
 
+        tick_id = tick_id or hourly_tick()
+        if location.get('last_billing_tick') == tick_id:
+            return location.get('current_period_fee', 0)
+
         monthly_fee = location.get('monthly_fee', 0)
         hourly_fee = calculate_hourly_fee(monthly_fee)
         
         current_time = datetime.now(timezone.utc)
         
-        current_period_fee = location.get('current_period_fee', 0) + hourly_fee
+        # A retried attempt, e.g. after a 429, finds the tick stamped and accrues nothing
+        patch = Patch().incr('current_period_fee', hourly_fee).set_fields({
+            'last_billing_update': current_time.isoformat(),
+            'last_billing_tick': tick_id
+        }).where_not('last_billing_tick', tick_id)
+        try:
+            location = await db_client.patch_location(location['id'], location['user_id'], patch)
+        except exceptions.CosmosAccessConditionFailedError:
+            logging.info(f"Location {location['id']} already billed for tick {tick_id}")
+            location = await db_client.get_location(location['id'], user_id=location['user_id'])
         
-        await db_client.update_location_billing(
-            location_id=location['id'],
-            current_period_fee=current_period_fee,
-            last_billing_update=current_time.isoformat()
-        )
+        current_period_fee = location.get('current_period_fee', 0)
         
         logging.info(f"Updated current_period_fee for location {location['id']}: {current_period_fee}")
         return current_period_fee
@@ -36,13 +49,14 @@ async def update_location_fees(db_client: CosmosDBClient, location):
         logging.error(f"Error updating fee for location {location['id']}: {str(e)}")
         raise
 
-async def update_user_pending_fee(db_client: CosmosDBClient, payment_setup):
-    """Calculate and update pending fee for a user"""
+async def update_user_pending_fee(db_client: AsyncCosmosDBClient, payment_setup, tick_id: Optional[str] = None):
+    """Calculate and update pending fee for a user; safe to retry within a tick"""
     try:
-        locations = db_client.get_locations(payment_setup['user_id'])
+        tick_id = tick_id or hourly_tick()
+        locations = await db_client.get_locations(payment_setup['user_id'])
         
         location_fees = await asyncio.gather(*[
-            update_location_fees(db_client, location)
+            update_location_fees(db_client, location, tick_id)
             for location in locations
         ])
 
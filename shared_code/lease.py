@@ -0,0 +1,207 @@
+# shared_code/lease.py
+import os
+import uuid
+import random
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+import azure.cosmos.exceptions as exceptions
+from .async_db_client import AsyncCosmosDBClient
+from .constants import (
+    BILLING_SHARD_COUNT,
+    LEASE_DURATION_SECONDS,
+    LEASE_RETENTION_SECONDS
+)
+
+LEASE_STATUS_HELD = 'held'
+LEASE_STATUS_DONE = 'done'
+
+# Identifies this worker instance in lease owner tokens
+INSTANCE_ID = os.getenv('WEBSITE_INSTANCE_ID') or uuid.uuid4().hex
+
+
+class Shard:
+    """One of count stable, hash-based slices of the user base"""
+
+    def __init__(self, index: int, count: int):
+        self.index = index
+        self.count = count
+        # Set by run_shard while the shard's work runs, so it can renew the lease
+        self.lease: Optional['Lease'] = None
+
+    def contains(self, user_id: str) -> bool:
+        digest = hashlib.md5(user_id.encode('utf-8')).hexdigest()
+        return int(digest, 16) % self.count == self.index
+
+    def __str__(self):
+        return f"{self.index + 1}/{self.count}"
+
+
+class Lease:
+    """Exclusive, expiring claim on one unit of work, kept as a system document.
+
+    Acquiring is a conditional write (create, or replace with If-Match on the
+    ETag), so of several instances racing for the same lease exactly one
+    wins. Each Lease object has its own owner token, so two claims from the
+    same worker, e.g. a queue message delivered twice in one batch, race
+    like claims from different instances. Only an expired lease left by a
+    crashed holder can be taken over; a completed one blocks the work until
+    the document's TTL removes it.
+    """
+
+    def __init__(self, db_client: AsyncCosmosDBClient, name: str, duration: Optional[int] = None):
+        self.db_client = db_client
+        self.name = name
+        self.id = f"lease_{name}"
+        self.owner = f"{INSTANCE_ID}:{uuid.uuid4().hex}"
+        self.duration = duration or int(os.getenv('LEASE_DURATION_SECONDS', LEASE_DURATION_SECONDS))
+        self.document = None
+
+    def _new_document(self, status: str = LEASE_STATUS_HELD) -> Dict:
+        now = datetime.now(timezone.utc)
+        return {
+            'id': self.id,
+            'type': 'lease',
+            'name': self.name,
+            'owner': self.owner,
+            'status': status,
+            'acquired_at': now.isoformat(),
+            'expires_at': (now + timedelta(seconds=self.duration)).isoformat(),
+            'ttl': max(self.duration, LEASE_RETENTION_SECONDS)
+        }
+
+    @property
+    def held(self) -> bool:
+        return self.document is not None and self.document['owner'] == self.owner
+
+    @property
+    def renewal_due(self) -> bool:
+        """True once half of a held lease's duration has passed"""
+        if not self.held:
+            return False
+        acquired_at = datetime.fromisoformat(self.document['acquired_at'])
+        return datetime.now(timezone.utc) >= acquired_at + timedelta(seconds=self.duration / 2)
+
+    async def acquire(self) -> bool:
+        """Try to take the lease, True if this instance now holds it"""
+        try:
+            self.document = await self.db_client.create_system_document(self._new_document())
+            logging.info(f"Acquired lease {self.name}")
+            return True
+        except exceptions.CosmosResourceExistsError:
+            pass
+
+        current = await self.db_client.get_system_document(self.id)
+        if current is None or current.get('status') == LEASE_STATUS_DONE:
+            return False
+
+        expired = current['expires_at'] <= datetime.now(timezone.utc).isoformat()
+        if not expired:
+            logging.info(f"Lease {self.name} is held by {current['owner']} until {current['expires_at']}")
+            return False
+
+        try:
+            self.document = await self.db_client.replace_system_document(self._new_document(), current['_etag'])
+            logging.info(f"Took over lease {self.name} from {current['owner']}")
+            return True
+        except exceptions.CosmosAccessConditionFailedError:
+            logging.info(f"Lost the race for lease {self.name}")
+            return False
+
+    async def renew(self) -> bool:
+        """Extend a held lease, False if another owner took it over meanwhile"""
+        if not self.held:
+            return False
+        try:
+            self.document = await self.db_client.replace_system_document(
+                self._new_document(),
+                self.document['_etag']
+            )
+            return True
+        except exceptions.CosmosAccessConditionFailedError:
+            logging.warning(f"Lease {self.name} was taken over by another instance")
+            self.document = None
+            return False
+
+    async def complete(self):
+        """Mark the work done so no instance picks it up again"""
+        if not self.held:
+            return
+        try:
+            self.document = await self.db_client.replace_system_document(
+                self._new_document(LEASE_STATUS_DONE),
+                self.document['_etag']
+            )
+        except exceptions.CosmosAccessConditionFailedError:
+            logging.warning(f"Lease {self.name} was taken over before it could be completed")
+            self.document = None
+
+    async def release(self):
+        """Give the lease up so another instance or the next run can resume the work"""
+        if not self.held:
+            return
+        try:
+            await self.db_client.delete_system_document(self.id, self.document['_etag'])
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
+            logging.warning(f"Lease {self.name} was already released or taken over")
+        self.document = None
+
+
+async def run_shard(
+    db_client: AsyncCosmosDBClient,
+    lease_name: str,
+    tick_id: str,
+    shard: Shard,
+    work
+) -> Optional[Dict]:
+    """Run work(shard) under the shard's lease, None if another instance holds it.
+
+    work returns a summary; when its 'completed' is False, or it raises,
+    the lease is released so the shard can be resumed. work can reach the
+    lease as shard.lease; a RunState given it renews the lease after each
+    batch and stops the run if it was taken over.
+    """
+    lease = Lease(db_client, f"{lease_name}_{tick_id}_{shard.index}")
+    if not await lease.acquire():
+        return None
+
+    shard.lease = lease
+    try:
+        summary = await work(shard)
+    except Exception:
+        await lease.release()
+        raise
+    finally:
+        shard.lease = None
+
+    if summary.get('completed', True):
+        await lease.complete()
+    else:
+        await lease.release()
+    return summary
+
+
+async def run_shards(
+    db_client: AsyncCosmosDBClient,
+    lease_name: str,
+    tick_id: str,
+    work,
+    shard_count: Optional[int] = None
+) -> Dict[int, Dict]:
+    """Run work(shard) for every shard of a tick whose lease this instance wins.
+
+    Shards are tried in random order so concurrent instances spread out.
+    """
+    shard_count = shard_count or int(os.getenv('BILLING_SHARD_COUNT', BILLING_SHARD_COUNT))
+    indexes = list(range(shard_count))
+    random.shuffle(indexes)
+
+    results = {}
+    for index in indexes:
+        summary = await run_shard(db_client, lease_name, tick_id, Shard(index, shard_count), work)
+        if summary is not None:
+            results[index] = summary
+
+    logging.info(f"{lease_name} tick {tick_id}: processed shards {sorted(results)} of {shard_count}")
+    return results
@@ -1,59 +1,171 @@
 from functools import wraps
+import asyncio
+import inspect
 import json
 import logging
+from typing import Dict, Optional, Union
 import azure.functions as func
 from .db_client import CosmosDBClient
+from .async_db_client import AsyncCosmosDBClient
+from .telemetry import operation, span, attach_server_timing
+from .access_cache import get_access_cache
+from .pending_billing import payment_required
+
+# Handlers that declare a parameter with this name get the RequestContext
+REQUEST_CONTEXT_PARAMETER = 'request_context'
+
+
+class RequestContext:
+    """What check_payment_access already parsed and loaded, handed to the wrapped handler.
+
+    db_client is an AsyncCosmosDBClient when the handler is a coroutine.
+    """
+
+    def __init__(
+        self,
+        req: func.HttpRequest,
+        body: Dict,
+        db_client: Union[CosmosDBClient, AsyncCosmosDBClient],
+        payment_setup: Optional[Dict]
+    ):
+        self.req = req
+        self.body = body
+        self.email = body.get('email')
+        self.db_client = db_client
+        self.payment_setup = payment_setup
+
+
+def _hide_parameter(wrapper, wrapped, name: str):
+    # The Functions host binds main's parameters from function.json, so the
+    # injected one must not show up in the signature it inspects
+    signature = inspect.signature(wrapped)
+    wrapper.__signature__ = signature.replace(
+        parameters=[parameter for parameter in signature.parameters.values() if parameter.name != name]
+    )
+    wrapper.__annotations__ = {key: value for key, value in wrapped.__annotations__.items() if key != name}
+
+
+def _parse_body(req: func.HttpRequest):
+    """The request's JSON body, or the 400 response to return instead"""
+    try:
+        req_body = req.get_json()
+    except ValueError:
+        return None, func.HttpResponse(
+            json.dumps({
+                "error": "Invalid request body",
+                "error_code": "invalid_request"
+            }),
+            mimetype="application/json",
+            status_code=400
+        )
+    if not req_body.get('email'):
+        return None, func.HttpResponse(
+            json.dumps({
+                "error": "Email is required",
+                "error_code": "missing_email"
+            }),
+            mimetype="application/json",
+            status_code=400
+        )
+    return req_body, None
+
+
+def _payment_required_response() -> func.HttpResponse:
+    return func.HttpResponse(
+        json.dumps({
+            "error": "Payment required to access this feature",
+            "error_code": "payment_required",
+            "requires_subscription": True
+        }),
+        mimetype="application/json",
+        status_code=402
+    )
+
+
+def _server_error_response(e: Exception) -> func.HttpResponse:
+    logging.error(f'Error in payment middleware: {str(e)}')
+    return func.HttpResponse(
+        json.dumps({
+            "error": "An unexpected error occurred",
+            "error_code": "server_error"
+        }),
+        mimetype="application/json",
+        status_code=500
+    )
+
 
 def check_payment_access(func_to_wrap):
-    @wraps(func_to_wrap)
-    def wrapper(req: func.HttpRequest, *args, **kwargs):
+    """Answer 402 instead of calling the handler while the user has an unpaid weekly charge.
+
+    Coroutine handlers get an async wrapper that looks the user up on the
+    azure.cosmos.aio client, and their RequestContext carries an
+    AsyncCosmosDBClient; sync handlers keep the blocking CosmosDBClient.
+    Every response, including the ones produced here, carries the
+    invocation's Server-Timing header.
+    """
+    accepts_context = REQUEST_CONTEXT_PARAMETER in inspect.signature(func_to_wrap).parameters
+
+    if asyncio.iscoroutinefunction(func_to_wrap):
+        async def guarded_async(req: func.HttpRequest, *args, **kwargs):
+            try:
+                req_body, error_response = _parse_body(req)
+                if error_response:
+                    return error_response
+                email = req_body['email']
+                db_client = AsyncCosmosDBClient()
+
+                with span('access_check'), operation('check_payment_access'):
+                    payment_setup = await db_client.get_payment_setup(email)
+                    payment_is_required = payment_required(payment_setup) if payment_setup else None
+                    if payment_is_required is None:
+                        payment_is_required = await get_access_cache().payment_required_async(
+                            email,
+                            lambda email: db_client.has_pending_weekly_billing(email, payment_setup)
+                        )
+                if payment_is_required:
+                    return _payment_required_response()
+                if accepts_context:
+                    kwargs[REQUEST_CONTEXT_PARAMETER] = RequestContext(req, req_body, db_client, payment_setup)
+                return await func_to_wrap(req, *args, **kwargs)
+            except Exception as e:
+                return _server_error_response(e)
+
+        @wraps(func_to_wrap)
+        async def async_wrapper(req: func.HttpRequest, *args, **kwargs):
+            return attach_server_timing(await guarded_async(req, *args, **kwargs))
+
+        if accepts_context:
+            _hide_parameter(async_wrapper, func_to_wrap, REQUEST_CONTEXT_PARAMETER)
+        return async_wrapper
+
+    def guarded(req: func.HttpRequest, *args, **kwargs):
         try:
-            req_body = req.get_json()
-            email = req_body.get('email')
-            if not email:
-                return func.HttpResponse(
-                    json.dumps({
-                        "error": "Email is required",
-                        "error_code": "missing_email"
-                    }),
-                    mimetype="application/json",
-                    status_code=400
-                )
+            req_body, error_response = _parse_body(req)
+            if error_response:
+                return error_response
+            email = req_body['email']
             db_client = CosmosDBClient()
-            
-            query = """
-            SELECT * FROM c 
-            WHERE c.type = 'transaction' 
-            AND c.user_id = @user_id 
-            AND c.transaction_type = 'weekly_billing'
-            AND c.status = 'pending'
-            """
-            parameters = [{"name": "@user_id", "value": email}]
-            
-            pending_transactions = list(db_client.transaction_container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
-            if pending_transactions:
-                return func.HttpResponse(
-                    json.dumps({
-                        "error": "Payment required to access this feature",
-                        "error_code": "payment_required",
-                        "requires_subscription": True
-                    }),
-                    mimetype="application/json",
-                    status_code=402
-                )
+
+            with span('access_check'), operation('check_payment_access'):
+                payment_setup = db_client.get_payment_setup(email)
+                payment_is_required = payment_required(payment_setup) if payment_setup else None
+                if payment_is_required is None:
+                    payment_is_required = get_access_cache().payment_required(
+                        email,
+                        lambda email: db_client.has_pending_weekly_billing(email, payment_setup)
+                    )
+            if payment_is_required:
+                return _payment_required_response()
+            if accepts_context:
+                kwargs[REQUEST_CONTEXT_PARAMETER] = RequestContext(req, req_body, db_client, payment_setup)
             return func_to_wrap(req, *args, **kwargs)
         except Exception as e:
-            logging.error(f'Error in payment middleware: {str(e)}')
-            return func.HttpResponse(
-                json.dumps({
-                    "error": "An unexpected error occurred",
-                    "error_code": "server_error"
-                }),
-                mimetype="application/json",
-                status_code=500
-            )
-    return wrapper
\ No newline at end of file
+            return _server_error_response(e)
+
+    @wraps(func_to_wrap)
+    def wrapper(req: func.HttpRequest, *args, **kwargs):
+        return attach_server_timing(guarded(req, *args, **kwargs))
+
+    if accepts_context:
+        _hide_parameter(wrapper, func_to_wrap, REQUEST_CONTEXT_PARAMETER)
+    return wrapper
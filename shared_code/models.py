@@ -41,8 +41,9 @@ class PaymentSetup(BaseModel):
         pending_fee: int = 0,
         monthly_usage: float = 0,
         payment_methods: List[str] = None,
+        card_summaries: List[Dict] = None,
     ):
-        self.id = f"payment_{email}"
+        self.id = self.document_id(email)
         self.user_id = email
         self.type = "payment_setup"
         self.email = email
@@ -57,6 +58,13 @@ class PaymentSetup(BaseModel):
         self.updated_at = self.created_at
         self.monthly_usage = monthly_usage
         self.payment_methods = payment_methods or []
+        self.card_summaries = card_summaries or []
+        self.pending_billing_count = 0
+        self.pending_billing_amount = 0
+
+    @staticmethod
+    def document_id(email: str) -> str:
+        return f"payment_{email}"
 
 class Location(BaseModel):
     def __init__(self, user_id: str, name: str, address: str):
@@ -84,9 +92,10 @@ class Transaction(BaseModel):
         location_id: Optional[str] = None,
         tokens: int = 0,
         status: str = 'pending',
-        stripe_session_id: Optional[str] = None
+        stripe_session_id: Optional[str] = None,
+        transaction_id: Optional[str] = None
     ):
-        self.id = f"trans_{datetime.utcnow().timestamp()}"
+        self.id = transaction_id or f"trans_{datetime.utcnow().timestamp()}"
         self.user_id = user_id
         self.type = "transaction"
         self.amount = amount
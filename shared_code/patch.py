@@ -0,0 +1,70 @@
+# shared_code/patch.py
+import json
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+# Cosmos DB rejects patch requests with more operations than this
+MAX_PATCH_OPERATIONS = 10
+
+
+def _path(field: str) -> str:
+    return field if field.startswith('/') else f"/{field}"
+
+
+class Patch:
+    """Builder for Cosmos DB partial document updates.
+
+    Fields are top-level property names or JSON paths ('/a/b'). Operations
+    run atomically on the server, so incr() needs no preceding read. A
+    where() condition makes the whole patch conditional, and several must
+    all hold; when they do not match, the write fails with
+    CosmosAccessConditionFailedError.
+    """
+
+    def __init__(self):
+        self.operations: List[Dict[str, Any]] = []
+        self.condition: Optional[str] = None
+
+    def where(self, condition: str) -> 'Patch':
+        """SQL condition over the document aliased as c, with literal values"""
+        self.condition = f"({self.condition}) AND ({condition})" if self.condition else condition
+        return self
+
+    def where_not(self, field: str, value: Any) -> 'Patch':
+        """Apply only if the field is missing or differs from value, e.g. a run marker"""
+        return self.where(f"NOT IS_DEFINED(c.{field}) OR c.{field} != {json.dumps(value)}")
+
+    @property
+    def filter_predicate(self) -> Optional[str]:
+        return f"FROM c WHERE {self.condition}" if self.condition else None
+
+    def set(self, field: str, value: Any) -> 'Patch':
+        self.operations.append({'op': 'set', 'path': _path(field), 'value': value})
+        return self
+
+    def set_fields(self, fields: Dict[str, Any]) -> 'Patch':
+        for field, value in fields.items():
+            self.set(field, value)
+        return self
+
+    def incr(self, field: str, value: float) -> 'Patch':
+        self.operations.append({'op': 'incr', 'path': _path(field), 'value': value})
+        return self
+
+    def add(self, field: str, value: Any) -> 'Patch':
+        """Add a property, or insert into an array ('/items/-' appends)"""
+        self.operations.append({'op': 'add', 'path': _path(field), 'value': value})
+        return self
+
+    def remove(self, field: str) -> 'Patch':
+        self.operations.append({'op': 'remove', 'path': _path(field)})
+        return self
+
+    def touch(self) -> 'Patch':
+        """Stamp updated_at unless the patch already sets it"""
+        if not any(operation['path'] == '/updated_at' for operation in self.operations):
+            self.set('updated_at', datetime.now(timezone.utc).isoformat())
+        return self
+
+    def __len__(self):
+        return len(self.operations)
@@ -0,0 +1,94 @@
+# shared_code/pending_billing.py
+import logging
+from collections import defaultdict
+from typing import Dict, Optional
+import azure.cosmos.exceptions as exceptions
+from .patch import Patch
+from .query import Query
+
+# Denormalized on payment_setup: number and total amount (in the
+# transactions' units, cents) of the user's pending weekly_billing
+# transactions, so the access check is a point read
+PENDING_BILLING_COUNT = 'pending_billing_count'
+PENDING_BILLING_AMOUNT = 'pending_billing_amount'
+
+TRANSACTION_TYPE_WEEKLY_BILLING = 'weekly_billing'
+TRANSACTION_STATUS_PENDING = 'pending'
+
+
+def is_pending_weekly_billing(transaction: Optional[Dict]) -> bool:
+    return (
+        bool(transaction)
+        and transaction.get('transaction_type') == TRANSACTION_TYPE_WEEKLY_BILLING
+        and transaction.get('status') == TRANSACTION_STATUS_PENDING
+    )
+
+
+def pending_billing_patch(count: int, amount: float) -> Patch:
+    """Patch that moves the pending counters by count and amount"""
+    return Patch().incr(PENDING_BILLING_COUNT, count).incr(PENDING_BILLING_AMOUNT, amount)
+
+
+def payment_required(payment_setup: Dict) -> Optional[bool]:
+    """Access decision from the counters, None if the setup predates them"""
+    if PENDING_BILLING_COUNT not in payment_setup:
+        return None
+    return payment_setup[PENDING_BILLING_COUNT] > 0
+
+
+async def reconcile_pending_billing(db_client) -> Dict:
+    """Rebuild the pending counters of every payment_setup from the transaction log.
+
+    Payment setups are read (projected to the counters) before the
+    transactions, and each correction is conditioned on the counters read,
+    so a transaction written while this runs makes the correction fail
+    instead of being overwritten; the next run picks the user up.
+    """
+    current = {}
+    setup_query = Query('payment_setup').select('id', 'user_id', PENDING_BILLING_COUNT, PENDING_BILLING_AMOUNT)
+    async for page in db_client.iter_payment_setup_pages(setup_query):
+        for payment_setup in page:
+            current[payment_setup['user_id']] = payment_setup
+
+    expected = defaultdict(lambda: {'count': 0, 'amount': 0})
+    transaction_query = (
+        Query('transaction')
+        .select('user_id', 'amount')
+        .where('transaction_type', TRANSACTION_TYPE_WEEKLY_BILLING)
+        .where('status', TRANSACTION_STATUS_PENDING)
+    )
+    async for page in db_client.iter_transaction_pages(transaction_query):
+        for transaction in page:
+            expected[transaction['user_id']]['count'] += 1
+            expected[transaction['user_id']]['amount'] += transaction.get('amount', 0)
+
+    summary = {'users': len(current), 'corrected': 0, 'skipped': 0, 'failed': 0}
+    for user_id, payment_setup in current.items():
+        count = expected[user_id]['count']
+        amount = expected[user_id]['amount']
+        if payment_setup.get(PENDING_BILLING_COUNT) == count and payment_setup.get(PENDING_BILLING_AMOUNT) == amount:
+            continue
+
+        patch = Patch().set_fields({PENDING_BILLING_COUNT: count, PENDING_BILLING_AMOUNT: amount})
+        if PENDING_BILLING_COUNT in payment_setup:
+            patch.where(
+                f"c.{PENDING_BILLING_COUNT} = {payment_setup[PENDING_BILLING_COUNT]} "
+                f"AND c.{PENDING_BILLING_AMOUNT} = {payment_setup.get(PENDING_BILLING_AMOUNT, 0)}"
+            )
+        else:
+            patch.where(f"NOT IS_DEFINED(c.{PENDING_BILLING_COUNT})")
+
+        try:
+            await db_client.patch_payment_setup(user_id, patch)
+            summary['corrected'] += 1
+            logging.info(
+                f"Pending billing of {user_id} corrected from "
+                f"{payment_setup.get(PENDING_BILLING_COUNT)}/{payment_setup.get(PENDING_BILLING_AMOUNT)} to {count}/{amount}"
+            )
+        except (exceptions.CosmosAccessConditionFailedError, exceptions.CosmosResourceNotFoundError):
+            summary['skipped'] += 1
+        except Exception as e:
+            logging.error(f"Error reconciling pending billing of {user_id}: {str(e)}")
+            summary['failed'] += 1
+
+    return summary
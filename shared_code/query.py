@@ -0,0 +1,100 @@
+# shared_code/query.py
+from typing import Any, Dict, List, Optional, Tuple
+
+COMPARISON_OPERATORS = ('=', '!=', '<', '<=', '>', '>=')
+
+
+def _field(field: str) -> str:
+    return f"c.{field}"
+
+
+class Query:
+    """Builder for parameterized Cosmos DB SQL queries over one document type.
+
+    select() projects the listed fields instead of SELECT *. count(),
+    exists() and sum() turn the query into a single value; run those with
+    the client's query_value, which returns 0 (False for exists) when
+    nothing matches.
+    """
+
+    def __init__(self, document_type: Optional[str] = None):
+        self.fields: List[str] = []
+        self.conditions: List[str] = []
+        self.parameters: List[Dict[str, Any]] = []
+        self.order: Optional[str] = None
+        self.top: Optional[int] = None
+        self.value: Optional[str] = None
+        self.default: Any = None
+        if document_type:
+            self.where('type', document_type)
+
+    def _parameter(self, value: Any) -> str:
+        name = f"@p{len(self.parameters)}"
+        self.parameters.append({'name': name, 'value': value})
+        return name
+
+    def select(self, *fields: str) -> 'Query':
+        self.fields.extend(fields)
+        return self
+
+    def where(self, field: str, value: Any, operator: str = '=') -> 'Query':
+        if operator not in COMPARISON_OPERATORS:
+            raise ValueError(f"Unsupported operator {operator}")
+        self.conditions.append(f"{_field(field)} {operator} {self._parameter(value)}")
+        return self
+
+    def where_not(self, field: str, value: Any) -> 'Query':
+        """Match documents where the field is missing or differs from value"""
+        self.conditions.append(f"(NOT IS_DEFINED({_field(field)}) OR {_field(field)} != {self._parameter(value)})")
+        return self
+
+    def where_undefined_or(self, field: str, value: Any, operator: str = '=') -> 'Query':
+        """Match documents where the field is missing or compares to value"""
+        if operator not in COMPARISON_OPERATORS:
+            raise ValueError(f"Unsupported operator {operator}")
+        self.conditions.append(f"(NOT IS_DEFINED({_field(field)}) OR {_field(field)} {operator} {self._parameter(value)})")
+        return self
+
+    def where_in(self, field: str, values: List[Any]) -> 'Query':
+        self.conditions.append(f"ARRAY_CONTAINS({self._parameter(list(values))}, {_field(field)})")
+        return self
+
+    def order_by(self, field: str, descending: bool = False) -> 'Query':
+        self.order = f"{_field(field)} {'DESC' if descending else 'ASC'}"
+        return self
+
+    def limit(self, count: int) -> 'Query':
+        self.top = count
+        return self
+
+    def count(self) -> 'Query':
+        self.value, self.default = 'COUNT(1)', 0
+        return self
+
+    def exists(self) -> 'Query':
+        """Stop at the first match instead of reading or counting every one"""
+        self.value, self.default, self.top = 'true', False, 1
+        return self
+
+    def sum(self, field: str) -> 'Query':
+        self.value, self.default = f"SUM({_field(field)})", 0
+        return self
+
+    def build(self) -> Tuple[str, List[Dict[str, Any]]]:
+        """SQL text and parameters for query_items"""
+        select = 'SELECT'
+        if self.top is not None:
+            select += f" TOP {int(self.top)}"
+        if self.value:
+            select += f" VALUE {self.value}"
+        elif self.fields:
+            select += ' ' + ', '.join(_field(field) for field in self.fields)
+        else:
+            select += ' *'
+
+        sql = f"{select} FROM c"
+        if self.conditions:
+            sql += ' WHERE ' + ' AND '.join(self.conditions)
+        if self.order and not self.value:
+            sql += f" ORDER BY {self.order}"
+        return sql, list(self.parameters)
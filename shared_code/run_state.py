@@ -0,0 +1,254 @@
+# shared_code/run_state.py
+import os
+import time
+import logging
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional
+from .async_db_client import AsyncCosmosDBClient
+from .query import Query
+from .constants import (
+    RUN_CHECKPOINT_BATCH_SIZE,
+    RUN_TIME_BUDGET_SECONDS,
+    RUN_STATE_TTL_SECONDS
+)
+
+RUN_STATUS_RUNNING = 'running'
+RUN_STATUS_COMPLETED = 'completed'
+
+
+def hourly_tick(now: Optional[datetime] = None) -> str:
+    now = now or datetime.now(timezone.utc)
+    return now.strftime('%Y-%m-%dT%H')
+
+
+def weekly_tick(now: Optional[datetime] = None) -> str:
+    now = now or datetime.now(timezone.utc)
+    return now.strftime('%G-W%V')
+
+
+def monthly_tick(now: Optional[datetime] = None) -> str:
+    now = now or datetime.now(timezone.utc)
+    return now.strftime('%Y-%m')
+
+
+class RunState:
+    """Progress of one job invocation for one schedule tick.
+
+    Users are processed in user_id order in batches; after each batch the
+    last user_id and the counts are saved, so a restarted run resumes after
+    the last finished batch instead of starting over. Jobs either batch an
+    in-memory list of user ids with batches(), or stream pages of a query
+    ordered by user_id (see resume_query) through stream().
+
+    With a lease, record_batch renews it once half its duration has passed,
+    and batches() and stream() stop early, like on a spent time budget, if
+    another instance took it over.
+    """
+
+    def __init__(
+        self,
+        db_client: AsyncCosmosDBClient,
+        job: str,
+        tick_id: str,
+        shard: Optional[int] = None,
+        started: Optional[float] = None,
+        lease=None
+    ):
+        self.db_client = db_client
+        self.job = job
+        self.tick_id = tick_id
+        self.shard = shard
+        self.id = f"run_{job}_{tick_id}" if shard is None else f"run_{job}_{tick_id}_{shard}"
+        self.document = None
+        self.finished = False
+        self.batch_size = int(os.getenv('RUN_CHECKPOINT_BATCH_SIZE', RUN_CHECKPOINT_BATCH_SIZE))
+        self.time_budget = float(os.getenv('RUN_TIME_BUDGET_SECONDS', RUN_TIME_BUDGET_SECONDS))
+        # Shards processed in one invocation share its time budget
+        self._started = started or time.monotonic()
+        self.lease = lease
+        self.lease_lost = False
+
+    async def load(self) -> 'RunState':
+        self.document = await self.db_client.get_system_document(self.id)
+        if self.document:
+            logging.info(
+                f"Resuming {self.job} tick {self.tick_id} after user {self.document.get('last_user_id')} "
+                f"({self.document['counts']})"
+            )
+        else:
+            now = datetime.now(timezone.utc).isoformat()
+            self.document = {
+                'id': self.id,
+                'type': 'run_state',
+                'job': self.job,
+                'tick_id': self.tick_id,
+                'shard': self.shard,
+                'status': RUN_STATUS_RUNNING,
+                'last_user_id': None,
+                'counts': {'processed': 0, 'failed': 0},
+                'failed_users': [],
+                'invocations': 0,
+                'started_at': now,
+                'ttl': RUN_STATE_TTL_SECONDS
+            }
+        self.document['invocations'] = self.document.get('invocations', 0) + 1
+        return self
+
+    @property
+    def completed(self) -> bool:
+        return self.document['status'] == RUN_STATUS_COMPLETED
+
+    @property
+    def cursor(self) -> Optional[str]:
+        return self.document.get('last_user_id')
+
+    def resume_query(self, query: Query) -> Query:
+        """Order a query by user_id and skip the users finished by earlier invocations"""
+        if self.cursor is not None:
+            query.where('user_id', self.cursor, '>')
+        return query.order_by('user_id')
+
+    def _budget_spent(self) -> bool:
+        return time.monotonic() - self._started > self.time_budget
+
+    def _should_stop(self) -> bool:
+        if self.lease_lost:
+            logging.warning(
+                f"{self.job} tick {self.tick_id}: lease lost after user {self.cursor}; "
+                f"stopping so the new holder runs the rest alone"
+            )
+            return True
+        return False
+
+    async def _renew_lease(self):
+        if self.lease is not None and self.lease.renewal_due and not await self.lease.renew():
+            self.lease_lost = True
+
+    async def stream(self, pages: AsyncIterator) -> AsyncIterator:
+        """Yield pages until the stream ends, which sets finished, or the time budget is spent.
+
+        Like batches(), the first page is always yielded.
+        """
+        first = True
+        async for page in pages:
+            if not first and self._should_stop():
+                return
+            if not first and self._budget_spent():
+                logging.warning(
+                    f"{self.job} tick {self.tick_id}: time budget spent after user "
+                    f"{self.cursor}; the next invocation resumes here"
+                )
+                return
+            first = False
+            yield page
+        self.finished = True
+
+    def remaining(self, user_ids: List[str]) -> List[str]:
+        """Sorted user ids that come after the saved cursor"""
+        cursor = self.document.get('last_user_id')
+        return sorted(user_id for user_id in set(user_ids) if cursor is None or user_id > cursor)
+
+    def batches(self, user_ids: List[str]):
+        """Yield batches of remaining users until done or the time budget is spent.
+
+        The first batch is always yielded, so every invocation makes progress.
+        """
+        remaining = self.remaining(user_ids)
+        for start in range(0, len(remaining), self.batch_size):
+            if start > 0 and self._should_stop():
+                return
+            if start > 0 and self._budget_spent():
+                logging.warning(
+                    f"{self.job} tick {self.tick_id}: time budget spent with "
+                    f"{len(remaining) - start} users left; the next invocation resumes here"
+                )
+                return
+            yield remaining[start:start + self.batch_size]
+
+    async def record_batch(self, user_ids: List[str], results: List, cursor: Optional[str] = None):
+        """Advance the cursor past a finished batch and save progress.
+
+        cursor overrides the batch's last user id, e.g. with the last user of
+        a streamed page whose other users belong to other shards.
+        """
+        failed = [
+            user_id for user_id, result in zip(user_ids, results)
+            if isinstance(result, Exception) or (isinstance(result, dict) and not result.get('success', True))
+        ]
+        self.document['last_user_id'] = cursor or user_ids[-1]
+        self.document['counts']['processed'] += len(user_ids) - len(failed)
+        self.document['counts']['failed'] += len(failed)
+        self.document['failed_users'] = (self.document.get('failed_users', []) + failed)[-100:]
+        await self.save()
+        await self._renew_lease()
+
+    async def start_retry_pass(self, max_passes: int) -> bool:
+        """Rewind a finished run for another pass if users failed and passes are left.
+
+        The job must skip users an earlier pass handled, e.g. by a per-tick
+        stamp, so only the failed ones are done again. Returns True when the
+        run was rewound and should be requeued rather than completed.
+        """
+        failed = self.document['counts']['failed']
+        passes = self.document.get('passes', 1)
+        if not failed:
+            return False
+        if passes >= max_passes:
+            logging.error(f"{self.job} tick {self.tick_id}: giving up on {failed} users after {passes} passes")
+            return False
+
+        logging.warning(f"{self.job} tick {self.tick_id}: {failed} users failed; starting pass {passes + 1}")
+        self.document.update({'last_user_id': None, 'passes': passes + 1})
+        self.document['counts']['failed'] = 0
+        self.finished = False
+        await self.save()
+        return True
+
+    async def complete(self, summary: Optional[Dict] = None):
+        self.document['status'] = RUN_STATUS_COMPLETED
+        self.document['completed_at'] = datetime.now(timezone.utc).isoformat()
+        if summary:
+            self.document['summary'] = summary
+        await self.save()
+
+    async def save(self):
+        self.document['updated_at'] = datetime.now(timezone.utc).isoformat()
+        self.document = await self.db_client.upsert_system_document(self.document)
+
+
+async def group_by_user(pages: AsyncIterator[List[Dict]]) -> AsyncIterator[Dict[str, List[Dict]]]:
+    """Regroup pages of documents ordered by user_id into {user_id: documents} chunks.
+
+    A user whose documents straddle a page boundary is held back until the
+    next page, so no chunk holds only part of a user's documents.
+    """
+    pending = {}
+    async for page in pages:
+        for document in page:
+            pending.setdefault(document['user_id'], []).append(document)
+        last_user_id = page[-1]['user_id']
+        chunk = {user_id: documents for user_id, documents in pending.items() if user_id != last_user_id}
+        pending = {last_user_id: pending[last_user_id]}
+        if chunk:
+            yield chunk
+    if pending:
+        yield pending
+
+
+async def find_unfinished_ticks(db_client: AsyncCosmosDBClient, job: str) -> List[str]:
+    """Ticks of a job whose run state is still open, oldest first"""
+    query = (
+        "SELECT VALUE c.tick_id FROM c WHERE c.type = 'run_state' "
+        "AND c.job = @job AND c.status = @status"
+    )
+    parameters = [
+        {"name": "@job", "value": job},
+        {"name": "@status", "value": RUN_STATUS_RUNNING}
+    ]
+    return sorted(set(await db_client.query_system_documents(query, parameters)))
+
+
+async def ticks_to_run(db_client: AsyncCosmosDBClient, job: str, current_tick: str) -> List[str]:
+    """Unfinished earlier ticks followed by the current one"""
+    ticks = [tick for tick in await find_unfinished_ticks(db_client, job) if tick < current_tick]
+    return ticks + [current_tick]
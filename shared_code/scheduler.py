@@ -0,0 +1,149 @@
+# shared_code/scheduler.py
+import os
+import time
+import asyncio
+import logging
+from azure.cosmos.exceptions import CosmosHttpResponseError
+from .concurrency import get_conflict_stats
+from .constants import (
+    BATCH_MAX_CONCURRENCY,
+    BATCH_MIN_CONCURRENCY,
+    MAX_RETRIES,
+    RETRY_DELAY
+)
+
+THROTTLE_STATUS_CODE = 429
+
+
+def get_retry_after(error: Exception):
+    """Seconds to back off for a throttled request, or None if the error is not a throttle"""
+    if not isinstance(error, CosmosHttpResponseError) or error.status_code != THROTTLE_STATUS_CODE:
+        return None
+
+    headers = error.headers or {}
+    retry_after_ms = headers.get('x-ms-retry-after-ms')
+    if retry_after_ms is not None:
+        return float(retry_after_ms) / 1000
+    retry_after = headers.get('Retry-After')
+    if retry_after is not None:
+        return float(retry_after)
+    return RETRY_DELAY.total_seconds()
+
+
+class AdaptiveLimiter:
+    """Concurrency limit that halves on throttling and grows back by one per window of successes"""
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._successes = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    async def on_success(self):
+        async with self._condition:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+    async def on_throttle(self):
+        async with self._condition:
+            self.limit = max(self.minimum, self.limit // 2)
+            self._successes = 0
+
+
+class TaskScheduler:
+    """Runs one coroutine per item with bounded, throttle-aware concurrency"""
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int = None,
+        min_concurrency: int = None,
+        max_throttle_retries: int = MAX_RETRIES
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency or int(os.getenv('BATCH_MAX_CONCURRENCY', BATCH_MAX_CONCURRENCY))
+        self.min_concurrency = min(min_concurrency or BATCH_MIN_CONCURRENCY, self.max_concurrency)
+        self.max_throttle_retries = max_throttle_retries
+        self.limiter = None
+        self.stats = {
+            'job': name,
+            'items': 0,
+            'completed': 0,
+            'failed': 0,
+            'throttled': 0,
+            'elapsed_seconds': 0
+        }
+
+    async def _run_one(self, limiter: AdaptiveLimiter, job, item):
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            try:
+                result = await job(item)
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if retry_after is None or attempt >= self.max_throttle_retries:
+                    self.stats['failed'] += 1
+                    raise
+                self.stats['throttled'] += 1
+                attempt += 1
+                await limiter.on_throttle()
+            else:
+                self.stats['completed'] += 1
+                await limiter.on_success()
+                return result
+            finally:
+                await limiter.release()
+
+            logging.warning(
+                f"{self.name}: throttled, retrying in {retry_after:.2f}s "
+                f"(attempt {attempt}, concurrency {limiter.limit})"
+            )
+            await asyncio.sleep(retry_after)
+
+    async def run(self, items, job, return_exceptions: bool = False) -> list:
+        """Apply job to every item, returning results in item order like asyncio.gather.
+
+        Stats and the learned concurrency carry over between calls, so a job
+        can run its items in several batches through one scheduler.
+        """
+        items = list(items)
+        if self.limiter is None:
+            self.limiter = AdaptiveLimiter(self.max_concurrency, self.min_concurrency, self.max_concurrency)
+        started = time.monotonic()
+
+        results = await asyncio.gather(
+            *[self._run_one(self.limiter, job, item) for item in items],
+            return_exceptions=True
+        )
+
+        total_items = self.stats['items'] + len(items)
+        elapsed = self.stats['elapsed_seconds'] + time.monotonic() - started
+        self.stats.update({
+            'items': total_items,
+            'elapsed_seconds': round(elapsed, 3),
+            'items_per_second': round(total_items / elapsed, 2) if elapsed > 0 else None,
+            'final_concurrency': self.limiter.limit
+        })
+        logging.info(f"Scheduler stats: {self.stats}, write conflicts: {get_conflict_stats()}")
+
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
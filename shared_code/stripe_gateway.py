@@ -0,0 +1,252 @@
+# shared_code/stripe_gateway.py
+import json
+import math
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+import stripe
+import azure.functions as func
+from . import clients
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+from .telemetry import register_metrics
+from .constants import (
+    STRIPE_MAX_WORKERS,
+    STRIPE_MAX_IN_FLIGHT,
+    STRIPE_CALL_DEADLINE_SECONDS,
+    STRIPE_BREAKER_FAILURE_THRESHOLD,
+    STRIPE_BREAKER_RESET_SECONDS
+)
+
+REASON_CIRCUIT_OPEN = 'circuit_open'
+REASON_BULKHEAD_FULL = 'bulkhead_full'
+REASON_DEADLINE_EXCEEDED = 'deadline_exceeded'
+
+# Confirmed charges and other state-changing calls, like attaching or
+# detaching a card, wait out the HTTP timeout instead of the fail-fast
+# deadline: a caller told to retry while the call can still succeed in the
+# pool would pay twice, or find the change already made and fail
+CHARGE_DEADLINE_SECONDS = clients.STRIPE_TIMEOUT + 5
+
+
+class StripeUnavailable(Exception):
+    """Stripe was not called, or not waited for: the circuit is open, the bulkhead is full or the deadline passed"""
+
+    def __init__(self, message: str, reason: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class StripeDeadlineExceeded(StripeUnavailable, TimeoutError):
+    """A Stripe call did not finish within its deadline"""
+
+    def __init__(self, message: str):
+        super().__init__(message, REASON_DEADLINE_EXCEEDED)
+
+
+def is_outage(error: BaseException) -> bool:
+    """Failures that say Stripe is unhealthy, as opposed to declines or bad requests"""
+    if isinstance(error, (StripeDeadlineExceeded, stripe.error.APIConnectionError, stripe.error.RateLimitError)):
+        return True
+    return isinstance(error, stripe.error.APIError) and (error.http_status or 500) >= 500
+
+
+def stripe_unavailable_response(error: StripeUnavailable) -> func.HttpResponse:
+    """503 for payment endpoints that fail fast while Stripe is unhealthy"""
+    logging.error(f"Stripe unavailable: {str(error)}")
+    headers = {'Retry-After': str(math.ceil(error.retry_after))} if error.retry_after else None
+    return func.HttpResponse(
+        json.dumps({
+            "error": "Payment provider is temporarily unavailable. Please try again shortly.",
+            "error_code": "stripe_unavailable",
+            "reason": error.reason
+        }),
+        mimetype="application/json",
+        status_code=503,
+        headers=headers
+    )
+
+
+class StripeGateway:
+    """Runs blocking stripe-python calls on a bounded thread pool with per-call deadlines.
+
+    All calls share the stripe module's keep-alive HTTP client set up by
+    clients.configure_stripe. A deadline stops the caller waiting, not the
+    worker: a timed-out request keeps its thread until the HTTP timeout
+    (STRIPE_TIMEOUT_SECONDS) ends it, so the pool bounds how many can pile up.
+    Calls run in a copy of the caller's context, so their stripe spans land
+    in the caller's invocation.
+
+    Two guards make callers fail fast with StripeUnavailable while Stripe is
+    unhealthy, instead of piling up behind it. The bulkhead caps calls in
+    flight, queued or running, timed out or not, at max_in_flight. The
+    circuit breaker opens after a run of outage failures (see is_outage)
+    and lets a single probe through once it has cooled down.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = STRIPE_MAX_WORKERS,
+        deadline: float = STRIPE_CALL_DEADLINE_SECONDS,
+        max_in_flight: int = STRIPE_MAX_IN_FLIGHT,
+        breaker: Optional[CircuitBreaker] = None
+    ):
+        self.max_workers = max_workers
+        self.deadline = deadline
+        self.max_in_flight = max_in_flight
+        self.breaker = breaker or CircuitBreaker('stripe', STRIPE_BREAKER_FAILURE_THRESHOLD, STRIPE_BREAKER_RESET_SECONDS)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.in_flight = 0
+        self.stats = {'calls': 0, 'failed': 0, 'timed_out': 0, REASON_CIRCUIT_OPEN: 0, REASON_BULKHEAD_FULL: 0}
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    clients.configure_stripe()
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='stripe')
+        return self._executor
+
+    def _submit(self, fn: Callable, *args, **kwargs):
+        """Submit a call through the bulkhead and the breaker, or raise StripeUnavailable"""
+        if not self._in_flight.acquire(blocking=False):
+            self.stats[REASON_BULKHEAD_FULL] += 1
+            raise StripeUnavailable(f"{self.max_in_flight} Stripe calls already in flight", REASON_BULKHEAD_FULL)
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError as e:
+            self._in_flight.release()
+            self.stats[REASON_CIRCUIT_OPEN] += 1
+            raise StripeUnavailable(str(e), REASON_CIRCUIT_OPEN, e.retry_after)
+
+        with self._lock:
+            self.stats['calls'] += 1
+            self.in_flight += 1
+        future = self.executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+        future.timed_out = False
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self.in_flight -= 1
+        self._in_flight.release()
+        # A timed-out call was already reported as a failure
+        if future.cancelled() or future.timed_out:
+            return
+        error = future.exception()
+        if error is not None and is_outage(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def _timed_out(self, future, name: str, deadline: float) -> StripeDeadlineExceeded:
+        future.timed_out = True
+        future.cancel()
+        self.breaker.record_failure()
+        self.stats['timed_out'] += 1
+        logging.error(f"Stripe call {name} exceeded its {deadline}s deadline")
+        return StripeDeadlineExceeded(f"Stripe call {name} exceeded its {deadline}s deadline")
+
+    def _submit_all(self, fn: Callable, items: Iterable[Hashable]) -> Tuple[Dict, Dict]:
+        futures, rejected = {}, {}
+        for item in dict.fromkeys(items):
+            try:
+                futures[item] = self._submit(fn, item)
+            except StripeUnavailable as e:
+                rejected[item] = e
+        return futures, rejected
+
+    def _collect(self, fn: Callable, futures: Dict, rejected: Dict, deadline: float) -> Tuple[Dict, Dict]:
+        results, errors = {}, dict(rejected)
+        for item, future in futures.items():
+            if not future.done():
+                errors[item] = self._timed_out(future, f"{getattr(fn, '__qualname__', fn)}({item})", deadline)
+            elif future.exception() is not None:
+                self.stats['failed'] += 1
+                errors[item] = future.exception()
+            else:
+                results[item] = future.result()
+        return results, errors
+
+    def call(self, fn: Callable, *args, deadline: Optional[float] = None, **kwargs) -> Any:
+        """Run fn(*args, **kwargs) on the pool, raising StripeUnavailable if rejected or past the deadline"""
+        deadline = deadline or self.deadline
+        future = self._submit(fn, *args, **kwargs)
+        done, _ = wait([future], timeout=deadline)
+        if not done:
+            raise self._timed_out(future, getattr(fn, '__qualname__', str(fn)), deadline)
+        try:
+            return future.result()
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+
+    def map(
+        self,
+        fn: Callable[[Any], Any],
+        items: Iterable[Hashable],
+        deadline: Optional[float] = None
+    ) -> Tuple[Dict[Hashable, Any], Dict[Hashable, Exception]]:
+        """Run fn(item) for every item concurrently under one shared deadline.
+
+        Returns the results of the calls that finished and the errors of the
+        ones that failed, were rejected or were still running at the
+        deadline, both keyed by item, so callers can use the partial results.
+        """
+        deadline = deadline or self.deadline
+        futures, rejected = self._submit_all(fn, items)
+        wait(futures.values(), timeout=deadline)
+        return self._collect(fn, futures, rejected, deadline)
+
+    async def call_async(self, fn: Callable, *args, deadline: Optional[float] = None, **kwargs) -> Any:
+        """call for coroutines: awaits the pooled call without blocking the event loop"""
+        deadline = deadline or self.deadline
+        future = self._submit(fn, *args, **kwargs)
+        try:
+            # shield keeps wait_for from cancelling the pooled future; _timed_out does that
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=deadline)
+        except asyncio.TimeoutError:
+            raise self._timed_out(future, getattr(fn, '__qualname__', str(fn)), deadline)
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+
+    async def map_async(
+        self,
+        fn: Callable[[Any], Any],
+        items: Iterable[Hashable],
+        deadline: Optional[float] = None
+    ) -> Tuple[Dict[Hashable, Any], Dict[Hashable, Exception]]:
+        """map for coroutines"""
+        deadline = deadline or self.deadline
+        futures, rejected = self._submit_all(fn, items)
+        if futures:
+            await asyncio.wait([asyncio.wrap_future(future) for future in futures.values()], timeout=deadline)
+        return self._collect(fn, futures, rejected, deadline)
+
+    def get_stats(self) -> Dict:
+        breaker = self.breaker.get_stats()
+        return {
+            **self.stats,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'max_workers': self.max_workers,
+            'deadline': self.deadline,
+            'breaker_state': breaker['state'],
+            'breaker': breaker
+        }
+
+
+_gateway = StripeGateway()
+register_metrics('stripe', _gateway.get_stats)
+
+
+def get_stripe_gateway() -> StripeGateway:
+    return _gateway
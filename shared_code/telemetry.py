@@ -0,0 +1,337 @@
+# shared_code/telemetry.py
+import json
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, List, Optional
+from .constants import SERVER_TIMING_ENABLED
+
+REQUEST_CHARGE_HEADER = 'x-ms-request-charge'
+SERVER_TIMING_HEADER = 'Server-Timing'
+
+# Span names for the outbound dependencies
+SPAN_COSMOS = 'cosmos'
+SPAN_STRIPE = 'stripe'
+SPAN_EVENTGRID = 'eventgrid'
+
+_invocation = contextvars.ContextVar('cosmos_invocation', default=None)
+_operation = contextvars.ContextVar('cosmos_operation', default=None)
+
+
+class TelemetrySink(ABC):
+    """Destination for per-invocation Cosmos usage summaries"""
+
+    @abstractmethod
+    def emit(self, summary: Dict):
+        ...
+
+
+class LoggingSink(TelemetrySink):
+    """Writes each summary as one JSON log line, queryable in Application Insights"""
+
+    def emit(self, summary: Dict):
+        logging.info(f"Invocation summary: {json.dumps(summary)}")
+
+
+class MemorySink(TelemetrySink):
+    """Keeps summaries in memory for tests and local runs"""
+
+    def __init__(self):
+        self.summaries: List[Dict] = []
+
+    def emit(self, summary: Dict):
+        self.summaries.append(summary)
+
+
+_sink: TelemetrySink = LoggingSink()
+
+
+def set_sink(sink: TelemetrySink):
+    global _sink
+    _sink = sink
+
+
+def get_sink() -> TelemetrySink:
+    return _sink
+
+
+# Worker-level gauges and counters, e.g. the Stripe gateway's breaker state,
+# snapshotted into every invocation summary under 'metrics'
+_metrics_providers: Dict[str, Callable[[], Dict]] = {}
+
+
+def register_metrics(name: str, provider: Callable[[], Dict]):
+    _metrics_providers[name] = provider
+
+
+def collect_metrics() -> Dict[str, Dict]:
+    metrics = {}
+    for name, provider in _metrics_providers.items():
+        try:
+            metrics[name] = provider()
+        except Exception as e:
+            logging.error(f"Error collecting {name} metrics: {str(e)}")
+    return metrics
+
+
+class Invocation:
+    """Cosmos operations and timed spans of one function invocation, aggregated by name"""
+
+    def __init__(self, function_name: str):
+        self.function_name = function_name
+        self.started = time.monotonic()
+        self.operations: Dict[str, Dict] = {}
+        self.timings: Dict[str, Dict] = {}
+        # Spans may finish on the Stripe gateway's worker threads
+        self._timings_lock = threading.Lock()
+
+    def add_timing(self, name: str, duration_ms: float):
+        with self._timings_lock:
+            entry = self.timings.setdefault(name, {'count': 0, 'duration_ms': 0.0})
+            entry['count'] += 1
+            entry['duration_ms'] += duration_ms
+
+    def record(
+        self,
+        operation: str,
+        request_charge: float,
+        latency_ms: float,
+        items: int = 0,
+        pages: int = 0,
+        error: bool = False
+    ):
+        entry = self.operations.setdefault(operation, {
+            'calls': 0,
+            'request_charge': 0.0,
+            'latency_ms': 0.0,
+            'items': 0,
+            'pages': 0,
+            'errors': 0
+        })
+        entry['calls'] += 1
+        entry['request_charge'] += request_charge
+        entry['latency_ms'] += latency_ms
+        entry['items'] += items
+        entry['pages'] += pages
+        entry['errors'] += int(error)
+        if SERVER_TIMING_ENABLED:
+            self.add_timing(SPAN_COSMOS, latency_ms)
+
+    def summary(self) -> Dict:
+        operations = {
+            name: {key: round(value, 2) if isinstance(value, float) else value for key, value in entry.items()}
+            for name, entry in sorted(
+                self.operations.items(),
+                key=lambda item: item[1]['request_charge'],
+                reverse=True
+            )
+        }
+        summary = {
+            'function': self.function_name,
+            'duration_ms': self.elapsed_ms(),
+            'request_charge': round(sum(entry['request_charge'] for entry in self.operations.values()), 2),
+            'calls': sum(entry['calls'] for entry in self.operations.values()),
+            'operations': operations
+        }
+        if self.timings:
+            summary['timings'] = {
+                name: {'count': entry['count'], 'duration_ms': round(entry['duration_ms'], 2)}
+                for name, entry in self.timings.items()
+            }
+        metrics = collect_metrics()
+        if metrics:
+            summary['metrics'] = metrics
+        return summary
+
+    def elapsed_ms(self) -> float:
+        return round((time.monotonic() - self.started) * 1000, 2)
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: one metric per span name, then the total so far"""
+        metrics = [
+            f'{name};dur={entry["duration_ms"]:.1f};desc="{entry["count"]}x"'
+            for name, entry in self.timings.items()
+        ]
+        metrics.append(f'total;dur={self.elapsed_ms():.1f}')
+        return ', '.join(metrics)
+
+
+def current_invocation() -> Optional[Invocation]:
+    return _invocation.get()
+
+
+def _emit(invocation: Invocation):
+    try:
+        _sink.emit(invocation.summary())
+    except Exception as e:
+        logging.error(f"Error emitting Cosmos usage for {invocation.function_name}: {str(e)}")
+
+
+def track_invocation(function_name: str):
+    """Decorator for a function's main that emits its usage and timing summary when it returns or raises"""
+    def decorator(main):
+        if asyncio.iscoroutinefunction(main):
+            @wraps(main)
+            async def async_wrapper(*args, **kwargs):
+                invocation = Invocation(function_name)
+                token = _invocation.set(invocation)
+                try:
+                    return await main(*args, **kwargs)
+                finally:
+                    _invocation.reset(token)
+                    _emit(invocation)
+            return async_wrapper
+
+        @wraps(main)
+        def wrapper(*args, **kwargs):
+            invocation = Invocation(function_name)
+            token = _invocation.set(invocation)
+            try:
+                return main(*args, **kwargs)
+            finally:
+                _invocation.reset(token)
+                _emit(invocation)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def operation(name: str):
+    """Tag the Cosmos calls made inside the block with name instead of the container method"""
+    token = _operation.set(name)
+    try:
+        yield
+    finally:
+        _operation.reset(token)
+
+
+@contextmanager
+def span(name: str):
+    """Time the block and add it to the current invocation's timings under name.
+
+    A no-op outside an invocation or with SERVER_TIMING_ENABLED off. Spans
+    may nest or overlap; each name is summed on its own.
+    """
+    invocation = _invocation.get() if SERVER_TIMING_ENABLED else None
+    if invocation is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        invocation.add_timing(name, (time.monotonic() - started) * 1000)
+
+
+def attach_server_timing(response):
+    """Set the Server-Timing header of an HttpResponse from the current invocation's timings"""
+    invocation = _invocation.get()
+    if SERVER_TIMING_ENABLED and invocation is not None and response is not None:
+        response.headers[SERVER_TIMING_HEADER] = invocation.server_timing()
+    return response
+
+
+def _request_charge(headers) -> float:
+    try:
+        return float((headers or {}).get(REQUEST_CHARGE_HEADER, 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class _Call:
+    """Measures one container call; query pages are reported through the response hook"""
+
+    def __init__(self, container_id: str, method: str):
+        self.invocation = _invocation.get()
+        self.name = _operation.get() or f"{container_id}.{method}"
+        self.started = time.monotonic()
+
+    def _elapsed_ms(self) -> float:
+        now = time.monotonic()
+        elapsed = (now - self.started) * 1000
+        self.started = now
+        return elapsed
+
+    def done(self, headers, items: int):
+        if self.invocation:
+            self.invocation.record(self.name, _request_charge(headers), self._elapsed_ms(), items=items)
+
+    def failed(self, error: Exception):
+        if self.invocation:
+            headers = getattr(error, 'headers', None)
+            self.invocation.record(self.name, _request_charge(headers), self._elapsed_ms(), error=True)
+
+    def page_hook(self, headers, result):
+        # Called once per request with the raw response body, a dict such as
+        # {'Documents': [...], '_count': n} for a query page (cross-partition
+        # query plans come through here too, without Documents), and once
+        # when the pager is created with the pager itself, which is ignored.
+        # Page latency runs from the previous page, so it includes the
+        # caller's time between pages unless the results are read eagerly.
+        if self.invocation and isinstance(result, dict):
+            documents = result.get('Documents')
+            self.invocation.record(
+                self.name,
+                _request_charge(headers),
+                self._elapsed_ms(),
+                items=len(documents or []),
+                pages=int(documents is not None)
+            )
+
+
+POINT_OPERATIONS = ('read_item', 'create_item', 'upsert_item', 'replace_item', 'patch_item', 'delete_item')
+QUERY_OPERATIONS = ('query_items', 'query_items_change_feed', 'read_all_items')
+
+
+class InstrumentedContainer:
+    """Proxy for a sync ContainerProxy that records request charge and latency of every call"""
+
+    def __init__(self, container):
+        self._container = container
+
+    def __getattr__(self, name):
+        attribute = getattr(self._container, name)
+        if name in POINT_OPERATIONS:
+            return self._point(name, attribute)
+        if name in QUERY_OPERATIONS:
+            return self._query(name, attribute)
+        return attribute
+
+    def _point(self, method: str, call):
+        def instrumented(*args, **kwargs):
+            measured = _Call(self._container.id, method)
+            items = 0 if method == 'delete_item' else 1
+            try:
+                result = call(*args, response_hook=lambda headers, _: measured.done(headers, items), **kwargs)
+            except Exception as e:
+                measured.failed(e)
+                raise
+            return result
+        return instrumented
+
+    def _query(self, method: str, call):
+        def instrumented(*args, **kwargs):
+            measured = _Call(self._container.id, method)
+            return call(*args, response_hook=measured.page_hook, **kwargs)
+        return instrumented
+
+
+class AsyncInstrumentedContainer(InstrumentedContainer):
+    """InstrumentedContainer for azure.cosmos.aio containers, whose point operations are coroutines"""
+
+    def _point(self, method: str, call):
+        async def instrumented(*args, **kwargs):
+            measured = _Call(self._container.id, method)
+            items = 0 if method == 'delete_item' else 1
+            try:
+                result = await call(*args, response_hook=lambda headers, _: measured.done(headers, items), **kwargs)
+            except Exception as e:
+                measured.failed(e)
+                raise
+            return result
+        return instrumented
@@ -1,5 +1,7 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
 import logging
+from .constants import FEE_ACCRUAL_MODE, FEE_ACCRUAL_LAZY, QUERY_PAGE_SIZE
 
 def calculate_hourly_rate(monthly_fee: int) -> float:
     """Calculate hourly rate from monthly fee"""
@@ -16,6 +18,85 @@ def calculate_hours_since_last_update(last_update: str) -> float:
         logging.error(f"Error calculating hours: {str(e)}")
         return 1.0
 
+def parse_timestamp(value: str) -> datetime:
+    """Parse a stored ISO timestamp; naive values were written with utcnow()"""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+# Location fields read by the fee accrual helpers below
+FEE_ACCRUAL_FIELDS = [
+    'current_period_fee', 'monthly_fee', 'is_active',
+    'last_billing_update', 'created_at', 'deactivated_at'
+]
+
+def calculate_unbilled_fee(location: Dict, as_of: Optional[datetime] = None) -> float:
+    """Fee accrued since last_billing_update that has not been written to current_period_fee"""
+    try:
+        as_of = as_of or datetime.now(timezone.utc)
+        start = location.get('last_billing_update') or location.get('created_at')
+        if not start:
+            return 0
+
+        if location.get('is_active', False):
+            end = as_of
+        elif location.get('deactivated_at'):
+            end = min(parse_timestamp(location['deactivated_at']), as_of)
+        else:
+            return 0
+
+        hours = (end - parse_timestamp(start)).total_seconds() / 3600
+        return calculate_hourly_rate(location.get('monthly_fee', 0)) * max(hours, 0)
+    except Exception as e:
+        logging.error(f"Error calculating accrued fee for location {location.get('id')}: {str(e)}")
+        return 0
+
+def calculate_accrued_fee(location: Dict, as_of: Optional[datetime] = None) -> float:
+    """Current period fee of a location as of a point in time"""
+    return location.get('current_period_fee', 0) + calculate_unbilled_fee(location, as_of)
+
+def calculate_pending_fee(locations: List[Dict], as_of: Optional[datetime] = None) -> float:
+    """Pending fee of a user, i.e. what the hourly job would have stored by as_of"""
+    as_of = as_of or datetime.now(timezone.utc)
+    return sum(calculate_accrued_fee(location, as_of) for location in locations)
+
+def calculate_threshold_due_at(locations: List[Dict], threshold: float, as_of: Optional[datetime] = None) -> Optional[str]:
+    """When the user's lazily accrued pending fee will cross threshold, None if it already has or never will"""
+    as_of = as_of or datetime.now(timezone.utc)
+    remaining = threshold - calculate_pending_fee(locations, as_of)
+    hourly_rate = sum(
+        calculate_hourly_rate(location.get('monthly_fee', 0))
+        for location in locations if location.get('is_active', False)
+    )
+    if remaining < 0 or hourly_rate <= 0:
+        return None
+    return (as_of + timedelta(hours=remaining / hourly_rate)).isoformat()
+
+def get_pending_fee(payment_setup: Dict, locations: List[Dict], as_of: Optional[datetime] = None) -> float:
+    """Pending fee to show or charge; derived from the locations when fees accrue lazily"""
+    if FEE_ACCRUAL_MODE == FEE_ACCRUAL_LAZY:
+        return calculate_pending_fee(locations, as_of)
+    return payment_setup.get('pending_fee', 0)
+
+def settle_location_fee(location: Dict, as_of: Optional[datetime] = None) -> Dict:
+    """Write the accrued fee into the location before a state change is persisted"""
+    as_of = as_of or datetime.now(timezone.utc)
+    location['current_period_fee'] = calculate_accrued_fee(location, as_of)
+    location['last_billing_update'] = as_of.isoformat()
+    return location
+
+def get_page_params(req_body: Dict) -> Tuple[Optional[int], Optional[str]]:
+    """page_size and continuation_token of a paged request; both None when the caller wants everything"""
+    page_size = req_body.get('page_size')
+    continuation = req_body.get('continuation_token')
+    if page_size is None and continuation is None:
+        return None, None
+    page_size = int(page_size) if page_size is not None else QUERY_PAGE_SIZE
+    if page_size < 1:
+        raise ValueError("page_size must be positive")
+    return min(page_size, QUERY_PAGE_SIZE), continuation
+
 def should_notify_user(current_fee: float, threshold: float, last_notification_time: str = None) -> bool:
     """Determine if user should be notified based on threshold and last notification time"""
     if current_fee <= threshold:
@@ -0,0 +1,51 @@
+# shared_code/work_queue.py
+import json
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Dict, Optional
+from .constants import WORK_QUEUE_BACKEND, WORK_QUEUE_LOCAL, SHARD_QUEUE_NAME
+from . import clients
+
+class WorkQueue(ABC):
+    """Destination for shard work messages"""
+
+    @abstractmethod
+    async def send(self, message: Dict):
+        ...
+
+
+class StorageWorkQueue(WorkQueue):
+    """Azure Storage queue consumed by the billing-shard-worker function"""
+
+    def __init__(self, queue_name: str = SHARD_QUEUE_NAME):
+        self.queue_name = queue_name
+
+    async def send(self, message: Dict):
+        try:
+            queue_client = await clients.get_async_queue_client(self.queue_name)
+            await queue_client.send_message(json.dumps(message))
+        except Exception as e:
+            logging.error(f"Error sending message to queue {self.queue_name}: {str(e)}")
+            raise
+
+
+class LocalWorkQueue(WorkQueue):
+    """In-process queue for tests and local runs; messages are handled by drain"""
+
+    def __init__(self):
+        self.messages = deque()
+
+    async def send(self, message: Dict):
+        self.messages.append(message)
+
+    async def drain(self, handler):
+        """Handle queued messages, including ones sent while draining, until none are left"""
+        while self.messages:
+            await handler(self.messages.popleft())
+
+
+def get_work_queue(backend: Optional[str] = None) -> WorkQueue:
+    if (backend or WORK_QUEUE_BACKEND) == WORK_QUEUE_LOCAL:
+        return LocalWorkQueue()
+    return StorageWorkQueue()
@@ -0,0 +1,62 @@
+import azure.functions as func
+import json
+import logging
+import os
+import stripe
+from shared_code import clients
+from shared_code.async_db_client import AsyncCosmosDBClient
+from shared_code.credit_purchases import is_credit_purchase, settle_credit_purchase, fail_credit_purchase
+from shared_code.telemetry import track_invocation
+
+clients.configure_stripe()
+
+@track_invocation('stripe-webhook')
+async def main(req: func.HttpRequest) -> func.HttpResponse:
+    """Settles credit purchases from Stripe events; any non-2xx answer makes Stripe retry the event"""
+    try:
+        event = stripe.Webhook.construct_event(
+            req.get_body(),
+            req.headers.get('Stripe-Signature'),
+            os.getenv('STRIPE_WEBHOOK_SECRET')
+        )
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        logging.error(f"Rejected Stripe webhook: {str(e)}")
+        return func.HttpResponse(
+            json.dumps({"error": "Invalid webhook payload or signature"}),
+            mimetype="application/json",
+            status_code=400
+        )
+
+    try:
+        payment_intent = event['data']['object']
+        if event['type'] not in ('payment_intent.succeeded', 'payment_intent.payment_failed') or not is_credit_purchase(payment_intent):
+            return func.HttpResponse(
+                json.dumps({"status": "ignored", "event_type": event['type']}),
+                mimetype="application/json",
+                status_code=200
+            )
+
+        db_client = AsyncCosmosDBClient()
+        if event['type'] == 'payment_intent.succeeded':
+            updated_setup = await settle_credit_purchase(db_client, payment_intent)
+            logging.info(
+                f"Credit purchase {payment_intent['id']} "
+                f"{'settled' if updated_setup else 'was already settled'} (event {event['id']})"
+            )
+        else:
+            await fail_credit_purchase(db_client, payment_intent)
+            logging.info(f"Credit purchase {payment_intent['id']} failed (event {event['id']})")
+
+        return func.HttpResponse(
+            json.dumps({"status": "success", "event_type": event['type']}),
+            mimetype="application/json",
+            status_code=200
+        )
+
+    except Exception as e:
+        logging.error(f"Error handling Stripe event {event.get('id')}: {str(e)}")
+        return func.HttpResponse(
+            json.dumps({"error": "Failed to handle event"}),
+            mimetype="application/json",
+            status_code=500
+        )
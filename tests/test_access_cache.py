@@ -0,0 +1,14 @@
+import pytest
+from shared_code.access_cache import AccessCache, CacheBackend
+
+
+def test_backend_without_delete_fails_when_created():
+    class ReadThroughBackend(CacheBackend):
+        def get(self, key):
+            return None
+
+        def set(self, key, value, ttl):
+            pass
+
+    with pytest.raises(TypeError):
+        AccessCache(ReadThroughBackend())
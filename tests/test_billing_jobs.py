@@ -0,0 +1,177 @@
+import re
+import json
+import asyncio
+import copy
+import azure.cosmos.exceptions as exceptions
+from shared_code.billing_jobs import bill_hourly_shard, charge_weekly_shard, initialize_monthly_shard
+from shared_code.fee_update import calculate_hourly_fee
+from shared_code.lease import Shard
+
+TICK = '2026-W42'
+
+
+def apply_patch(document, patch):
+    # where_not markers are the only conditions the jobs rely on for reruns
+    for field, value in re.findall(r'c\.(\w+) != ("[^"]*")', patch.condition or ''):
+        if document.get(field) == json.loads(value):
+            raise exceptions.CosmosAccessConditionFailedError()
+    for operation in patch.operations:
+        field = operation['path'].lstrip('/')
+        if operation['op'] == 'incr':
+            document[field] = document.get(field, 0) + operation['value']
+        else:
+            document[field] = operation['value']
+    return copy.deepcopy(document)
+
+
+class FakeDBClient:
+    """Serves the payment setups as they were when the shard was queued, like a stale page would,
+    unless stale_pages is False"""
+
+    def __init__(self, payment_setups, locations, stale_pages=True):
+        self.payment_setups = {payment_setup['user_id']: payment_setup for payment_setup in payment_setups}
+        self.snapshot = copy.deepcopy(payment_setups)
+        self.stale_pages = stale_pages
+        self.locations = locations
+        self.system_documents = {}
+        self.fail_users = set()
+        self.fail_locations = set()
+
+    async def get_system_document(self, doc_id):
+        return copy.deepcopy(self.system_documents.get(doc_id))
+
+    async def upsert_system_document(self, document):
+        self.system_documents[document['id']] = copy.deepcopy(document)
+        return document
+
+    async def iter_payment_setup_pages(self, query=None, page_size=None):
+        yield copy.deepcopy(self.snapshot if self.stale_pages else list(self.payment_setups.values()))
+
+    async def get_locations_of_users(self, user_ids, fields=None):
+        return [copy.deepcopy(location) for location in self.locations if location['user_id'] in user_ids]
+
+    async def get_locations(self, email, fields=None):
+        return await self.get_locations_of_users([email])
+
+    async def get_location(self, location_id, user_id=None):
+        return copy.deepcopy(next(location for location in self.locations if location['id'] == location_id))
+
+    async def patch_location(self, location_id, user_id, patch):
+        if location_id in self.fail_locations:
+            raise RuntimeError("write failed")
+        return apply_patch(next(location for location in self.locations if location['id'] == location_id), patch)
+
+    async def get_payment_setup(self, email):
+        return copy.deepcopy(self.payment_setups.get(email))
+
+    async def patch_payment_setup(self, email, patch):
+        if email in self.fail_users:
+            raise RuntimeError("write failed")
+        return apply_patch(self.payment_setups[email], patch)
+
+
+def make_db_client():
+    return FakeDBClient(
+        [{'user_id': 'a@example.com', 'tokens': 100}, {'user_id': 'b@example.com', 'tokens': 100}],
+        [
+            {'user_id': 'a@example.com', 'current_period_fee': 30, 'is_active': False},
+            {'user_id': 'b@example.com', 'current_period_fee': 40, 'is_active': False}
+        ]
+    )
+
+
+def charge(db_client):
+    return asyncio.run(charge_weekly_shard(db_client, Shard(0, 1), TICK, None))
+
+
+def tokens(db_client):
+    return {user_id: payment_setup['tokens'] for user_id, payment_setup in db_client.payment_setups.items()}
+
+
+def test_redelivered_shard_after_partial_failure_charges_each_user_once():
+    db_client = make_db_client()
+    db_client.fail_users.add('b@example.com')
+
+    summary = charge(db_client)
+    assert summary['completed'] is False
+    assert summary['failed'] == 1
+    assert tokens(db_client) == {'a@example.com': 70, 'b@example.com': 100}
+
+    db_client.fail_users.clear()
+    summary = charge(db_client)
+    assert summary['completed'] is True
+    assert tokens(db_client) == {'a@example.com': 70, 'b@example.com': 60}
+
+    assert charge(db_client) == {'completed': True}
+    assert tokens(db_client) == {'a@example.com': 70, 'b@example.com': 60}
+
+
+def test_taken_over_shard_does_not_charge_again():
+    db_client = make_db_client()
+    assert charge(db_client)['completed'] is True
+
+    # A worker that took the lease over starts without the run state
+    db_client.system_documents.clear()
+    summary = charge(db_client)
+
+    assert summary['completed'] is True
+    assert tokens(db_client) == {'a@example.com': 70, 'b@example.com': 60}
+
+
+def test_shard_with_persistent_failures_gives_up_after_max_passes():
+    db_client = make_db_client()
+    db_client.fail_users.add('b@example.com')
+
+    results = [charge(db_client)['completed'] for _ in range(3)]
+
+    assert results == [False, False, True]
+    assert tokens(db_client) == {'a@example.com': 70, 'b@example.com': 100}
+
+
+def make_active_db_client():
+    return FakeDBClient(
+        [{'user_id': 'a@example.com', 'pending_fee': 10}, {'user_id': 'b@example.com', 'pending_fee': 20}],
+        [
+            {'id': 'loc-a', 'user_id': 'a@example.com', 'current_period_fee': 10, 'monthly_fee': 720, 'is_active': True},
+            {'id': 'loc-b', 'user_id': 'b@example.com', 'current_period_fee': 20, 'monthly_fee': 720, 'is_active': True}
+        ],
+        stale_pages=False
+    )
+
+
+def location_fees(db_client):
+    return {location['id']: location['current_period_fee'] for location in db_client.locations}
+
+
+def test_hourly_shard_retries_failed_users_before_completing():
+    db_client = make_active_db_client()
+    db_client.fail_locations.add('loc-b')
+    hourly_fee = calculate_hourly_fee(720)
+
+    summary = asyncio.run(bill_hourly_shard(db_client, Shard(0, 1), '2026-10-17T05', None))
+    assert summary['completed'] is False
+    assert location_fees(db_client) == {'loc-a': 10 + hourly_fee, 'loc-b': 20}
+
+    db_client.fail_locations.clear()
+    summary = asyncio.run(bill_hourly_shard(db_client, Shard(0, 1), '2026-10-17T05', None))
+    assert summary['completed'] is True
+    assert location_fees(db_client) == {'loc-a': 10 + hourly_fee, 'loc-b': 20 + hourly_fee}
+    assert db_client.payment_setups['b@example.com']['pending_fee'] == 20 + hourly_fee
+    assert db_client.system_documents['run_hourly-update_2026-10-17T05_0']['passes'] == 2
+
+
+def test_monthly_shard_retries_users_whose_rollover_failed():
+    db_client = make_active_db_client()
+    db_client.fail_locations.add('loc-b')
+
+    summary = asyncio.run(initialize_monthly_shard(db_client, Shard(0, 1), '2026-10', None))
+    assert summary['completed'] is False
+    assert location_fees(db_client)['loc-b'] > 0
+
+    db_client.fail_locations.clear()
+    summary = asyncio.run(initialize_monthly_shard(db_client, Shard(0, 1), '2026-10', None))
+    assert summary['completed'] is True
+    assert location_fees(db_client) == {'loc-a': 0, 'loc-b': 0}
+    # The rerun only finished resetting b's locations; its pending fee grew once
+    assert 39.9 < db_client.payment_setups['b@example.com']['pending_fee'] < 40.1
+    assert 19.9 < db_client.payment_setups['a@example.com']['pending_fee'] < 20.1
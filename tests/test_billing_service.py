@@ -0,0 +1,158 @@
+import asyncio
+import copy
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from shared_code import billing_service
+from shared_code.billing_service import BillingService
+from shared_code.query import Query
+
+NOW = datetime.now(timezone.utc)
+
+
+class FakeDBClient:
+    """Payment setups and locations keyed by user, answering the threshold_due_at query itself"""
+
+    def __init__(self, locations, payment_setups):
+        self.locations = locations
+        self.payment_setups = {payment_setup['user_id']: payment_setup for payment_setup in payment_setups}
+        self.queries = []
+        self.reads = []
+
+    async def iter_payment_setup_pages(self, query=None, page_size=None):
+        self.queries.append(query.build())
+        as_of = query.parameters[-1]['value']
+        yield [
+            {'user_id': user_id} for user_id, payment_setup in self.payment_setups.items()
+            if 'threshold_due_at' not in payment_setup
+            or (payment_setup['threshold_due_at'] is not None and payment_setup['threshold_due_at'] <= as_of)
+        ]
+
+    async def get_payment_setup(self, email):
+        self.reads.append(email)
+        return copy.deepcopy(self.payment_setups.get(email))
+
+    async def get_locations(self, email, fields=None):
+        return [copy.deepcopy(location) for location in self.locations if location['user_id'] == email]
+
+    async def patch_payment_setup(self, email, patch):
+        payment_setup = self.payment_setups[email]
+        for operation in patch.operations:
+            payment_setup[operation['path'].lstrip('/')] = operation['value']
+        return copy.deepcopy(payment_setup)
+
+
+class UnchangedFeed:
+    def __init__(self, db_client, container_name, lease_name=None):
+        pass
+
+    async def read_changes(self):
+        return []
+
+    async def checkpoint(self):
+        pass
+
+
+def make_service(db_client):
+    with mock.patch.object(billing_service, 'AsyncCosmosDBClient'), mock.patch.object(billing_service, 'EventGridPublisher'):
+        service = BillingService()
+    service.db_client = db_client
+    service.event_publisher.publish_threshold_event = mock.AsyncMock(return_value=True)
+    return service
+
+
+def process_changes(service):
+    with mock.patch.object(billing_service, 'ChangeFeedProcessor', UnchangedFeed):
+        return asyncio.run(service.process_changes())
+
+
+def location(user_id, current_period_fee, monthly_fee, days_ago):
+    return {
+        'user_id': user_id,
+        'current_period_fee': current_period_fee,
+        'monthly_fee': monthly_fee,
+        'is_active': True,
+        'last_billing_update': (NOW - timedelta(days=days_ago)).isoformat()
+    }
+
+
+def test_threshold_crossed_by_accrual_without_writes_is_published():
+    db_client = FakeDBClient(
+        # 10 days at $300/month accrue $100 on top of $50 already billed
+        [location('due@example.com', 50, 300, 10), location('later@example.com', 0, 30, 10)],
+        [
+            {'user_id': 'due@example.com', 'custom_threshold': 120,
+             'threshold_due_at': (NOW - timedelta(days=3)).isoformat()},
+            {'user_id': 'later@example.com', 'custom_threshold': 120,
+             'threshold_due_at': (NOW + timedelta(days=100)).isoformat()}
+        ]
+    )
+    service = make_service(db_client)
+
+    summary = process_changes(service)
+
+    assert summary['changed_users'] == 0
+    assert summary['threshold_due_users'] == 1
+    # Users not yet due are neither read nor written
+    assert db_client.reads == ['due@example.com']
+    service.event_publisher.publish_threshold_event.assert_awaited_once()
+    published = service.event_publisher.publish_threshold_event.await_args.kwargs
+    assert published['user_id'] == 'due@example.com'
+    assert published['threshold'] == 120
+    assert 149.9 < published['current_fee'] < 150.1
+    # Already over the threshold, so not due again until a change resyncs it
+    assert db_client.payment_setups['due@example.com']['threshold_due_at'] is None
+
+    service.event_publisher.publish_threshold_event.reset_mock()
+    process_changes(service)
+    service.event_publisher.publish_threshold_event.assert_not_awaited()
+
+
+def test_sync_stores_when_the_threshold_will_be_crossed():
+    # $50 billed plus $10 a day reaches $120 in 7 days
+    db_client = FakeDBClient(
+        [location('user@example.com', 50, 300, 0)],
+        [{'user_id': 'user@example.com', 'custom_threshold': 120}]
+    )
+    service = make_service(db_client)
+
+    asyncio.run(service.sync_user_pending_fee('user@example.com', NOW))
+
+    payment_setup = db_client.payment_setups['user@example.com']
+    due_at = datetime.fromisoformat(payment_setup['threshold_due_at'])
+    assert abs(due_at - (NOW + timedelta(days=7))) < timedelta(seconds=1)
+    assert payment_setup['updated_at'] == payment_setup['pending_fee_synced_at']
+    service.event_publisher.publish_threshold_event.assert_not_awaited()
+
+
+def test_users_synced_before_threshold_due_at_are_backfilled_once():
+    db_client = FakeDBClient(
+        [location('user@example.com', 0, 30, 1)],
+        [{'user_id': 'user@example.com', 'custom_threshold': 120}]
+    )
+    service = make_service(db_client)
+
+    assert process_changes(service)['threshold_due_users'] == 1
+    assert db_client.payment_setups['user@example.com']['threshold_due_at'] > NOW.isoformat()
+    assert process_changes(service)['threshold_due_users'] == 0
+
+
+def test_users_without_active_locations_are_never_due():
+    db_client = FakeDBClient(
+        [{**location('user@example.com', 20, 300, 1), 'is_active': False}],
+        [{'user_id': 'user@example.com'}]
+    )
+    service = make_service(db_client)
+
+    process_changes(service)
+
+    assert db_client.payment_setups['user@example.com']['threshold_due_at'] is None
+
+
+def test_due_query_matches_missing_or_past_due_times():
+    sql, parameters = Query('payment_setup').select('user_id').where_undefined_or('threshold_due_at', 'now', '<=').build()
+
+    assert sql == (
+        "SELECT c.user_id FROM c WHERE c.type = @p0 "
+        "AND (NOT IS_DEFINED(c.threshold_due_at) OR c.threshold_due_at <= @p1)"
+    )
+    assert parameters[1] == {'name': '@p1', 'value': 'now'}
@@ -0,0 +1,70 @@
+import asyncio
+import copy
+from unittest import mock
+from azure.cosmos.aio import CosmosClient, _asynchronous_request
+from shared_code import change_feed
+from shared_code.change_feed import ChangeFeedProcessor
+
+DATABASE_ACCOUNT = {
+    'id': 'account',
+    'writableLocations': [],
+    'readableLocations': [],
+    'userConsistencyPolicy': {'defaultConsistencyLevel': 'Session'}
+}
+
+
+class FakeCosmos:
+    """Answers the aio SDK's HTTP requests: two partition key ranges with one change each"""
+
+    def __init__(self):
+        self.changes = {'0': [{'id': 'a'}], '1': [{'id': 'b'}]}
+
+    async def request(self, **kwargs):
+        request_params, request = kwargs['request_params'], kwargs['request']
+        if request_params.resource_type == 'databaseaccount':
+            return DATABASE_ACCOUNT, {}
+        if request_params.resource_type == 'pkranges':
+            return {'PartitionKeyRanges': [{'id': '0'}, {'id': '1'}], '_count': 2}, {}
+        range_id = request.headers['x-ms-documentdb-partitionkeyrangeid']
+        etag = f'"{range_id}-{len(self.changes[range_id])}"'
+        if request.headers.get('If-None-Match') == etag:
+            return {'Documents': [], '_count': 0}, {'etag': etag}
+        return {'Documents': self.changes[range_id], '_count': len(self.changes[range_id])}, {'etag': etag}
+
+
+class FakeDBClient:
+    def __init__(self):
+        self.documents = {}
+
+    async def get_system_document(self, doc_id):
+        return copy.deepcopy(self.documents.get(doc_id))
+
+    async def upsert_system_document(self, document):
+        self.documents[document['id']] = copy.deepcopy(document)
+        return document
+
+
+def test_reads_every_partition_key_range_from_its_checkpoint():
+    cosmos = FakeCosmos()
+    db_client = FakeDBClient()
+
+    async def read_twice():
+        async with CosmosClient('https://account.documents.azure.com:443/', 'a2V5a2V5') as client:
+            container = client.get_database_client('culvana').get_container_client('culvana-location')
+
+            async def get_container(name):
+                return container
+
+            with mock.patch.object(change_feed.clients, 'get_async_container', get_container):
+                processor = ChangeFeedProcessor(db_client, 'culvana-location')
+                first = await processor.read_changes()
+                await processor.checkpoint()
+                second = await ChangeFeedProcessor(db_client, 'culvana-location').read_changes()
+        return first, second
+
+    with mock.patch.object(_asynchronous_request, 'AsynchronousRequest', cosmos.request):
+        first, second = asyncio.run(read_twice())
+
+    assert sorted(document['id'] for document in first) == ['a', 'b']
+    assert second == []
+    assert db_client.documents['changefeed_culvana-location']['continuations'] == {'0': '"0-1"', '1': '"1-1"'}
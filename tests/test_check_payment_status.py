@@ -0,0 +1,82 @@
+import copy
+import json
+import importlib
+import azure.functions as func
+
+check_payment_status = importlib.import_module('check-payment-status')
+
+EMAIL = 'user@example.com'
+
+
+class FakeDBClient:
+    """Hands every request the pending list read before any of them settled, like concurrent requests"""
+
+    def __init__(self, tokens, transactions):
+        self.payment_setup = {'user_id': EMAIL, 'tokens': tokens, 'pending_fee': 30, 'monthly_usage': 0}
+        self.transactions = {transaction['id']: transaction for transaction in transactions}
+        self.snapshot = [{'id': t['id'], 'amount': t['amount']} for t in transactions]
+
+    def __call__(self):
+        return self
+
+    def get_payment_setup(self, email):
+        return copy.deepcopy(self.payment_setup)
+
+    def get_pending_weekly_billing(self, email, fields=None):
+        return copy.deepcopy(self.snapshot)
+
+    def modify_payment_setup(self, email, mutate):
+        payment_setup = copy.deepcopy(self.payment_setup)
+        mutate(payment_setup)
+        self.payment_setup = payment_setup
+        return copy.deepcopy(payment_setup)
+
+    def modify_transaction(self, transaction_id, user_id, mutate):
+        transaction = copy.deepcopy(self.transactions[transaction_id])
+        mutate(transaction)
+        self.transactions[transaction_id] = transaction
+        return copy.deepcopy(transaction)
+
+
+def make_db_client(monkeypatch, tokens):
+    db_client = FakeDBClient(tokens, [
+        {'id': 'trans_1', 'user_id': EMAIL, 'amount': 2000, 'status': 'pending'},
+        {'id': 'trans_2', 'user_id': EMAIL, 'amount': 1000, 'status': 'pending'}
+    ])
+    monkeypatch.setattr(check_payment_status, 'CosmosDBClient', db_client)
+    return db_client
+
+
+def check():
+    return check_payment_status.main(func.HttpRequest(
+        method='POST',
+        url='/api/check-payment-status',
+        body=json.dumps({'email': EMAIL}).encode()
+    ))
+
+
+def test_concurrent_checks_debit_pending_transactions_once(monkeypatch):
+    db_client = make_db_client(monkeypatch, tokens=100)
+
+    first = check()
+    second = check()
+
+    assert first.status_code == 200
+    assert json.loads(first.get_body())['remaining_tokens'] == 70
+    assert second.status_code == 200
+    assert db_client.payment_setup['tokens'] == 70
+    assert db_client.payment_setup['monthly_usage'] == 30
+    assert {t['status'] for t in db_client.transactions.values()} == {'completed'}
+
+
+def test_claimed_transactions_are_reopened_when_the_debit_fails(monkeypatch):
+    db_client = make_db_client(monkeypatch, tokens=100)
+    # Tokens spent between the balance check and the debit
+    db_client.modify_payment_setup = lambda email, mutate: mutate({'tokens': 10})
+
+    response = check()
+
+    assert response.status_code == 500
+    assert db_client.payment_setup['tokens'] == 100
+    assert {t['status'] for t in db_client.transactions.values()} == {'pending'}
+    assert all('completed_at' not in t for t in db_client.transactions.values())
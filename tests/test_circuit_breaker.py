@@ -0,0 +1,86 @@
+import types
+import pytest
+from shared_code import circuit_breaker
+from shared_code.circuit_breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(circuit_breaker, 'time', types.SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def trip(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=30)
+
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.get_stats()['opened'] == 1
+
+
+def test_open_circuit_rejects_with_retry_after(clock):
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    trip(breaker)
+    clock.now += 10
+
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_call()
+
+    assert error.value.retry_after == 20
+    assert breaker.get_stats()['rejected'] == 1
+
+
+def test_successful_probe_closes(clock):
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    trip(breaker)
+    clock.now += 30
+    assert breaker.state == HALF_OPEN
+
+    breaker.before_call()
+    # Only half_open_max_calls probes are admitted while it is still failing or slow
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+
+    assert breaker.state == CLOSED
+    breaker.before_call()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+    trip(breaker)
+    clock.now += 30
+
+    breaker.before_call()
+    breaker.record_failure()
+
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_call()
+    assert error.value.retry_after == 30
+    assert breaker.get_stats()['opened'] == 2
+
+
+def test_half_open_max_calls(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=5, half_open_max_calls=2)
+    trip(breaker)
+    clock.now += 5
+
+    breaker.before_call()
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
@@ -0,0 +1,210 @@
+import asyncio
+import copy
+import pytest
+import azure.cosmos.exceptions as exceptions
+from shared_code.async_db_client import AsyncCosmosDBClient
+from shared_code.credit_purchases import (
+    SETTLED_PAYMENT_INTENTS,
+    TOKENS_CREDITED,
+    credit_purchase_metadata,
+    credit_transaction_id,
+    record_credit_purchase,
+    settle_credit_purchase,
+    fail_credit_purchase
+)
+from shared_code.models import PaymentSetup
+
+EMAIL = 'user@example.com'
+
+
+class FakeDBClient(AsyncCosmosDBClient):
+    """In-memory documents with ETag checks behind the real modify_* methods.
+
+    Every read and write yields to the event loop, so coroutines run with
+    asyncio.gather interleave between a read and its conditional replace.
+    """
+
+    def __init__(self, tokens=0):
+        self.documents = {}
+        self.credits = 0
+        self._store(PaymentSetup.document_id(EMAIL), {
+            'id': PaymentSetup.document_id(EMAIL),
+            'user_id': EMAIL,
+            'type': 'payment_setup',
+            'tokens': tokens
+        })
+
+    def _store(self, key, document):
+        current = self.documents.get(key)
+        document['_etag'] = str(int(current['_etag']) + 1 if current else 1)
+        self.documents[key] = copy.deepcopy(document)
+        return copy.deepcopy(document)
+
+    async def _read(self, key):
+        await asyncio.sleep(0)
+        document = self.documents.get(key)
+        return copy.deepcopy(document) if document else None
+
+    async def _replace(self, key, document):
+        await asyncio.sleep(0)
+        if self.documents[key]['_etag'] != document['_etag']:
+            raise exceptions.CosmosAccessConditionFailedError()
+        return self._store(key, document)
+
+    async def get_payment_setup(self, email):
+        return await self._read(PaymentSetup.document_id(email))
+
+    async def update_payment_setup(self, payment_setup):
+        current = self.documents[payment_setup['id']]
+        result = await self._replace(payment_setup['id'], payment_setup)
+        self.credits += int(result['tokens'] != current['tokens'])
+        return result
+
+    async def get_transaction(self, transaction_id, user_id):
+        return await self._read(transaction_id)
+
+    async def create_transaction(self, user_id, amount, transaction_type, location_id=None, tokens=0,
+                                 status='pending', stripe_session_id=None, transaction_id=None):
+        await asyncio.sleep(0)
+        if transaction_id in self.documents:
+            raise exceptions.CosmosResourceExistsError()
+        return self._store(transaction_id, {
+            'id': transaction_id,
+            'user_id': user_id,
+            'amount': amount,
+            'transaction_type': transaction_type,
+            'tokens': tokens,
+            'status': status,
+            'stripe_session_id': stripe_session_id
+        })
+
+    async def update_transaction(self, transaction):
+        return await self._replace(transaction['id'], transaction)
+
+    async def _adjust_pending_billing(self, user_id, count, amount):
+        pass
+
+    def payment_setup(self):
+        return self.documents[PaymentSetup.document_id(EMAIL)]
+
+    def transaction(self, payment_intent):
+        return self.documents[credit_transaction_id(payment_intent['id'])]
+
+
+def payment_intent(payment_intent_id='pi_1', amount=500):
+    return {
+        'id': payment_intent_id,
+        'amount': amount,
+        'amount_received': amount,
+        'metadata': credit_purchase_metadata(EMAIL, amount)
+    }
+
+
+def test_add_credits_and_webhook_racing_credit_once():
+    db_client = FakeDBClient(tokens=100)
+    intent = payment_intent()
+
+    async def run():
+        await record_credit_purchase(db_client, intent)
+        return await asyncio.gather(
+            settle_credit_purchase(db_client, intent),
+            settle_credit_purchase(db_client, intent)
+        )
+
+    results = asyncio.run(run())
+
+    assert db_client.payment_setup()['tokens'] == 600
+    assert db_client.payment_setup()[SETTLED_PAYMENT_INTENTS] == ['pi_1']
+    assert db_client.credits == 1
+    assert sum(result is not None for result in results) == 1
+    assert db_client.transaction(intent)['status'] == 'completed'
+
+
+def test_webhook_retries_credit_once():
+    db_client = FakeDBClient(tokens=100)
+    intent = payment_intent()
+
+    first = asyncio.run(settle_credit_purchase(db_client, intent))
+    second = asyncio.run(settle_credit_purchase(db_client, intent))
+
+    assert first['tokens'] == 600
+    assert second is None
+    assert db_client.credits == 1
+    assert db_client.transaction(intent)['status'] == 'completed'
+
+
+def test_webhook_before_add_credits_records_the_transaction():
+    db_client = FakeDBClient()
+    intent = payment_intent()
+
+    async def run():
+        await asyncio.gather(
+            record_credit_purchase(db_client, intent),
+            settle_credit_purchase(db_client, intent)
+        )
+
+    asyncio.run(run())
+
+    assert db_client.payment_setup()['tokens'] == 500
+    assert db_client.transaction(intent)['status'] == 'completed'
+
+
+def test_failure_does_not_override_a_settled_purchase():
+    db_client = FakeDBClient()
+    intent = payment_intent()
+
+    asyncio.run(settle_credit_purchase(db_client, intent))
+    assert asyncio.run(fail_credit_purchase(db_client, intent)) is None
+
+    assert db_client.transaction(intent)['status'] == 'completed'
+    assert db_client.payment_setup()['tokens'] == 500
+
+
+def test_distinct_payment_intents_each_credit():
+    db_client = FakeDBClient()
+
+    async def run():
+        await asyncio.gather(
+            settle_credit_purchase(db_client, payment_intent('pi_1', 500)),
+            settle_credit_purchase(db_client, payment_intent('pi_2', 300))
+        )
+
+    asyncio.run(run())
+
+    assert db_client.payment_setup()['tokens'] == 800
+    assert sorted(db_client.payment_setup()[SETTLED_PAYMENT_INTENTS]) == ['pi_1', 'pi_2']
+
+
+def test_late_webhook_retry_after_the_settled_list_moved_on_credits_nothing():
+    db_client = FakeDBClient()
+    intent = payment_intent()
+    asyncio.run(settle_credit_purchase(db_client, intent))
+
+    # Later purchases pushed pi_1 out of the trimmed list before Stripe retried
+    db_client.payment_setup()[SETTLED_PAYMENT_INTENTS] = [f"pi_later_{n}" for n in range(50)]
+    assert asyncio.run(settle_credit_purchase(db_client, intent)) is None
+
+    assert db_client.payment_setup()['tokens'] == 500
+    assert db_client.transaction(intent)[TOKENS_CREDITED] is True
+
+
+def test_settlement_interrupted_before_the_credit_is_finished_by_a_retry():
+    db_client = FakeDBClient()
+    intent = payment_intent()
+    update_payment_setup = db_client.update_payment_setup
+
+    async def crash(payment_setup):
+        raise RuntimeError("worker recycled")
+
+    db_client.update_payment_setup = crash
+    with pytest.raises(RuntimeError):
+        asyncio.run(settle_credit_purchase(db_client, intent))
+    assert db_client.transaction(intent)['status'] == 'completed'
+    assert db_client.transaction(intent)[TOKENS_CREDITED] is False
+
+    db_client.update_payment_setup = update_payment_setup
+    assert asyncio.run(settle_credit_purchase(db_client, intent))['tokens'] == 500
+    assert asyncio.run(settle_credit_purchase(db_client, intent)) is None
+
+    assert db_client.payment_setup()['tokens'] == 500
+    assert db_client.transaction(intent)[TOKENS_CREDITED] is True
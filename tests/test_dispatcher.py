@@ -0,0 +1,60 @@
+import asyncio
+import pytest
+from shared_code import dispatcher
+from shared_code.billing_jobs import ShardJob
+from shared_code.dispatcher import dispatch, run_summary_id, RUN_SUMMARY_COMPLETED
+from shared_code.work_queue import LocalWorkQueue, WorkQueue
+from tests.test_lease import FakeDBClient
+
+
+def test_queue_without_send_fails_when_created():
+    class DrainOnlyQueue(WorkQueue):
+        async def drain(self, handler):
+            pass
+
+    with pytest.raises(TypeError):
+        DrainOnlyQueue()
+
+
+def test_local_queue_drains_messages_sent_while_draining():
+    queue = LocalWorkQueue()
+    handled = []
+
+    async def handler(message):
+        handled.append(message)
+        if message < 3:
+            await queue.send(message + 1)
+
+    async def run():
+        await queue.send(1)
+        await queue.drain(handler)
+
+    asyncio.run(run())
+
+    assert handled == [1, 2, 3]
+    assert not queue.messages
+
+
+def test_dispatch_runs_shards_in_process_and_requeues_unfinished_ones(monkeypatch):
+    db_client = FakeDBClient()
+    calls = []
+
+    async def handler(db_client, shard, tick_id, started):
+        calls.append(shard.index)
+        # Shard 1 runs out of time budget on its first run
+        if shard.index == 1 and calls.count(1) == 1:
+            return {'completed': False}
+        return {'completed': True, 'processed': 10}
+
+    monkeypatch.setitem(dispatcher.SHARD_JOBS, 'test-job', ShardJob('test-job', 'test-job', handler))
+
+    summary = asyncio.run(dispatch(db_client, 'test-job', 'tick', queue=LocalWorkQueue(), shard_count=2))
+
+    assert sorted(calls) == [0, 1, 1]
+    assert summary['status'] == RUN_SUMMARY_COMPLETED
+    assert summary['totals'] == {'processed': 20}
+
+    # A completed tick is not dispatched again
+    asyncio.run(dispatch(db_client, 'test-job', 'tick', queue=LocalWorkQueue()))
+    assert len(calls) == 3
+    assert db_client.documents[run_summary_id('test-job', 'tick')]['status'] == RUN_SUMMARY_COMPLETED
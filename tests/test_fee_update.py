@@ -0,0 +1,57 @@
+import asyncio
+import copy
+import pytest
+import azure.cosmos.exceptions as exceptions
+from shared_code.fee_update import update_user_pending_fee, calculate_hourly_fee
+
+TICK = '2026-10-17T05'
+
+
+class FakeDBClient:
+    def __init__(self, locations):
+        self.locations = {location['id']: location for location in locations}
+        self.pending_fee = None
+        self.fail_once = set()
+
+    async def get_locations(self, email, fields=None):
+        return [copy.deepcopy(location) for location in self.locations.values()]
+
+    async def get_location(self, location_id, user_id=None):
+        return copy.deepcopy(self.locations[location_id])
+
+    async def patch_location(self, location_id, user_id, patch):
+        if location_id in self.fail_once:
+            self.fail_once.discard(location_id)
+            raise RuntimeError("throttled")
+        location = self.locations[location_id]
+        if 'last_billing_tick' in (patch.condition or '') and location.get('last_billing_tick') == TICK:
+            raise exceptions.CosmosAccessConditionFailedError()
+        for operation in patch.operations:
+            field = operation['path'].lstrip('/')
+            if operation['op'] == 'incr':
+                location[field] = location.get(field, 0) + operation['value']
+            else:
+                location[field] = operation['value']
+        return copy.deepcopy(location)
+
+    async def update_payment_setup_pending_fee(self, email, pending_fee):
+        self.pending_fee = pending_fee
+
+
+def test_retry_after_partial_failure_accrues_each_location_once():
+    db_client = FakeDBClient([
+        {'id': 'loc-1', 'user_id': 'user@example.com', 'is_active': True, 'monthly_fee': 720, 'current_period_fee': 10},
+        {'id': 'loc-2', 'user_id': 'user@example.com', 'is_active': True, 'monthly_fee': 720, 'current_period_fee': 20}
+    ])
+    db_client.fail_once.add('loc-2')
+    payment_setup = {'user_id': 'user@example.com'}
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(update_user_pending_fee(db_client, payment_setup, TICK))
+    asyncio.run(update_user_pending_fee(db_client, payment_setup, TICK))
+    asyncio.run(update_user_pending_fee(db_client, payment_setup, TICK))
+
+    hourly_fee = calculate_hourly_fee(720)
+    assert db_client.locations['loc-1']['current_period_fee'] == 10 + hourly_fee
+    assert db_client.locations['loc-2']['current_period_fee'] == 20 + hourly_fee
+    assert db_client.pending_fee == 30 + 2 * hourly_fee
@@ -0,0 +1,145 @@
+import asyncio
+import copy
+import itertools
+import azure.cosmos.exceptions as exceptions
+from shared_code.lease import Lease, Shard, run_shard
+from shared_code.run_state import RunState
+
+PAGES = [[{'user_id': 'a'}], [{'user_id': 'b'}], [{'user_id': 'c'}]]
+
+
+class FakeDBClient:
+    def __init__(self):
+        self.documents = {}
+        self.etags = itertools.count()
+
+    def _store(self, document):
+        document = {**copy.deepcopy(document), '_etag': str(next(self.etags))}
+        self.documents[document['id']] = document
+        return copy.deepcopy(document)
+
+    async def get_system_document(self, doc_id):
+        return copy.deepcopy(self.documents.get(doc_id))
+
+    async def create_system_document(self, document):
+        if document['id'] in self.documents:
+            raise exceptions.CosmosResourceExistsError()
+        return self._store(document)
+
+    async def replace_system_document(self, document, etag):
+        if self.documents.get(document['id'], {}).get('_etag') != etag:
+            raise exceptions.CosmosAccessConditionFailedError()
+        return self._store(document)
+
+    async def upsert_system_document(self, document):
+        return self._store(document)
+
+    async def delete_system_document(self, doc_id, etag=None):
+        self.documents.pop(doc_id, None)
+
+    def take_over(self, lease_id):
+        self._store({**self.documents[lease_id], 'owner': 'another-instance'})
+
+
+async def pages():
+    for page in PAGES:
+        yield page
+
+
+def run(db_client, on_batch=lambda: None):
+    processed = []
+
+    async def work(shard):
+        run_state = await RunState(db_client, 'job', 'tick', shard.index, None, shard.lease).load()
+        async for page in run_state.stream(pages()):
+            processed.extend(document['user_id'] for document in page)
+            on_batch()
+            await run_state.record_batch([document['user_id'] for document in page], [None] * len(page))
+        return {'completed': run_state.finished}
+
+    summary = asyncio.run(run_shard(db_client, 'job', 'tick', Shard(0, 1), work))
+    return summary, processed
+
+
+def test_lease_is_renewed_after_each_batch(monkeypatch):
+    monkeypatch.setenv('LEASE_DURATION_SECONDS', '0')
+    db_client = FakeDBClient()
+
+    summary, processed = run(db_client)
+
+    assert summary == {'completed': True}
+    assert processed == ['a', 'b', 'c']
+    # acquire, three renewals, three run state saves and complete
+    assert int(db_client.documents['lease_job_tick_0']['_etag']) == 7
+    assert db_client.documents['lease_job_tick_0']['status'] == 'done'
+
+
+def test_run_stops_when_the_lease_is_taken_over(monkeypatch):
+    monkeypatch.setenv('LEASE_DURATION_SECONDS', '0')
+    db_client = FakeDBClient()
+
+    summary, processed = run(db_client, on_batch=lambda: db_client.take_over('lease_job_tick_0'))
+
+    assert summary == {'completed': False}
+    assert processed == ['a']
+    assert db_client.documents['lease_job_tick_0']['owner'] == 'another-instance'
+
+
+class YieldingDBClient(FakeDBClient):
+    """Yields before every read and write, so coroutines gathered in one worker interleave"""
+
+    async def get_system_document(self, doc_id):
+        await asyncio.sleep(0)
+        return await super().get_system_document(doc_id)
+
+    async def create_system_document(self, document):
+        await asyncio.sleep(0)
+        return await super().create_system_document(document)
+
+    async def replace_system_document(self, document, etag):
+        await asyncio.sleep(0)
+        return await super().replace_system_document(document, etag)
+
+
+def test_leases_in_one_worker_race_like_separate_instances():
+    db_client = YieldingDBClient()
+    leases = [Lease(db_client, 'job_tick_0') for _ in range(2)]
+
+    async def race():
+        return await asyncio.gather(*(lease.acquire() for lease in leases))
+
+    assert sorted(asyncio.run(race())) == [False, True]
+    winner = next(lease for lease in leases if lease.held)
+    assert db_client.documents['lease_job_tick_0']['owner'] == winner.owner
+
+    # A live lease is not taken over by a later claim from the same worker either
+    assert not asyncio.run(Lease(db_client, 'job_tick_0').acquire())
+
+
+def test_duplicate_shard_messages_run_the_shard_once():
+    db_client = YieldingDBClient()
+    runs = []
+
+    async def work(shard):
+        runs.append(shard.index)
+        await asyncio.sleep(0)
+        return {'completed': True}
+
+    async def race():
+        return await asyncio.gather(*(run_shard(db_client, 'job', 'tick', Shard(0, 1), work) for _ in range(2)))
+
+    summaries = asyncio.run(race())
+
+    assert runs == [0]
+    assert summaries.count(None) == 1
+
+
+def test_expired_lease_is_taken_over(monkeypatch):
+    db_client = FakeDBClient()
+    monkeypatch.setenv('LEASE_DURATION_SECONDS', '0')
+    crashed = Lease(db_client, 'job_tick_0')
+    assert asyncio.run(crashed.acquire())
+
+    successor = Lease(db_client, 'job_tick_0')
+    assert asyncio.run(successor.acquire())
+    assert not asyncio.run(crashed.renew())
@@ -0,0 +1,27 @@
+import importlib
+
+setup_payment = importlib.import_module('setup-payment')
+idempotency_key = setup_payment.idempotency_key
+
+
+def test_retries_of_one_request_replay_its_charge():
+    assert (idempotency_key('user@example.com', 'pm_1', 'setup-fee', 'req-1')
+            == idempotency_key('user@example.com', 'pm_1', 'setup-fee', 'req-1'))
+
+
+def test_new_attempt_after_a_decline_is_charged_again():
+    # Stripe would replay a cached decline for the same key for 24 hours
+    assert (idempotency_key('user@example.com', 'pm_1', 'setup-fee', 'req-1')
+            != idempotency_key('user@example.com', 'pm_1', 'setup-fee', 'req-2'))
+    assert (idempotency_key('user@example.com', 'pm_1', 'attach', 'req-1')
+            != idempotency_key('user@example.com', 'pm_1', 'attach', 'req-2'))
+
+
+def test_steps_and_cards_get_their_own_keys():
+    keys = {
+        idempotency_key('user@example.com', 'pm_1', 'customer'),
+        idempotency_key('user@example.com', 'pm_2', 'customer'),
+        idempotency_key('user@example.com', 'pm_1', 'attach', 'req-1'),
+        idempotency_key('user@example.com', 'pm_1', 'setup-fee', 'req-1')
+    }
+    assert len(keys) == 4
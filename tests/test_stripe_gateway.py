@@ -0,0 +1,200 @@
+import json
+import asyncio
+import threading
+import time
+import pytest
+import stripe
+from shared_code.circuit_breaker import CircuitBreaker
+from shared_code.stripe_gateway import (
+    StripeGateway,
+    StripeUnavailable,
+    StripeDeadlineExceeded,
+    stripe_unavailable_response
+)
+
+
+def make_gateway(**kwargs):
+    options = {'max_workers': 4, 'deadline': 5, 'max_in_flight': 10}
+    options.update(kwargs)
+    options.setdefault('breaker', CircuitBreaker('stripe-test', 5, 60))
+    return StripeGateway(**options)
+
+
+def wait_until(predicate, timeout=2.0):
+    """The gateway reports outcomes from a done callback on the worker, just after waiters wake"""
+    stop = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < stop
+        time.sleep(0.005)
+
+
+def declined(item):
+    raise stripe.error.CardError("Your card was declined.", None, 'card_declined')
+
+
+def test_call_past_deadline_is_reported_once():
+    gateway = make_gateway()
+    release = threading.Event()
+
+    with pytest.raises(StripeDeadlineExceeded) as error:
+        gateway.call(release.wait, deadline=0.05)
+    release.set()
+    wait_until(lambda: gateway.in_flight == 0)
+    gateway.executor.shutdown(wait=True)
+
+    assert error.value.reason == 'deadline_exceeded'
+    stats = gateway.get_stats()
+    assert stats['calls'] == 1
+    assert stats['timed_out'] == 1
+    assert stats['failed'] == 0
+    # The late completion is not reported again as a success
+    assert stats['breaker']['failures'] == 1
+    assert stats['breaker']['successes'] == 0
+
+
+def test_map_returns_partial_results_under_one_deadline():
+    gateway = make_gateway()
+    release = threading.Event()
+
+    def lookup(item):
+        if item == 'slow':
+            release.wait()
+        if item == 'declined':
+            declined(item)
+        return item.upper()
+
+    results, errors = gateway.map(lookup, ['ok', 'declined', 'slow', 'ok'], deadline=0.1)
+    release.set()
+    gateway.executor.shutdown(wait=True)
+
+    assert results == {'ok': 'OK'}
+    assert isinstance(errors['declined'], stripe.error.CardError)
+    assert isinstance(errors['slow'], StripeDeadlineExceeded)
+    stats = gateway.get_stats()
+    assert stats['calls'] == 3
+    assert stats['failed'] == 1
+    assert stats['timed_out'] == 1
+    assert stats['in_flight'] == 0
+
+
+def test_map_async_returns_partial_results():
+    gateway = make_gateway()
+    release = threading.Event()
+
+    def lookup(item):
+        if item == 'slow':
+            release.wait()
+        return item.upper()
+
+    results, errors = asyncio.run(gateway.map_async(lookup, ['a', 'slow'], deadline=0.1))
+    release.set()
+    gateway.executor.shutdown(wait=True)
+
+    assert results == {'a': 'A'}
+    assert isinstance(errors['slow'], StripeDeadlineExceeded)
+    assert gateway.get_stats()['timed_out'] == 1
+
+
+def test_call_async_past_deadline():
+    gateway = make_gateway()
+    release = threading.Event()
+
+    with pytest.raises(StripeDeadlineExceeded):
+        asyncio.run(gateway.call_async(release.wait, deadline=0.05))
+    release.set()
+    gateway.executor.shutdown(wait=True)
+
+    assert gateway.get_stats()['timed_out'] == 1
+
+
+def test_outages_open_the_breaker_and_reject_without_calling():
+    gateway = make_gateway(breaker=CircuitBreaker('stripe-test', 2, 60))
+    calls = []
+
+    def unreachable():
+        calls.append(1)
+        raise stripe.error.APIConnectionError("Could not connect to Stripe")
+
+    for _ in range(2):
+        with pytest.raises(stripe.error.APIConnectionError):
+            gateway.call(unreachable)
+    wait_until(lambda: gateway.breaker.get_stats()['failures'] == 2)
+
+    with pytest.raises(StripeUnavailable) as error:
+        gateway.call(unreachable)
+    gateway.executor.shutdown(wait=True)
+
+    assert error.value.reason == 'circuit_open'
+    assert error.value.retry_after > 0
+    assert len(calls) == 2
+    stats = gateway.get_stats()
+    assert stats['breaker_state'] == 'open'
+    assert stats['calls'] == 2
+    assert stats['failed'] == 2
+    assert stats['circuit_open'] == 1
+    assert stats['in_flight'] == 0
+
+
+def test_declines_do_not_open_the_breaker():
+    gateway = make_gateway(breaker=CircuitBreaker('stripe-test', 2, 60))
+
+    for _ in range(3):
+        with pytest.raises(stripe.error.CardError):
+            gateway.call(declined, 'card')
+    gateway.executor.shutdown(wait=True)
+
+    stats = gateway.get_stats()
+    assert stats['breaker_state'] == 'closed'
+    assert stats['breaker']['successes'] == 3
+    assert stats['failed'] == 3
+
+
+def test_bulkhead_rejects_calls_over_max_in_flight():
+    gateway = make_gateway(max_in_flight=2)
+    release = threading.Event()
+
+    def lookup(item):
+        release.wait()
+        return item
+
+    timer = threading.Timer(0.1, release.set)
+    timer.start()
+    results, errors = gateway.map(lookup, [1, 2, 3])
+    gateway.executor.shutdown(wait=True)
+
+    assert results == {1: 1, 2: 2}
+    assert errors[3].reason == 'bulkhead_full'
+    stats = gateway.get_stats()
+    assert stats['calls'] == 2
+    assert stats['bulkhead_full'] == 1
+    assert stats['in_flight'] == 0
+
+
+def test_timed_out_calls_hold_the_bulkhead_until_they_finish():
+    gateway = make_gateway(max_in_flight=1)
+    release = threading.Event()
+
+    with pytest.raises(StripeDeadlineExceeded):
+        gateway.call(release.wait, deadline=0.05)
+    with pytest.raises(StripeUnavailable) as error:
+        gateway.call(lambda: 'next')
+    assert error.value.reason == 'bulkhead_full'
+
+    def admitted():
+        try:
+            return gateway.call(lambda: 'next') == 'next'
+        except StripeUnavailable:
+            return False
+
+    release.set()
+    wait_until(admitted)
+    gateway.executor.shutdown(wait=True)
+    assert gateway.get_stats()['bulkhead_full'] >= 1
+
+
+def test_stripe_unavailable_response():
+    response = stripe_unavailable_response(StripeUnavailable("open", 'circuit_open', retry_after=12.2))
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '13'
+    assert json.loads(response.get_body())['error_code'] == 'stripe_unavailable'
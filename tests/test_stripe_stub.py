@@ -0,0 +1,88 @@
+import json
+import importlib
+import threading
+import urllib.request
+import pytest
+import stripe
+from tools import stripe_stub
+
+unsubscribe = importlib.import_module('unsubscribe')
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = stripe_stub.serve(port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://localhost:{server.server_address[1]}"
+    monkeypatch.setattr(stripe, 'api_base', url)
+    monkeypatch.setattr(stripe, 'api_key', 'sk_test_stub')
+    yield url
+    server.shutdown()
+    server.server_close()
+
+
+def control(url, path, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    with urllib.request.urlopen(urllib.request.Request(f"{url}{path}", data=data)) as response:
+        return json.loads(response.read())
+
+
+def test_setup_flow_succeeds(stub):
+    customer = stripe.Customer.create(email='user@example.com', metadata={'user_id': 'user@example.com'})
+    payment_method = stripe.PaymentMethod.attach('pm_card_mastercard', customer=customer.id)
+    payment_intent = stripe.PaymentIntent.create(
+        amount=2500,
+        currency='usd',
+        customer=customer.id,
+        payment_method=payment_method.id,
+        confirm=True,
+        metadata={'purpose': 'credit_purchase'}
+    )
+
+    assert customer.metadata['user_id'] == 'user@example.com'
+    assert payment_method.customer == customer.id
+    assert payment_method.card.last4 == '4444'
+    assert payment_intent.status == 'succeeded'
+    assert payment_intent.amount_received == 2500
+    assert payment_intent.metadata['purpose'] == 'credit_purchase'
+
+
+def test_decline_test_card_raises_card_error(stub):
+    with pytest.raises(stripe.error.CardError) as error:
+        stripe.PaymentIntent.create(
+            amount=2500,
+            currency='usd',
+            payment_method='pm_card_chargeDeclinedInsufficientFunds',
+            confirm=True
+        )
+
+    assert error.value.http_status == 402
+    assert error.value.code == 'card_declined'
+    assert error.value.error.decline_code == 'insufficient_funds'
+    assert control(stub, '/_stub/stats')['declines'] == 1
+
+
+def test_injected_errors_are_api_errors(stub):
+    control(stub, '/_stub/config', {'error_rate': 1})
+
+    with pytest.raises(stripe.error.APIError) as error:
+        stripe.PaymentMethod.retrieve('pm_card_visa')
+
+    assert error.value.http_status == 500
+    stats = control(stub, '/_stub/stats')
+    assert stats['injected_errors'] == 1
+    assert stats['by_route'] == {'GET /v1/payment_methods/:id': 1}
+
+
+def test_detach_retried_after_it_went_through_counts_as_detached(stub):
+    customer = stripe.Customer.create(email='user@example.com')
+    stripe.PaymentMethod.attach('pm_card_visa', customer=customer.id)
+
+    unsubscribe.detach_payment_method('pm_card_visa')
+    # Stripe refuses to detach a card twice; the retry must still go on to remove it
+    with pytest.raises(stripe.error.InvalidRequestError):
+        stripe.PaymentMethod.detach('pm_card_visa')
+    unsubscribe.detach_payment_method('pm_card_visa')
+
+    assert stripe.PaymentMethod.retrieve('pm_card_visa').customer is None
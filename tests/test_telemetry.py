@@ -0,0 +1,134 @@
+import asyncio
+import pytest
+from unittest import mock
+from azure.cosmos import CosmosClient, _synchronized_request
+from shared_code.telemetry import (
+    InstrumentedContainer,
+    Invocation,
+    MemorySink,
+    TelemetrySink,
+    _invocation,
+    current_invocation,
+    get_sink,
+    set_sink,
+    track_invocation
+)
+
+DATABASE_ACCOUNT = {
+    'id': 'account',
+    'writableLocations': [],
+    'readableLocations': [],
+    'userConsistencyPolicy': {'defaultConsistencyLevel': 'Session'}
+}
+
+PAGES = [
+    ({'Documents': [{'id': 'a'}, {'id': 'b'}], '_count': 2}, {'x-ms-request-charge': '2.5', 'x-ms-continuation': 'page-2'}),
+    ({'Documents': [{'id': 'c'}], '_count': 1}, {'x-ms-request-charge': '3.5'})
+]
+
+
+def fake_request(**kwargs):
+    """Answers the SDK's HTTP requests below its query pipeline, so the response hook sees real payloads"""
+    if kwargs['request_params'].resource_type == 'databaseaccount':
+        return DATABASE_ACCOUNT, {}
+    return PAGES[1] if kwargs['request'].headers.get('x-ms-continuation') else PAGES[0]
+
+
+def test_sink_without_emit_fails_when_created():
+    class SilentSink(TelemetrySink):
+        pass
+
+    with pytest.raises(TypeError):
+        SilentSink()
+
+
+def test_paged_query_records_request_charge_per_page():
+    with mock.patch.object(_synchronized_request, 'SynchronizedRequest', fake_request):
+        client = CosmosClient('https://account.documents.azure.com:443/', 'a2V5a2V5')
+        container = InstrumentedContainer(client.get_database_client('db').get_container_client('payment'))
+
+        invocation = Invocation('test')
+        token = _invocation.set(invocation)
+        try:
+            items = list(container.query_items('SELECT * FROM c', partition_key='user@example.com'))
+        finally:
+            _invocation.reset(token)
+
+    assert [item['id'] for item in items] == ['a', 'b', 'c']
+    operation = invocation.summary()['operations']['payment.query_items']
+    assert operation['request_charge'] == 6.0
+    assert operation['pages'] == 2
+    assert operation['items'] == 3
+    assert invocation.timings['cosmos']['count'] == 2
+
+
+def test_pool_stats_are_reported_in_every_summary():
+    from shared_code import clients
+    clients.get_http_session('test')
+
+    metrics = Invocation('test').summary()['metrics']
+
+    assert metrics['clients']['pools']['test'] == {'hosts': 0, 'connections_opened': 0, 'requests_sent': 0}
+    assert metrics['clients']['clients']['session:test']['created'] == 1
+
+
+def test_access_cache_stats_are_reported_in_every_summary():
+    from shared_code.access_cache import get_access_cache
+    get_access_cache().invalidate('user@example.com')
+
+    metrics = Invocation('test').summary()['metrics']
+
+    assert metrics['access_cache']['invalidations'] >= 1
+    assert 'hit_rate' in metrics['access_cache']
+
+
+def test_write_conflict_stats_are_reported_in_every_summary():
+    from shared_code import concurrency
+    concurrency._record('payment_setup', 'conflicts')
+    concurrency._record('payment_setup', 'writes')
+
+    metrics = Invocation('test').summary()['metrics']
+
+    assert metrics['write_conflicts']['payment_setup']['conflicts'] >= 1
+    assert 0 < metrics['write_conflicts']['payment_setup']['conflict_rate'] < 1
+
+
+@pytest.fixture
+def sink():
+    previous = get_sink()
+    sink = MemorySink()
+    set_sink(sink)
+    yield sink
+    set_sink(previous)
+
+
+def test_summary_is_emitted_when_the_function_raises(sink):
+    @track_invocation('failing')
+    def main():
+        current_invocation().record('payment.read_item', 1.5, 4.0, items=1)
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        main()
+
+    assert len(sink.summaries) == 1
+    summary = sink.summaries[0]
+    assert summary['function'] == 'failing'
+    assert summary['request_charge'] == 1.5
+    assert summary['operations']['payment.read_item']['calls'] == 1
+    assert current_invocation() is None
+
+
+def test_async_invocations_are_summarized_separately(sink):
+    @track_invocation('async')
+    async def main(charge):
+        await asyncio.sleep(0)
+        current_invocation().record('location.query_items', charge, 1.0, items=2, pages=1)
+
+    async def run():
+        await asyncio.gather(main(1.0), main(2.0))
+
+    asyncio.run(run())
+
+    assert sorted(summary['request_charge'] for summary in sink.summaries) == [1.0, 2.0]
+    assert all(summary['calls'] == 1 for summary in sink.summaries)
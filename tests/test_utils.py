@@ -0,0 +1,146 @@
+import asyncio
+import copy
+from datetime import datetime, timedelta, timezone
+import pytest
+from shared_code import utils
+from shared_code.billing_engine import HourlyBillingEngine
+from shared_code.utils import (
+    calculate_accrued_fee,
+    calculate_hourly_rate,
+    calculate_unbilled_fee,
+    get_pending_fee,
+    settle_location_fee
+)
+from shared_code.constants import FEE_ACCRUAL_EAGER, FEE_ACCRUAL_LAZY
+
+START = datetime(2026, 10, 1, tzinfo=timezone.utc)
+# $720 a month is $1 an hour
+MONTHLY_FEE = 720
+
+
+def location(**fields):
+    return {
+        'id': 'loc-1',
+        'user_id': 'user@example.com',
+        'monthly_fee': MONTHLY_FEE,
+        'current_period_fee': 5,
+        'is_active': True,
+        'last_billing_update': START.isoformat(),
+        **fields
+    }
+
+
+def test_active_location_accrues_since_last_billing_update():
+    as_of = START + timedelta(hours=10)
+
+    assert calculate_unbilled_fee(location(), as_of) == pytest.approx(10)
+    assert calculate_accrued_fee(location(), as_of) == pytest.approx(15)
+
+
+def test_deactivated_location_stops_accruing_at_deactivated_at():
+    deactivated = location(is_active=False, deactivated_at=(START + timedelta(hours=4)).isoformat())
+
+    assert calculate_accrued_fee(deactivated, START + timedelta(hours=100)) == pytest.approx(9)
+    # Reads before the deactivation time only count up to the read
+    assert calculate_accrued_fee(deactivated, START + timedelta(hours=2)) == pytest.approx(7)
+
+
+def test_inactive_location_without_deactivated_at_accrues_nothing():
+    assert calculate_accrued_fee(location(is_active=False), START + timedelta(hours=10)) == 5
+
+
+def test_missing_last_billing_update_accrues_since_creation():
+    created = location(created_at=(START - timedelta(hours=2)).isoformat())
+    del created['last_billing_update']
+
+    assert calculate_unbilled_fee(created, START) == pytest.approx(2)
+
+
+def test_location_without_any_timestamp_accrues_nothing():
+    assert calculate_unbilled_fee(location(last_billing_update=None), START) == 0
+
+
+def test_naive_and_z_timestamps_are_utc():
+    as_of = START + timedelta(hours=3)
+    aware = location()
+    naive = location(last_billing_update=START.replace(tzinfo=None).isoformat())
+    zulu = location(last_billing_update=START.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    assert calculate_unbilled_fee(naive, as_of) == pytest.approx(calculate_unbilled_fee(aware, as_of))
+    assert calculate_unbilled_fee(zulu, as_of) == pytest.approx(calculate_unbilled_fee(aware, as_of))
+    assert calculate_unbilled_fee(aware, as_of) == pytest.approx(3)
+
+
+def test_settling_a_location_does_not_change_its_accrued_fee():
+    settled = settle_location_fee(location(), START + timedelta(hours=6))
+
+    assert settled['current_period_fee'] == pytest.approx(11)
+    assert settled['last_billing_update'] == (START + timedelta(hours=6)).isoformat()
+    assert calculate_accrued_fee(settled, START + timedelta(hours=10)) == pytest.approx(
+        calculate_accrued_fee(location(), START + timedelta(hours=10))
+    )
+
+
+def test_pending_fee_source_follows_the_accrual_mode(monkeypatch):
+    payment_setup = {'pending_fee': 42}
+    locations = [location(), location(id='loc-2', current_period_fee=0)]
+    as_of = START + timedelta(hours=1)
+
+    monkeypatch.setattr(utils, 'FEE_ACCRUAL_MODE', FEE_ACCRUAL_LAZY)
+    assert get_pending_fee(payment_setup, locations, as_of) == pytest.approx(5 + 1 + 0 + 1)
+
+    monkeypatch.setattr(utils, 'FEE_ACCRUAL_MODE', FEE_ACCRUAL_EAGER)
+    assert get_pending_fee(payment_setup, locations, as_of) == 42
+
+
+class FakeDBClient:
+    def __init__(self, locations):
+        self.locations = {location['id']: location for location in copy.deepcopy(locations)}
+        self.pending_fee = None
+
+    async def patch_location(self, location_id, user_id, patch):
+        location = self.locations[location_id]
+        for operation in patch.operations:
+            field = operation['path'].lstrip('/')
+            if operation['op'] == 'incr':
+                location[field] = location.get(field, 0) + operation['value']
+            else:
+                location[field] = operation['value']
+        return copy.deepcopy(location)
+
+    async def patch_payment_setup(self, email, patch):
+        for operation in patch.operations:
+            if operation['path'] == '/pending_fee':
+                self.pending_fee = operation['value']
+
+
+def test_lazy_accrual_matches_eager_hourly_billing():
+    locations = [
+        location(),
+        location(id='loc-2', monthly_fee=300, current_period_fee=0),
+        location(id='loc-3', monthly_fee=90, current_period_fee=2)
+    ]
+    db_client = FakeDBClient(locations)
+    engine = HourlyBillingEngine(db_client)
+    hours = 30
+    deactivated_at = START + timedelta(hours=12)
+
+    for hour in range(1, hours + 1):
+        now = START + timedelta(hours=hour)
+        if now > deactivated_at:
+            db_client.locations['loc-3']['is_active'] = False
+        asyncio.run(engine.bill_user(
+            {'user_id': 'user@example.com'},
+            copy.deepcopy(list(db_client.locations.values())),
+            now.isoformat(),
+            now.strftime('%Y-%m-%dT%H')
+        ))
+
+    lazy_locations = copy.deepcopy(locations)
+    lazy_locations[2].update({'is_active': False, 'deactivated_at': deactivated_at.isoformat()})
+    as_of = START + timedelta(hours=hours)
+
+    assert db_client.pending_fee == pytest.approx(utils.calculate_pending_fee(lazy_locations, as_of))
+    assert db_client.pending_fee == pytest.approx(
+        5 + hours + 2 + hours * calculate_hourly_rate(300) + 12 * calculate_hourly_rate(90)
+    )
@@ -1,16 +1,20 @@
 import azure.functions as func
 import json
 import logging
-from shared_code.db_client import CosmosDBClient
 from datetime import datetime, timezone
-from shared_code.middleware import check_payment_access
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code.utils import settle_location_fee
+from shared_code.patch import Patch
+import azure.cosmos.exceptions as exceptions
+from shared_code.telemetry import track_invocation
 
+@track_invocation('toggle-active')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         email = req_body.get('email')
         location_id = req_body.get('id')
         
@@ -25,7 +29,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         try:
-            payment_setup = db_client.get_payment_setup(email)
+            payment_setup = request_context.payment_setup
             if not payment_setup:
                 return func.HttpResponse(
                     json.dumps({
@@ -36,19 +40,9 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     status_code=404
                 )
 
-            query = "SELECT * FROM c WHERE c.id = @location_id AND c.type = 'location' AND c.user_id = @user_id"
-            parameters = [
-                {"name": "@location_id", "value": location_id},
-                {"name": "@user_id", "value": email}
-            ]
-            
-            items = list(db_client.location_container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
+            existing_location = db_client.get_location(location_id, user_id=email)
 
-            if not items:
+            if not existing_location:
                 return func.HttpResponse(
                     json.dumps({
                         "error": "Location not found or you don't have permission to update it",
@@ -58,33 +52,45 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     status_code=404
                 )
 
-            existing_location = items[0]
-            current_time = datetime.now(timezone.utc).isoformat()
+            now = datetime.now(timezone.utc)
+            current_time = now.isoformat()
 
-            current_num_locations = payment_setup.get('num_locations', 0)
-            if existing_location['is_active']:
-                new_num_locations = max(0, current_num_locations - 1)
-            else:
-                new_num_locations = current_num_locations + 1
+            was_active = existing_location['is_active']
+            settle_location_fee(existing_location, now)
 
-            payment_setup['num_locations'] = new_num_locations
-            payment_setup['updated_at'] = current_time
-            
-            db_client.payment_container.replace_item(
-                item=payment_setup['id'],
-                body=payment_setup
-            )
-
-            existing_location['is_active'] = not existing_location['is_active']
-            existing_location['updated_at'] = current_time
-            
-            if not existing_location['is_active']:
-                existing_location['deactivated_at'] = current_time
+            location_patch = Patch().set_fields({
+                'is_active': not was_active,
+                'current_period_fee': existing_location['current_period_fee'],
+                'last_billing_update': existing_location['last_billing_update'],
+                'deactivated_at' if was_active else 'activated_at': current_time,
+                'updated_at': current_time
+            })
+            try:
+                # A concurrent toggle must not be applied twice
+                result = db_client.patch_location(
+                    location_id,
+                    email,
+                    location_patch.where(f"c.is_active = {'true' if was_active else 'false'}")
+                )
+            except exceptions.CosmosAccessConditionFailedError:
+                return func.HttpResponse(
+                    json.dumps({
+                        "error": "Location status changed, please try again",
+                        "error_code": "conflict"
+                    }),
+                    mimetype="application/json",
+                    status_code=409
+                )
 
-            result = db_client.location_container.replace_item(
-                item=existing_location['id'],
-                body=existing_location
-            )
+            setup_patch = Patch().incr('num_locations', -1 if was_active else 1).set('updated_at', current_time)
+            try:
+                updated_setup = db_client.patch_payment_setup(
+                    email,
+                    setup_patch.where("c.num_locations > 0") if was_active else setup_patch
+                )
+                new_num_locations = updated_setup['num_locations']
+            except exceptions.CosmosAccessConditionFailedError:
+                new_num_locations = 0
 
             status_message = "deactivated" if not result['is_active'] else "activated"
 
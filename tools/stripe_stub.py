@@ -0,0 +1,386 @@
+# tools/stripe_stub.py
+"""Local stand-in for the part of the Stripe API the payment functions use.
+
+Serves Customer create/modify, PaymentMethod retrieve/attach/detach and
+PaymentIntent create/confirm with Stripe's response and error shapes, so
+setup-payment, add-card, add-credits, unsubscribe and get-payinfo can be
+load-tested offline. Start it and point the function app at it:
+
+    python tools/stripe_stub.py --port 12111 --latency-ms 150 --jitter-ms 50
+    STRIPE_API_BASE=http://localhost:12111 STRIPE_SECRET_KEY=sk_test_stub func start
+
+Payment methods behave like Stripe's test ids: pm_card_visa,
+pm_card_mastercard and pm_card_amex succeed, and the pm_card_chargeDeclined*
+ids decline when a PaymentIntent is confirmed; any other id is a Visa
+ending 4242. Latency, random declines and injected failures can be changed
+while running:
+
+    curl -X POST localhost:12111/_stub/config -d '{"decline_rate": 0.1, "error_rate": 0.02}'
+    curl localhost:12111/_stub/stats
+
+Not shipped with the function app (see .funcignore).
+"""
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+CARDS = {
+    'pm_card_visa': ('visa', '4242'),
+    'pm_card_mastercard': ('mastercard', '4444'),
+    'pm_card_amex': ('amex', '8431'),
+    'pm_card_chargeDeclined': ('visa', '0002'),
+    'pm_card_chargeDeclinedInsufficientFunds': ('visa', '9995'),
+    'pm_card_chargeDeclinedExpiredCard': ('visa', '0069'),
+    'pm_card_chargeDeclinedIncorrectCvc': ('visa', '0127'),
+}
+DECLINES = {
+    'pm_card_chargeDeclined': 'generic_decline',
+    'pm_card_chargeDeclinedInsufficientFunds': 'insufficient_funds',
+    'pm_card_chargeDeclinedExpiredCard': 'expired_card',
+    'pm_card_chargeDeclinedIncorrectCvc': 'incorrect_cvc',
+}
+DECLINE_CODES = {
+    'expired_card': 'expired_card',
+    'incorrect_cvc': 'incorrect_cvc',
+}
+
+
+class StubConfig:
+    """Behaviour of the stub; every field can be changed through POST /_stub/config"""
+
+    def __init__(
+        self,
+        latency_ms: float = 0,
+        jitter_ms: float = 0,
+        decline_rate: float = 0,
+        decline_code: str = 'generic_decline',
+        error_rate: float = 0,
+        timeout_rate: float = 0,
+        timeout_seconds: float = 60
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.decline_rate = decline_rate
+        self.decline_code = decline_code
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+
+    def update(self, values: dict):
+        for key, value in values.items():
+            if not hasattr(self, key):
+                raise ValueError(f"Unknown setting {key}")
+            setattr(self, key, type(getattr(self, key))(value))
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+class StubState:
+    """Objects created so far and request counters, shared by the handler threads"""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.lock = threading.RLock()
+        self.customers = {}
+        self.payment_methods = {}
+        self.payment_intents = {}
+        self.stats = {'requests': 0, 'declines': 0, 'injected_errors': 0, 'injected_timeouts': 0, 'by_route': {}}
+
+    def count(self, key: str, route: str = None):
+        with self.lock:
+            self.stats[key] += 1
+            if route:
+                self.stats['by_route'][route] = self.stats['by_route'].get(route, 0) + 1
+
+
+class StripeError(Exception):
+    def __init__(self, status: int, error: dict):
+        super().__init__(error.get('message'))
+        self.status = status
+        self.error = error
+
+
+def _id(prefix: str) -> str:
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+def _form(body: bytes) -> dict:
+    """Stripe's form encoding, with one level of nesting: metadata[key]=value"""
+    params = {}
+    for key, value in parse_qsl(body.decode(), keep_blank_values=True):
+        match = re.fullmatch(r'(\w+)\[(\w+)\]', key)
+        if match:
+            params.setdefault(match.group(1), {})[match.group(2)] = value
+        else:
+            params[key] = value
+    return params
+
+
+def _card_declined(decline_code: str) -> StripeError:
+    return StripeError(402, {
+        'type': 'card_error',
+        'code': DECLINE_CODES.get(decline_code, 'card_declined'),
+        'decline_code': decline_code,
+        'message': 'Your card was declined.'
+    })
+
+
+def _not_found(kind: str, object_id: str) -> StripeError:
+    return StripeError(404, {
+        'type': 'invalid_request_error',
+        'code': 'resource_missing',
+        'message': f"No such {kind}: '{object_id}'"
+    })
+
+
+def _payment_method(state: StubState, payment_method_id: str) -> dict:
+    payment_method = state.payment_methods.get(payment_method_id)
+    if payment_method is None:
+        brand, last4 = CARDS.get(payment_method_id, ('visa', '4242'))
+        payment_method = {
+            'id': payment_method_id,
+            'object': 'payment_method',
+            'type': 'card',
+            'customer': None,
+            'created': int(time.time()),
+            'card': {'brand': brand, 'last4': last4, 'exp_month': 12, 'exp_year': time.gmtime().tm_year + 3}
+        }
+        state.payment_methods[payment_method_id] = payment_method
+    return payment_method
+
+
+def _customer(state: StubState, customer_id: str, email: str = None) -> dict:
+    # Customers created before the stub started, e.g. on existing payment
+    # setups, are made up on first use instead of failing with 404
+    customer = state.customers.get(customer_id)
+    if customer is None:
+        customer = {
+            'id': customer_id,
+            'object': 'customer',
+            'email': email,
+            'created': int(time.time()),
+            'invoice_settings': {'default_payment_method': None},
+            'metadata': {}
+        }
+        state.customers[customer_id] = customer
+    return customer
+
+
+def create_customer(state: StubState, params: dict) -> dict:
+    customer = _customer(state, _id('cus'), params.get('email'))
+    customer['metadata'] = params.get('metadata', {})
+    return customer
+
+
+def modify_customer(state: StubState, params: dict, customer_id: str) -> dict:
+    customer = _customer(state, customer_id)
+    for key, value in params.items():
+        if isinstance(value, dict):
+            customer.setdefault(key, {}).update(value)
+        else:
+            customer[key] = value
+    return customer
+
+
+def retrieve_payment_method(state: StubState, params: dict, payment_method_id: str) -> dict:
+    return _payment_method(state, payment_method_id)
+
+
+def attach_payment_method(state: StubState, params: dict, payment_method_id: str) -> dict:
+    payment_method = _payment_method(state, payment_method_id)
+    payment_method['customer'] = _customer(state, params.get('customer'))['id']
+    return payment_method
+
+
+def detach_payment_method(state: StubState, params: dict, payment_method_id: str) -> dict:
+    payment_method = _payment_method(state, payment_method_id)
+    if payment_method['customer'] is None:
+        raise StripeError(400, {
+            'type': 'invalid_request_error',
+            'message': 'The payment method you provided is not attached to a customer so detachment is impossible.'
+        })
+    payment_method['customer'] = None
+    return payment_method
+
+
+def _confirm(state: StubState, payment_intent: dict) -> dict:
+    decline_code = DECLINES.get(payment_intent['payment_method'])
+    if decline_code is None and random.random() < state.config.decline_rate:
+        decline_code = state.config.decline_code
+    if decline_code:
+        state.count('declines')
+        payment_intent['status'] = 'requires_payment_method'
+        error = _card_declined(decline_code)
+        error.error['payment_intent'] = payment_intent
+        raise error
+    payment_intent['status'] = 'succeeded'
+    payment_intent['amount_received'] = payment_intent['amount']
+    return payment_intent
+
+
+def create_payment_intent(state: StubState, params: dict) -> dict:
+    payment_intent_id = _id('pi')
+    payment_intent = {
+        'id': payment_intent_id,
+        'object': 'payment_intent',
+        'client_secret': f"{payment_intent_id}_secret_{uuid.uuid4().hex[:24]}",
+        'amount': int(params.get('amount', 0)),
+        'amount_received': 0,
+        'currency': params.get('currency', 'usd'),
+        'customer': params.get('customer'),
+        'payment_method': params.get('payment_method'),
+        'description': params.get('description'),
+        'metadata': params.get('metadata', {}),
+        'created': int(time.time()),
+        'status': 'requires_confirmation' if params.get('payment_method') else 'requires_payment_method'
+    }
+    state.payment_intents[payment_intent['id']] = payment_intent
+    if str(params.get('confirm')).lower() == 'true':
+        return _confirm(state, payment_intent)
+    return payment_intent
+
+
+def confirm_payment_intent(state: StubState, params: dict, payment_intent_id: str) -> dict:
+    payment_intent = state.payment_intents.get(payment_intent_id)
+    if payment_intent is None:
+        raise _not_found('payment_intent', payment_intent_id)
+    if params.get('payment_method'):
+        payment_intent['payment_method'] = params['payment_method']
+    return _confirm(state, payment_intent)
+
+
+ROUTES = [
+    ('POST', '/v1/customers', create_customer),
+    ('POST', '/v1/customers/:id', modify_customer),
+    ('GET', '/v1/payment_methods/:id', retrieve_payment_method),
+    ('POST', '/v1/payment_methods/:id/attach', attach_payment_method),
+    ('POST', '/v1/payment_methods/:id/detach', detach_payment_method),
+    ('POST', '/v1/payment_intents', create_payment_intent),
+    ('POST', '/v1/payment_intents/:id/confirm', confirm_payment_intent),
+]
+ROUTE_PATTERNS = [
+    (method, route, re.compile(route.replace(':id', '([^/]+)')), action)
+    for method, route, action in ROUTES
+]
+
+
+def make_handler(state: StubState):
+    class StripeStubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, body: dict):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.send_header('Request-Id', _id('req'))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        def _control(self, method: str, path: str):
+            if path == '/_stub/stats':
+                with state.lock:
+                    return self._send(200, json.loads(json.dumps(state.stats)))
+            if path == '/_stub/config':
+                if method == 'POST':
+                    try:
+                        state.config.update(json.loads(self._body() or b'{}'))
+                    except (ValueError, TypeError) as e:
+                        return self._send(400, {'error': str(e)})
+                return self._send(200, state.config.to_dict())
+            self._send(404, {'error': f'Unknown control endpoint {path}'})
+
+        def _handle(self, method: str):
+            path = self.path.split('?', 1)[0]
+            if path.startswith('/_stub/'):
+                return self._control(method, path)
+
+            body = self._body()
+            for route_method, route, pattern, action in ROUTE_PATTERNS:
+                match = pattern.fullmatch(path)
+                if route_method != method or not match:
+                    continue
+                state.count('requests', f"{method} {route}")
+                config = state.config
+
+                time.sleep(max(0, config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms)) / 1000)
+                if random.random() < config.timeout_rate:
+                    state.count('injected_timeouts')
+                    time.sleep(config.timeout_seconds)
+                if random.random() < config.error_rate:
+                    state.count('injected_errors')
+                    return self._send(500, {'error': {'type': 'api_error', 'message': 'Injected failure'}})
+
+                try:
+                    with state.lock:
+                        return self._send(200, action(state, _form(body), *match.groups()))
+                except StripeError as e:
+                    return self._send(e.status, {'error': e.error})
+                except Exception as e:
+                    return self._send(500, {'error': {'type': 'api_error', 'message': f'Stub error: {e}'}})
+
+            self._send(404, {'error': {'type': 'invalid_request_error', 'message': f'Unrecognized request URL ({method}: {path})'}})
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def do_DELETE(self):
+            self._handle('DELETE')
+
+    return StripeStubHandler
+
+
+def serve(host: str = 'localhost', port: int = 12111, config: StubConfig = None) -> ThreadingHTTPServer:
+    """Create the stub server; call serve_forever() on it, e.g. in a thread for in-process benchmarks"""
+    server = ThreadingHTTPServer((host, port), make_handler(StubState(config or StubConfig())))
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--decline-rate', type=float, default=0)
+    parser.add_argument('--decline-code', default='generic_decline')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--timeout-rate', type=float, default=0)
+    parser.add_argument('--timeout-seconds', type=float, default=60)
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, StubConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        decline_rate=args.decline_rate,
+        decline_code=args.decline_code,
+        error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate,
+        timeout_seconds=args.timeout_seconds
+    ))
+    print(f"Stripe stub listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,19 +2,57 @@ import azure.functions as func
 import json
 import logging
 import stripe
-import os
 from shared_code.db_client import CosmosDBClient
-from shared_code.middleware import check_payment_access
-from datetime import datetime 
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code import clients
+from shared_code.patch import Patch
+from shared_code.constants import MAX_RETRIES
+import azure.cosmos.exceptions as exceptions
+from shared_code.telemetry import track_invocation
+from shared_code.card_summaries import CARD_SUMMARIES
+from shared_code.stripe_gateway import get_stripe_gateway, StripeUnavailable, stripe_unavailable_response, CHARGE_DEADLINE_SECONDS
 
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+clients.configure_stripe()
 
+def remove_payment_method(db_client: CosmosDBClient, email: str, payment_setup: dict, card_id: str):
+    """Remove a card id and its summary by index, re-reading the setup if either list changed in between"""
+    for attempt in range(MAX_RETRIES):
+        payment_methods = payment_setup.get('payment_methods', [])
+        if card_id not in payment_methods:
+            return
+        index = payment_methods.index(card_id)
+        patch = Patch().remove(f'/payment_methods/{index}')
+        condition = f"c.payment_methods[{index}] = {json.dumps(card_id)}"
+
+        summary_ids = [summary['id'] for summary in payment_setup.get(CARD_SUMMARIES) or []]
+        if card_id in summary_ids:
+            summary_index = summary_ids.index(card_id)
+            patch.remove(f'/{CARD_SUMMARIES}/{summary_index}')
+            condition += f" AND c.{CARD_SUMMARIES}[{summary_index}].id = {json.dumps(card_id)}"
+
+        try:
+            return db_client.patch_payment_setup(email, patch.where(condition))
+        except exceptions.CosmosAccessConditionFailedError:
+            payment_setup = db_client.get_payment_setup(email) or {}
+    raise RuntimeError(f"Payment methods of {email} kept changing, could not remove {card_id}")
+
+def detach_payment_method(card_id: str):
+    """Detach a card from its customer; a card an earlier attempt already detached counts as detached"""
+    gateway = get_stripe_gateway()
+    try:
+        gateway.call(stripe.PaymentMethod.detach, card_id, deadline=CHARGE_DEADLINE_SECONDS)
+    except stripe.error.InvalidRequestError:
+        if gateway.call(stripe.PaymentMethod.retrieve, card_id).customer is not None:
+            raise
+        logging.info(f"Payment method {card_id} was already detached")
+
+@track_invocation('unsubscribe')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         email = req_body.get('email')
         card_id = req_body.get('cardId')
 
@@ -28,7 +66,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
 
-        payment_setup = db_client.get_payment_setup(email)
+        payment_setup = request_context.payment_setup
         if not payment_setup:
             return func.HttpResponse(
                 json.dumps({
@@ -51,16 +89,9 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         try:
-            stripe.PaymentMethod.detach(card_id)
+            detach_payment_method(card_id)
 
-            payment_methods.remove(card_id)
-            payment_setup['payment_methods'] = payment_methods
-            payment_setup['updated_at'] = datetime.utcnow().isoformat()
-
-            db_client.payment_container.replace_item(
-                item=payment_setup['id'],
-                body=payment_setup
-            )
+            remove_payment_method(db_client, email, payment_setup, card_id)
 
             return func.HttpResponse(
                 json.dumps({
@@ -71,6 +102,9 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=200
             )
 
+        except StripeUnavailable as e:
+            return stripe_unavailable_response(e)
+
         except stripe.error.StripeError as e:
             error_msg = str(e)
             logging.error(f"Stripe error: {error_msg}")
@@ -2,16 +2,19 @@
 import azure.functions as func
 import json
 import logging
-from shared_code.db_client import CosmosDBClient
 from datetime import datetime
-from shared_code.middleware import check_payment_access
+from shared_code.middleware import check_payment_access, RequestContext
+from shared_code.patch import Patch
+import azure.cosmos.exceptions as exceptions
+from shared_code.telemetry import track_invocation
 
+@track_invocation('update-location')
 @check_payment_access
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    db_client = CosmosDBClient()
+def main(req: func.HttpRequest, request_context: RequestContext) -> func.HttpResponse:
+    db_client = request_context.db_client
     
     try:
-        req_body = req.get_json()
+        req_body = request_context.body
         logging.info(f"Received request body: {req_body}")
         
         email = req_body.get('email')
@@ -36,7 +39,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
 
         try:
-            payment_setup = db_client.get_payment_setup(email)
+            payment_setup = request_context.payment_setup
             if not payment_setup:
                 return func.HttpResponse(
                     json.dumps({"error": "No payment setup found for this email"}),
@@ -44,19 +47,17 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     status_code=404
                 )
 
-            query = "SELECT * FROM c WHERE c.id = @location_id AND c.type = 'location' AND c.user_id = @user_id"
-            parameters = [
-                {"name": "@location_id", "value": location_id},
-                {"name": "@user_id", "value": email}
-            ]
-            
-            items = list(db_client.location_container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
-
-            if not items:
+            try:
+                result = db_client.patch_location(
+                    location_id,
+                    email,
+                    Patch().set_fields({
+                        'name': location_name,
+                        'address': location_address,
+                        'updated_at': datetime.utcnow().isoformat()
+                    }).where("c.type = 'location'")
+                )
+            except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
                 return func.HttpResponse(
                     json.dumps({
                         "error": "Location not found or you don't have permission to update it",
@@ -66,16 +67,6 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     status_code=404
                 )
 
-            existing_location = items[0]
-            existing_location['name'] = location_name
-            existing_location['address'] = location_address
-            existing_location['updated_at'] = datetime.utcnow().isoformat()
-
-            result = db_client.location_container.replace_item(
-                item=existing_location['id'],
-                body=existing_location
-            )
-
             return func.HttpResponse(
                 json.dumps({
                     "status": "success",